@@ -23,10 +23,11 @@ I do not perform any algebraic optimization.
 
 from __future__ import absolute_import
 from __future__ import division
-try:
-    from uncertainties import umath as math
-except ImportError:
-    import math
+from collections import namedtuple
+import math
+
+import backends
+from units import kPa
 
 
 # Arterial blood reference
@@ -37,7 +38,16 @@ norm_pO2 = (80., 100.)
 live_pH = (6.8, 7.8)  # Live borders
 
 
-kPa = 0.133322368  # kPa to mmHg, 1 mmHg = 0.133322368 kPa
+def use_uncertainties(enable=True):
+    """Switch module math to `uncertainties.umath` to accept ufloat values.
+
+    Plain `math` is used by default: it is much faster and production code
+    passes floats only. For error propagation over arrays see `propagation`.
+
+    :param bool enable: False switches back to plain `math`.
+    """
+    global math
+    math = backends.load('uncertainties' if enable else 'math')
 
 
 def calculate_anion_gap(Na, Cl, HCO3act, K=0.0, albuminum=None):
@@ -169,7 +179,7 @@ def calculate_hco3p(pH, pCO2):
     return 0.230 * pCO2 * 10 ** (pH - pKp)
 
 
-def calculate_hco3pst(pH, pCO2, ctHb, sO2):
+def calculate_hco3pst(pH, pCO2, ctHb, sO2, ABE=None):
     """Standard Bicarbonate, the concentration of HCO3- in the plasma
     from blood which is equilibrated with a gas mixture with
     pCO2 = 5.33 kPa (40 mmHg) and
@@ -187,12 +197,16 @@ def calculate_hco3pst(pH, pCO2, ctHb, sO2):
     :param float pCO2: kPa
     :param float ctHb: Concentration of total hemoglobin in blood, mmol/L
     :param float sO2: Fraction of saturated hemoglobin, fraction.
+    :param float ABE: Actual base excess cBase(B) for given ctHb, mEq/L.
+        Calculated if not given, pass it to avoid repeated calculation.
     :return:
         cHCO3(P,st) mmol/L.
     :rtype: float
     """
+    if ABE is None:
+        ABE = calculate_cbase(pH, pCO2, ctHb=ctHb)
     a = 4.04 * 10 ** -3 + 4.25 * 10 ** -4 * ctHb
-    Z = calculate_cbase(pH, pCO2, ctHb=ctHb) - 0.3062 * ctHb * (1 - sO2)
+    Z = ABE - 0.3062 * ctHb * (1 - sO2)
     return 24.47 + 0.919 * Z + Z * a * (Z - 8)
 
 
@@ -426,87 +440,209 @@ def expected_pH(pCO2, status='acute'):
     return 7.4 + st[status] * (40.0 - pCO2)
 
 
+# Acid-base category codes, see `classify`
+UNKNOWN = 0  # pH or pCO2 missing
+NORMAL = 1
+RESP_ALK_FULL_COMP = 2
+MET_ACID_FULL_COMP = 3
+RESP_ACID_FULL_COMP = 4
+MET_ALK_FULL_COMP = 5
+MET_ACID_PARTIAL_COMP = 6
+RESP_ALK = 7
+RESP_ACID = 8
+MET_ALK_PARTIAL_COMP = 9
+MET_ACID = 10
+MET_ALK = 11
+
+# Code -> opinion, '%s' is replaced by `check_metabolic` result
+CATEGORIES = {
+    UNKNOWN: None,
+    NORMAL: "ABG normal",
+    RESP_ALK_FULL_COMP:
+        "Respiratory alcalosis, full comp. by metabolic acidosis",
+    MET_ACID_FULL_COMP: "Metabolic acidosis, full comp. by CO2 alcalosis",
+    RESP_ACID_FULL_COMP:
+        "Respiratory acidosis, full comp. by metabolic alcalosis. COPD?",
+    MET_ALK_FULL_COMP: "Metabolic alcalosis, full comp. by CO2 acidosis",
+    MET_ACID_PARTIAL_COMP:
+        "Metabolic acidosis, partial comp. by CO2 alcalosis [check BDG]",
+    RESP_ALK: "Respiratory alcalosis (%s)",
+    RESP_ACID: "Respiratory acidosis (%s)",
+    MET_ALK_PARTIAL_COMP: "Metabolic alcalosis, partial comp. by CO2 "
+        "acidosis [check Na, Cl, albumin]",
+    MET_ACID: "Metabolic acidosis, no respiratory comp.",
+    MET_ALK: "Metabolic alcalosis, no respiratory comp.",
+}
+
+# Decision table: [pH low, normal, high][pCO2 low, normal, high] -> code.
+# With normal pH and abnormal pCO2 (full compensation) primary process is
+# chosen by slight pH shift, see `classify`.
+DECISION_TABLE = (
+    (MET_ACID_PARTIAL_COMP, MET_ACID, RESP_ACID),
+    (RESP_ALK_FULL_COMP, NORMAL, RESP_ACID_FULL_COMP),
+    (RESP_ALK, MET_ALK, MET_ALK_PARTIAL_COMP),
+)
+full_comp_pH = (7.39, 7.41)  # pH shift revealing primary process
+metabolic_threshold = 0.07  # Max deviation from expected pH
+
+
+def _isnan(value):
+    """NaN check for float or ufloat (by nominal value)."""
+    value = getattr(value, 'nominal_value', value)
+    return value != value
+
+
+def _level(value, norm):
+    """0, 1, 2 for value below, within or above `norm` range."""
+    if value < norm[0]:
+        return 0
+    elif value > norm[1]:
+        return 2
+    return 1
+
+
+def classify(pH, pCO2):
+    """Acid-base category code, see `abg`.
+
+    `abg_batch.classify` is vectorized version.
+
+    :param float pH:
+    :param float pCO2: mmHg
+    :return:
+        One of category codes, e.g. `RESP_ACID`. `UNKNOWN` for NaN.
+    :rtype: int
+    """
+    if _isnan(pH) or _isnan(pCO2):
+        return UNKNOWN
+    code = DECISION_TABLE[_level(pH, norm_pH)][_level(pCO2, norm_pCO2)]
+    # Don't calculating expected CO2/pH values because both values are
+    # normal or represent two opposed processes (no need for searching
+    # hidden one). pCO2 is abnormal, checking slight pH shifts.
+    if code == RESP_ALK_FULL_COMP and pH < full_comp_pH[1]:
+        return MET_ACID_FULL_COMP
+    if code == RESP_ACID_FULL_COMP and pH > full_comp_pH[0]:
+        return MET_ALK_FULL_COMP  # Classic "chronic" COPD gas otherwise
+    return code
+
+
+def check_metabolic(ex_pH, deviation):
+    """Check metabolic status by expected pH level.
+
+    Does this pH and pCO2 means hidden metabolic process?
+
+    :param float ex_pH: Expected pH, see `expected_pH`.
+    :param float deviation: Actual pH minus expected pH.
+    :rtype: str
+    """
+    guess = ''
+    if abs(deviation) > metabolic_threshold:
+        if deviation > 0:
+            guess += "background metabolic alcalosis, "
+        else:
+            guess += "background metabolic acidosis, "
+    return "%(guess)sexpected pH %(ex_pH).2f" % {
+        'guess': guess, 'ex_pH': ex_pH}
+
+
+def opinion(code, ex_pH, deviation):
+    """Text for category code, see `CATEGORIES`.
+
+    :param int code: Category code, see `classify`.
+    :param float ex_pH: Expected pH, see `expected_pH`.
+    :param float deviation: Actual pH minus expected pH.
+    :rtype: str
+    """
+    text = CATEGORIES[code]
+    if code in (RESP_ALK, RESP_ACID):
+        return text % check_metabolic(ex_pH, deviation)
+    return text
+
+
 def abg(pH, pCO2):
     """Evaluate arterial blood gas status.
 
     http://en.wikipedia.org/wiki/Arterial_blood_gas
 
+    Thin wrapper around `classify` and `opinion`. Use
+    `abg_batch.classify` for many samples.
+
     :param float pH:
     :param float pCO2: mmHg
     :return:
-        Opinion.
+        Opinion, None if pH or pCO2 is NaN.
     :rtype: unicode
     """
-    # https://www.kernel.org/doc/Documentation/CodingStyle
-    # The answer to that is that if you need more than 3 levels of
-    # indentation, you're screwed anyway, and should fix your program.
-
-    def check_metabolic(pH, pCO2):
-        """Check metabolic status by expected pH level.
-
-        Does this pH and pCO2 means hidden metabolic process?
-        """
-        guess = ''
-        magic_number = 0.07
-        ex_pH = expected_pH(pCO2)
-        if abs(pH - ex_pH) > magic_number:
-            if pH > ex_pH:
-                guess += "background metabolic alcalosis, "
-            else:
-                guess += "background metabolic acidosis, "
-        return "%(guess)sexpected pH %(ex_pH).2f" % {
-            'guess': guess, 'ex_pH': ex_pH}
-
-    if norm_pH[0] <= pH <= norm_pH[1]:  # pH is normal or compensated
-        # Don't calculating expected CO2/pH values because both values are
-        # normal or represent two opposed processes (no need for searching
-        # hidden one)
-        # pCO2 is abnormal, checking slight pH shifts
-        if pCO2 < norm_pCO2[0]:
-            # Low (respiratory alcalosis)
-            if pH >= 7.41:
-                return "Respiratory alcalosis, full comp. by metabolic acidosis"
-            else:
-                return "Metabolic acidosis, full comp. by CO2 alcalosis"
-        elif pCO2 > norm_pCO2[1]:
-            # High (respiratory acidosis)
-            if pH <= 7.39:  # pH almost acidotic
-                # Classic "chronic" COPD gas
-                return "Respiratory acidosis, full comp. by metabolic alcalosis. COPD?"
-            else:
-                return "Metabolic alcalosis, full comp. by CO2 acidosis"
-        else:
-            return "ABG normal"
-    else:
-        # pH decompensation
-        if pCO2 < norm_pCO2[0]:  # Low (respiratory alcalosis)
-            # Достаточно ли такого изменения pH, чтобы дать такой pCO2?
-            if pH < norm_pH[0]:
-                # Check anion gap here?
-                return "Metabolic acidosis, partial comp. by CO2 alcalosis [check BDG]"
-            elif pH > norm_pH[1]:
-                return "Respiratory alcalosis (%s)" % check_metabolic(pH, pCO2)
-        elif pCO2 > norm_pCO2[1]:
-            if pH < norm_pH[0]:
-                return "Respiratory acidosis (%s)" % check_metabolic(pH, pCO2)
-            elif pH > norm_pH[1]:
-                return "Metabolic alcalosis, partial comp. by CO2 acidosis [check Na, Cl, albumin]"
-        else:
-            # Normal pCO2 (35 <= pCO2 <= 45 normal)
-            if pH < norm_pH[0]:
-                return "Metabolic acidosis, no respiratory comp."
-            elif pH > norm_pH[1]:
-                return "Metabolic alcalosis, no respiratory comp."
+    ex_pH = expected_pH(pCO2)
+    return opinion(classify(pH, pCO2), ex_pH, pH - ex_pH)
 
 
-def abg2(pH, pCO2, HCO3=None):
+# Winter's formula: expected pCO2 = slope * HCO3 + intercept ± tolerance
+WINTER = {
+    'acidosis': (1.5, 8., 2.),
+    'alkalosis': (0.7, 20., 1.5),
+}
+
+Compensation = namedtuple('Compensation', [
+    'ratio', 'pH_acute', 'pH_chronic',
+    'pCO2_acidosis_low', 'pCO2_acidosis_high',
+    'pCO2_alkalosis_low', 'pCO2_alkalosis_high'])
+Compensation.__doc__ = """Expected ABG values, see `compensation`.
+
+ratio - ΔpH/ΔpCO2×100.
+pH_acute, pH_chronic - expected pH, see `expected_pH`.
+pCO2_* - Winter's formula bounds of expected pCO2, mmHg.
+"""
+
+
+def compensation(pH, pCO2, HCO3=None):
     """Calculate expected ABG values.
 
+    `abg_batch.compensation` is vectorized version.
+
 
     References
     ----------
     [1] Kostuchenko S.S., ABB in the ICU, 2009
 
+    :param float pH:
+    :param float pCO2: mmHg
+    :param float HCO3: mEq/L, standartized. Evaluated automatically if not
+        provided
+    :rtype: Compensation
+    """
+    if HCO3 is None:
+        HCO3 = calculate_hco3(pH, pCO2)
+    bounds = []
+    for status in ('acidosis', 'alkalosis'):
+        slope, intercept, tolerance = WINTER[status]
+        bounds.extend((slope * HCO3 + intercept - tolerance,
+                       slope * HCO3 + intercept + tolerance))
+    return Compensation(
+        (7.4 - pH) / (pCO2 - 40.0) * 100,  # Assess respiratory problem
+        expected_pH(pCO2, 'acute'), expected_pH(pCO2, 'chronic'), *bounds)
+
+
+def compensation_text(result):
+    """Render `Compensation` as text, one metric per line.
+
+    :rtype: str
+    """
+    acidosis = (result.pCO2_acidosis_low + result.pCO2_acidosis_high) / 2
+    alkalosis = (result.pCO2_alkalosis_low + result.pCO2_alkalosis_high) / 2
+    return "\n".join((
+        "y = ΔpH/ΔpCO2×100 = %.2f" % result.ratio,
+        "pH\t\tby Genderson\texpected %.2f .. %.2f acute-chronic" % (
+            result.pH_acute, result.pH_chronic),
+        "pCO2\tby Winter (x)\texpected %.1f±%g .. %.1f±%g"
+        " acidisis-alkalosis" % (
+            acidosis, WINTER['acidosis'][2],
+            alkalosis, WINTER['alkalosis'][2]),
+    ))
+
+
+def abg2(pH, pCO2, HCO3=None):
+    """Print expected ABG values, see `compensation`.
+
     :param float pH:
     :param float pCO2: mmHg
     :param float HCO3: mEq/L, standartized. Evaluated automatically if not
@@ -515,27 +651,37 @@ def abg2(pH, pCO2, HCO3=None):
         Opinion.
     :rtype: str
     """
-    if HCO3 is None:
-        HCO3 = calculate_hco3(pH, pCO2)
+    text = compensation_text(compensation(pH, pCO2, HCO3))
+    print(text)
+    return text
 
-    # Assess respiratory problem
-    print("y = ΔpH/ΔpCO2×100 = %.2f" % ((7.4 - pH) / (pCO2 - 40.0) * 100))
 
-    # Expected pH (acute, chronic)
-    print("pH\t\tby Genderson\texpected %.2f .. %.2f acute-chronic" % (
-        7.4 + 0.008 * (40 - pCO2), 7.4 + 0.003 * (40 - pCO2)))
+def describe_text(pH, pCO2, HCO3act, BE, opinion, result):
+    """Full text report, see `describe`.
 
-    # Winter's formula (acidosis, alkalosis)
-    print("pCO2\tby Winter (x)\texpected %.1f±2 .. %.1f±1.5"
-          " acidisis-alkalosis" % (1.5 * HCO3 + 8, 0.7 * HCO3 + 20))
+    :param str opinion: See `abg`.
+    :param Compensation result: See `compensation`.
+    :rtype: str
+    """
+    return "pH %.2f, pCO2 %.2f, HCO3act %.2f, BE %+.2f\n%s\n%s" % (
+        pH, pCO2, HCO3act, BE, opinion, compensation_text(result))
 
 
 def describe(pH, pCO2):
-    HCO3act = calculate_hco3p(pH, pCO2)
-    info = "pH %.2f, pCO2 %.2f, HCO3act %.2f, BE %+.2f" % (pH, pCO2, HCO3act, calculate_be(pH, pCO2, HCO3act))
-    print(info)
-    print(abg(pH, pCO2))
-    abg2(pH, pCO2)
+    """Print acid-base status report, see `abg_batch.describe` for arrays.
+
+    :param float pH:
+    :param float pCO2: mmHg
+    :return:
+        Report text.
+    :rtype: str
+    """
+    HCO3act = calculate_hco3p(pH, pCO2 * kPa)
+    text = describe_text(
+        pH, pCO2, HCO3act, calculate_be(pH, pCO2 * kPa, HCO3act),
+        abg(pH, pCO2), compensation(pH, pCO2))
+    print(text)
+    return text
 
 
 def test():
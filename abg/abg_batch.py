@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized (NumPy) counterparts of `abg` calculate_* functions.
+
+Every function takes scalars or array-likes, broadcasts them against each
+other and returns `numpy.ndarray`. Equations, argument names and units are
+exactly the same as in `abg` module, so check original docstrings for
+references. Results match scalar versions within float tolerance:
+
+    >>> import abg, abg_batch
+    >>> abg_batch.calculate_hco3p(pH=[6.656, 7.4], pCO2=[3.72, 5.33])
+    array([ 2.93209238, 24.24897842])
+
+Use this module for lab archives and cohorts, where per-value Python call
+overhead dominates.
+
+Acid-base status of whole arrays is classified by `classify` into integer
+codes of `abg.CATEGORIES`, text is rendered only on demand:
+
+    >>> result = abg_batch.classify(pH, pCO2)
+    >>> (result.code == abg.RESP_ACID).sum()
+    >>> abg_batch.opinions(result)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from collections import namedtuple
+
+import abg
+import backends
+from units import kPa
+
+np = backends.lazy('numpy')
+
+
+def _asarray(value):
+    """Convert input to float ndarray without copying if possible."""
+    return np.asarray(value, dtype=float)
+
+
+def calculate_anion_gap(Na, Cl, HCO3act, K=0.0, albuminum=None):
+    """Calculate serum 'Anion Gap' or 'Anion Gap (K+)', see `abg`.
+
+    :param ndarray Na: Serum sodium, mmol/L.
+    :param ndarray Cl: Serum chloride, mmol/L.
+    :param ndarray HCO3act: Serum actual bicarbonate (HCO3(P)), mmol/L.
+    :param ndarray K: Serum potassium, mmol/L.
+    :param ndarray albuminum: Protein correction, g/dL.
+    :return:
+        Anion gap mEq/L.
+    :rtype: ndarray
+    """
+    anion_gap = (_asarray(Na) + _asarray(K)) - (
+        _asarray(Cl) + _asarray(HCO3act))
+    if albuminum is not None:
+        anion_gap = anion_gap + 2.5 * (4.4 - _asarray(albuminum))
+    return anion_gap
+
+
+def calculate_mosm(Na, glucosae):
+    """Calculate serum osmolarity (mOsm), see `abg`.
+
+    :param ndarray Na: mmol/L
+    :param ndarray glucosae: mmol/L
+    :return:
+        Serum osmolarity, mmol/kg.
+    :rtype: ndarray
+    """
+    return 2 * _asarray(Na) + _asarray(glucosae)
+
+
+def calculate_hco3(pH, pCO2):
+    """Concentration of HCO3 in plasma, Henderson-Hasselbalch, see `abg`.
+
+    :param ndarray pH:
+    :param ndarray pCO2: mmHg
+    :return:
+        HCO3act mmol/L.
+    :rtype: ndarray
+    """
+    return 0.03 * _asarray(pCO2) * 10 ** (_asarray(pH) - 6.1)
+
+
+def calculate_hco3p(pH, pCO2):
+    """Concentration of HCO3 in plasma (actual bicarbonate), see `abg`.
+
+    :param ndarray pH:
+    :param ndarray pCO2: kPa
+    :return:
+        cHCO3(P) mmol/L.
+    :rtype: ndarray
+    """
+    pH = _asarray(pH)
+    pKp = 6.125 - np.log10(1 + 10 ** (pH - 8.7))  # Dissociation constant
+    return 0.230 * _asarray(pCO2) * 10 ** (pH - pKp)
+
+
+def calculate_hco3pst(pH, pCO2, ctHb, sO2, ABE=None):
+    """Standard Bicarbonate cHCO3(P,st), see `abg`.
+
+    :param ndarray pH:
+    :param ndarray pCO2: kPa
+    :param ndarray ctHb: Concentration of total hemoglobin in blood, mmol/L
+    :param ndarray sO2: Fraction of saturated hemoglobin, fraction.
+    :param ndarray ABE: Actual base excess cBase(B) for given ctHb, mEq/L.
+        Calculated if not given, pass it to avoid repeated calculation.
+    :return:
+        cHCO3(P,st) mmol/L.
+    :rtype: ndarray
+    """
+    ctHb = _asarray(ctHb)
+    if ABE is None:
+        ABE = calculate_cbase(pH, pCO2, ctHb=ctHb)
+    a = 4.04 * 10 ** -3 + 4.25 * 10 ** -4 * ctHb
+    Z = _asarray(ABE) - 0.3062 * ctHb * (1 - _asarray(sO2))
+    return 24.47 + 0.919 * Z + Z * a * (Z - 8)
+
+
+def calculate_be(pH, pCO2, HCO3act):
+    """Calculate base excess (BE), Siggaard Andersen approximation,
+    see `abg`.
+
+    :param ndarray pH:
+    :param ndarray pCO2: mmHg
+    :return:
+        Base excess, mEq/L.
+    :rtype: ndarray
+    """
+    return 0.9287 * _asarray(HCO3act) + 13.77 * _asarray(pH) - 124.58
+
+
+def calculate_cbase(pH, pCO2, ctHb=3):
+    """Calculate standard (SBE) or actual (ABE) base excess, see `abg`.
+
+    :param ndarray pH:
+    :param ndarray pCO2: kPa
+    :param ndarray ctHb: Concentration of total hemoglobin in blood, mmol/L
+        If not given, calculate cBase(Ecf), otherwise cBase(B).
+    :return:
+        Standard base excess (SBE) or actual base excess (ABE), mEq/L.
+    :rtype: ndarray
+    """
+    pH = _asarray(pH)
+    pCO2 = _asarray(pCO2)
+    ctHb = _asarray(ctHb)
+    a = 4.04 * 10 ** -3 + 4.25 * 10 ** -4 * ctHb
+    pHHb = 4.06 * 10 ** -2 * ctHb + 5.98 - 1.92 * 10 ** (-0.16169 * ctHb)
+    log_pCO2Hb = -1.7674 * (10 ** -2) * ctHb + 3.4046 + 2.12 * 10 ** (
+        -0.15158 * ctHb)
+    pHst = pH + np.log10(5.33 / pCO2) * (
+        (pHHb - pH) / (log_pCO2Hb - np.log10(7.5006 * pCO2)))
+    cHCO3_533 = 0.23 * 5.33 * 10 ** ((pHst - 6.161) / 0.9524)
+    return 0.5 * ((8 * a - 0.919) / a) + 0.5 * np.sqrt(
+        (((0.919 - 8 * a) / a) ** 2) - 4 * ((24.47 - cHCO3_533) / a))
+
+
+def calculate_hct(ctHb):
+    """Calculate hematocrit, see `abg`.
+
+    :param ndarray ctHb: Concentration of total hemoglobin in blood, mmol/L.
+    :return:
+        Hematocrit, fraction (not %).
+    :rtype: ndarray
+    """
+    return 0.0485 * _asarray(ctHb) + 8.3 * 10 ** -3
+
+
+def calculate_pHT(pH, t):
+    """pH of blood at patient temperature, see `abg`.
+
+    :param ndarray pH:
+    :param ndarray t: Body temperature, °C.
+    :return:
+        pH of blood at given temperature.
+    :rtype: ndarray
+    """
+    pH = _asarray(pH)
+    return pH - (0.0146 + 0.0065 * (pH - 7.40)) * (_asarray(t) - 37)
+
+
+def calculate_pCO2T(pCO2, t):
+    """Partial pressure of CO2 in blood at patient temperature, see `abg`.
+
+    :param ndarray pCO2: kPa or mmHg (sic!)
+    :param ndarray t: Body temperature, °C.
+    :return:
+        Partial pressure of CO2 at given temperature, kPa or mmHg.
+    :rtype: ndarray
+    """
+    return _asarray(pCO2) * 10 ** (0.021 * (_asarray(t) - 37))
+
+
+def calculate_ctO2(pO2, sO2, FCOHb, FMetHb, ctHb):
+    """Total oxygen concentration of blood ctO2(B), see `abg`.
+
+    :param ndarray pO2: kPa
+    :param ndarray sO2: fraction
+    :param ndarray FCOHb: fraction
+    :param ndarray FMetHb: fraction
+    :param ndarray ctHb: mmol/L
+    :return:
+        O2 content, mmol/L.
+    :rtype: ndarray
+    """
+    alphaO2 = 9.83 * 10 ** -3  # mmol/L/kPa
+    return alphaO2 * _asarray(pO2) + _asarray(sO2) * (
+        1 - _asarray(FCOHb) - _asarray(FMetHb)) * _asarray(ctHb)
+
+
+def calculate_pO2_FO2_fraction(pO2, FO2):
+    """pO2(a)/FO2(I) ratio, see `abg`.
+
+    Unlike scalar version input array is never modified in place.
+
+    :param ndarray pO2: kPa
+    :param ndarray FO2: Fraction of oxygen in dry inspired air, fraction.
+    :return:
+        pO2(a)/FO2(I), mmHg.
+    :rtype: ndarray
+    """
+    return _asarray(pO2) / kPa / _asarray(FO2)
+
+
+def calculate_Ca74(pH, Ca):
+    """Ionized calcium at pH 7.4, see `abg`.
+
+    Scalar version raises ValueError for pH out of valid range. One bad
+    sample must not break whole batch, so NaN returned for such elements.
+
+    :param ndarray pH:
+    :param ndarray Ca: mmol/L
+    :return:
+        cCa2+(7.4), mmol/L.
+    :rtype: ndarray
+    """
+    pH = _asarray(pH)
+    Ca74 = _asarray(Ca) * (1 - 0.53 * (7.4 - pH))
+    return np.where((7.2 <= pH) & (pH <= 7.4), Ca74, np.nan)
+
+
+def expected_pH(pCO2, status='acute'):
+    """Calculate expected pH for given pCO2, see `abg`.
+
+    :param ndarray pCO2: mmHg
+    :return:
+        Expected pH.
+    :rtype: ndarray
+    """
+    st = {'acute': 0.008, 'chronic': 0.003}
+    return 7.4 + st[status] * (40.0 - _asarray(pCO2))
+
+
+Classification = namedtuple('Classification', 'code expected_pH deviation')
+Classification.__doc__ = """Acid-base status of samples, see `classify`.
+
+code - int8 array of `abg` category codes.
+expected_pH - expected pH for acute respiratory process, `expected_pH`.
+deviation - actual pH minus expected pH.
+"""
+
+
+def classify(pH, pCO2):
+    """Acid-base category codes for arrays, see `abg.classify`.
+
+    Same decision table as scalar version, evaluated with array indexing.
+
+    :param ndarray pH:
+    :param ndarray pCO2: mmHg
+    :rtype: Classification
+    """
+    pH, pCO2 = np.broadcast_arrays(_asarray(pH), _asarray(pCO2))
+    table = np.array(abg.DECISION_TABLE, dtype=np.int8)
+    with np.errstate(invalid='ignore'):
+        ph_level = (pH >= abg.norm_pH[0]).astype(np.intp) + (
+            pH > abg.norm_pH[1])
+        co2_level = (pCO2 >= abg.norm_pCO2[0]).astype(np.intp) + (
+            pCO2 > abg.norm_pCO2[1])
+        code = table[ph_level, co2_level]
+        code[(code == abg.RESP_ALK_FULL_COMP) & (
+            pH < abg.full_comp_pH[1])] = abg.MET_ACID_FULL_COMP
+        code[(code == abg.RESP_ACID_FULL_COMP) & (
+            pH > abg.full_comp_pH[0])] = abg.MET_ALK_FULL_COMP
+    code[np.isnan(pH) | np.isnan(pCO2)] = abg.UNKNOWN
+    ex_pH = expected_pH(pCO2)
+    return Classification(code, ex_pH, pH - ex_pH)
+
+
+def opinions(result):
+    """Text opinions for classified samples, see `abg.opinion`.
+
+    :param Classification result: Output of `classify`.
+    :return:
+        List of str (None for `abg.UNKNOWN`), flat.
+    :rtype: list
+    """
+    return [abg.opinion(code, ex_pH, deviation) for code, ex_pH, deviation
+            in zip(result.code.ravel().tolist(),
+                   result.expected_pH.ravel().tolist(),
+                   result.deviation.ravel().tolist())]
+
+
+def compensation(pH, pCO2, HCO3=None):
+    """Expected ABG values for arrays, see `abg.compensation`.
+
+    :param ndarray pH:
+    :param ndarray pCO2: mmHg
+    :param ndarray HCO3: mEq/L, Henderson-Hasselbalch by default.
+    :return:
+        `abg.Compensation` of ndarrays. Ratio is inf or NaN for pCO2 of
+        exactly 40 mmHg.
+    :rtype: abg.Compensation
+    """
+    pH, pCO2 = _asarray(pH), _asarray(pCO2)
+    if HCO3 is None:
+        HCO3 = calculate_hco3(pH, pCO2)
+    HCO3 = _asarray(HCO3)
+    bounds = []
+    for status in ('acidosis', 'alkalosis'):
+        slope, intercept, tolerance = abg.WINTER[status]
+        bounds.extend((slope * HCO3 + intercept - tolerance,
+                       slope * HCO3 + intercept + tolerance))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (7.4 - pH) / (pCO2 - 40.0) * 100
+    return abg.Compensation(
+        ratio, expected_pH(pCO2, 'acute'), expected_pH(pCO2, 'chronic'),
+        *bounds)
+
+
+def describe(pH, pCO2):
+    """Acid-base status of arrays as numbers, see `abg.describe`.
+
+    :param ndarray pH:
+    :param ndarray pCO2: mmHg
+    :return:
+        Dict of ndarrays: 'HCO3act', 'BE', fields of `Classification`
+        and `abg.Compensation`. Ready for `pandas.DataFrame`.
+    :rtype: dict
+    """
+    pH, pCO2 = np.broadcast_arrays(_asarray(pH), _asarray(pCO2))
+    HCO3act = calculate_hco3p(pH, pCO2 * kPa)
+    result = {
+        'HCO3act': HCO3act,
+        'BE': calculate_be(pH, pCO2 * kPa, HCO3act),
+    }
+    result.update(classify(pH, pCO2)._asdict())
+    result.update(compensation(pH, pCO2)._asdict())
+    return result
+
+
+def render(pH, pCO2, description):
+    """Text reports for described samples, see `abg.describe_text`.
+
+    Separate optional stage: numbers are formatted only here, all samples
+    in one pass.
+
+    :param ndarray pH:
+    :param ndarray pCO2: mmHg
+    :param dict description: Output of `describe`.
+    :return:
+        List of str, flat.
+    :rtype: list
+    """
+    def column(values):
+        return np.broadcast_to(
+            values, description['code'].shape).ravel().tolist()
+
+    texts = opinions(Classification(*[
+        description[name] for name in Classification._fields]))
+    results = zip(*[column(description[name])
+                    for name in abg.Compensation._fields])
+    return [abg.describe_text(*row) for row in zip(
+        column(pH), column(pCO2), column(description['HCO3act']),
+        column(description['BE']), texts,
+        [abg.Compensation(*r) for r in results])]
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming parser of ASTM-like analyzer messages (ASTM E1394 / LIS2-A2).
+
+Analyzers push results as line-oriented records, one message per sample:
+
+    H|\\^&|||ABL800^Radiometer
+    P|1||13594
+    O|1|S123|||||20150429081000
+    R|1|^^^pH|7.390|||N||F
+    R|2|^^^pCO2|31.9|mmHg||N||F
+    L|1|N
+
+`MessageParser.feed()` takes raw bytes as they arrive (any split, LIS1-A
+frames `<STX>n...<ETX>cc` are unwrapped) and returns completed samples,
+no intermediate CSV is needed:
+
+    >>> parser = MessageParser()
+    >>> for data in read_socket(sock):
+    ...     for sample in parser.feed(data):
+    ...         ...  # {'id': '13594', 'sample_date': ..., 'pH': 7.39, ...}
+
+    >>> for chunk in derive_stream(read_file('night.astm')):
+    ...     chunk['SBE']  # `pipeline.derive` columns plus id, sample_date
+
+Result values are converted to canonical units (`units.ingest`) using
+unit field of result record, default is `samples.csv` unit. Result
+records with unknown test code are ignored, ones with unparsable value or
+unit not accepted for parameter are counted in `MessageParser.errors`.
+
+Records are located in receive buffer in place (regex over `bytearray`),
+buffer is compacted once per `feed()` call; only records themselves are
+copied out for splitting to fields.
+
+    $ python astm.py night.astm derived.csv
+    $ python astm.py --listen 5000 derived.csv  # Analyzer or replay
+    $ python astm.py --replay night.astm --port 5000  # Replay file to socket
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import argparse
+import io
+import re
+import socket
+
+import backends
+import pipeline
+import stream
+from sample import _parse_date
+from units import INPUTS, UnitError, canonical, multiplier
+
+np = backends.lazy('numpy')
+
+# Analyzer test code -> `samples.csv` column
+TESTS = {
+    'pH': 'pH',
+    'pCO2': 'pCO2',
+    'pO2': 'pO2',
+    'sO2': 'sO2',
+    'ctHb': 'ctHb',
+    'FCOHb': 'FCOHb',
+    'FMetHb': 'FMetHb',
+    'cNa': 'cNa', 'cNa+': 'cNa',
+    'cCl': 'cCl', 'cCl-': 'cCl',
+    'cK': 'cK', 'cK+': 'cK',
+    'cGlu': 'cGlu',
+    'T': 'temp', 'temp': 'temp',
+    'FO2': 'FO2', 'FO2(I)': 'FO2',
+}
+
+# Unit spellings seen in messages -> `units` name
+UNIT_ALIASES = {
+    'C': '°C', 'degC': '°C', 'Cel': '°C',
+    'mmol/l': 'mmol/L', 'g/dl': 'g/dL', 'kpa': 'kPa', 'mmhg': 'mmHg',
+}
+
+# `samples.csv` column -> `units.INPUTS` name
+_NAMES = dict((column, name) for name, (column, _, _) in INPUTS.items())
+
+# Units of parsed samples, pass as `units` to `pipeline.derive`
+UNITS = dict((column, canonical(name)) for column, name in _NAMES.items())
+
+STX, ETX, ETB = b'\x02', b'\x03', b'\x17'
+_CONTROL = b'\x04\x05\x06\x15'  # EOT, ENQ, ACK, NAK
+_TERMINATOR = re.compile(b'[\r\n]')
+
+
+def _field(fields, i):
+    return fields[i] if i < len(fields) else ''
+
+
+def _date(value):
+    """ASTM YYYYMMDD[HHMM[SS]] to ISO 8601, '' if malformed."""
+    value = value.strip()
+    if len(value) < 8 or not value[:12].isdigit():
+        return ''
+    date = '%s-%s-%s' % (value[:4], value[4:6], value[6:8])
+    if len(value) >= 12:
+        date += 'T%s:%s' % (value[8:10], value[10:12])
+    return date
+
+
+def _factor(test, unit):
+    """Column and multiplier to canonical unit for result record.
+
+    :return:
+        (None, None) for unknown test, (column, None) for unit not
+        accepted for it.
+    """
+    code = test.split('^')
+    column = TESTS.get(code[3] if len(code) > 3 else code[-1])
+    if column is None:
+        return None, None
+    name = _NAMES[column]
+    unit = unit.strip()
+    unit = UNIT_ALIASES.get(unit, unit) or INPUTS[name][1]
+    try:
+        return column, multiplier(name, unit)
+    except UnitError:
+        return column, None
+
+
+class MessageParser(object):
+
+    """Incremental parser of analyzer byte stream, see module description.
+
+    :param str encoding: Text encoding of records.
+    """
+
+    def __init__(self, encoding='latin-1'):
+        self.encoding = encoding
+        self._buffer = bytearray()
+        self._sample = None
+        self._id = ''
+        self._factors = {}  # (test id, unit) -> (column, multiplier)
+        self.records = 0
+        self.samples = 0
+        self.errors = 0
+
+    def feed(self, data):
+        """Parse next piece of stream.
+
+        :param bytes data: Raw bytes, may end in the middle of record.
+        :return:
+            List of samples completed by this piece: dicts with 'id',
+            'sample_date' and `samples.csv` input columns, canonical units.
+        :rtype: list
+        """
+        buffer = self._buffer
+        buffer += data
+        view = memoryview(buffer)
+        completed = []
+        start = 0
+        try:
+            for match in _TERMINATOR.finditer(buffer):
+                end = match.start()
+                if end > start:
+                    self._record(view[start:end], completed)
+                start = end + 1
+        finally:
+            view.release()
+        del buffer[:start]  # Keep incomplete record only
+        return completed
+
+    def close(self):
+        """Flush last sample if stream ended without terminator record.
+
+        :rtype: list
+        """
+        completed = []
+        if self._buffer:
+            self._record(memoryview(bytes(self._buffer)), completed)
+            del self._buffer[:]
+        self._emit(completed)
+        return completed
+
+    def _record(self, line, completed):
+        """Handle one record, `line` is memoryview into buffer."""
+        line = line.tobytes().strip(_CONTROL)
+        if line[:1] == STX:  # LIS1-A frame: STX, frame number, ..., ETX cc
+            line = line[2:]
+            for mark in (ETX, ETB):
+                i = line.rfind(mark)
+                if i >= 0:
+                    line = line[:i]
+                    break
+        if line[1:2] != b'|':
+            return
+        kind = line[:1]
+        if kind == b'R':
+            self.records += 1
+            self._result(line.decode(self.encoding).split('|', 5))
+            return
+        if kind not in b'HPOL':
+            return
+        self.records += 1
+        fields = line.decode(self.encoding).split('|', 8)
+        if kind == b'H':
+            self._emit(completed)
+            self._id = ''
+        elif kind == b'P':
+            self._emit(completed)
+            self._id = (_field(fields, 2) or _field(fields, 3)).strip()
+        elif kind == b'O':
+            self._emit(completed)
+            self._sample = {
+                'id': self._id or _field(fields, 2).strip(),
+                'sample_date': _date(_field(fields, 7))}
+        else:  # L
+            self._emit(completed)
+
+    def _result(self, fields):
+        if len(fields) < 5:
+            fields += [''] * (5 - len(fields))
+        key = (fields[2], fields[4])
+        try:
+            column, factor = self._factors[key]
+        except KeyError:
+            column, factor = self._factors[key] = _factor(*key)
+        if column is None:
+            return
+        if self._sample is None:
+            self._sample = {'id': self._id, 'sample_date': ''}
+        try:
+            value = float(fields[3])
+        except ValueError:
+            factor = None
+        if factor is None:  # Unparsable value or unit not accepted
+            self.errors += 1
+        else:
+            self._sample[column] = value * factor
+
+    def _emit(self, completed):
+        sample, self._sample = self._sample, None
+        if sample is not None and len(sample) > 2:
+            completed.append(sample)
+            self.samples += 1
+
+
+def parse(chunks, encoding='latin-1'):
+    """Parse iterable of byte pieces to samples.
+
+    :return:
+        Generator of sample dicts, see `MessageParser.feed`.
+    """
+    parser = MessageParser(encoding)
+    for data in chunks:
+        for sample in parser.feed(data):
+            yield sample
+    for sample in parser.close():
+        yield sample
+
+
+def _table(samples):
+    """Samples to dict of columns: passthrough as str, inputs as float."""
+    table = dict((name, np.array([s[name] for s in samples], dtype=str))
+                 for name in stream.PASSTHROUGH)
+    for column in UNITS:
+        if any(column in s for s in samples):
+            table[column] = np.array(
+                [s.get(column, np.nan) for s in samples], dtype=float)
+    return table
+
+
+def derive_stream(chunks, chunksize=1000, columns=None):
+    """Derive parameters for samples of byte stream, see `pipeline.derive`.
+
+    Samples are collected to tables of `chunksize` rows, so formulas run
+    vectorized; last table is flushed when stream ends.
+
+    :param chunks: Iterable of bytes, e.g. `read_file` or `read_socket`.
+    :param columns: Derived columns to calculate, all by default.
+    :return:
+        Generator of dicts: 'id', 'sample_date' and derived columns, ready
+        for `stream.write_csv`.
+    """
+    samples = []
+    for sample in parse(chunks):
+        samples.append(sample)
+        if len(samples) == chunksize:
+            yield _derive(samples, columns)
+            samples = []
+    if samples:
+        yield _derive(samples, columns)
+
+
+def _derive(samples, columns):
+    table = _table(samples)
+    derived = dict((name, table[name]) for name in stream.PASSTHROUGH)
+    derived.update(pipeline.derive(table, columns=columns, units=dict(
+        (column, unit) for column, unit in UNITS.items() if column in table)))
+    return derived
+
+
+def read_file(source, blocksize=65536):
+    """Read file by blocks.
+
+    :param source: Path or binary file object.
+    :return:
+        Generator of bytes.
+    """
+    if isinstance(source, str):
+        with io.open(source, 'rb') as f:
+            for data in read_file(f, blocksize):
+                yield data
+        return
+    while True:
+        data = source.read(blocksize)
+        if not data:
+            return
+        yield data
+
+
+def read_socket(sock, blocksize=65536):
+    """Receive from connected socket until peer closes it.
+
+    :return:
+        Generator of bytes.
+    """
+    while True:
+        data = sock.recv(blocksize)
+        if not data:
+            return
+        yield data
+
+
+def listen(port, host='127.0.0.1'):
+    """Accept one analyzer connection and read it until closed.
+
+    :return:
+        Generator of bytes.
+    """
+    server = socket.create_server((host, port))
+    try:
+        conn, _ = server.accept()
+        with conn:
+            for data in read_socket(conn):
+                yield data
+    finally:
+        server.close()
+
+
+def replay(source, port, host='127.0.0.1', blocksize=4096):
+    """Send file to socket as analyzer would, for testing `listen`.
+
+    :param source: Path or binary file object with recorded messages.
+    :return:
+        Number of bytes sent.
+    """
+    sent = 0
+    with socket.create_connection((host, port)) as sock:
+        for data in read_file(source, blocksize):
+            sock.sendall(data)
+            sent += len(data)
+    return sent
+
+
+def encode(table):
+    """Format `samples.csv`-like table as messages, e.g. to make replay
+    files from exports.
+
+    :param table: Dict of arrays or DataFrame with `samples.csv` columns
+        and units.
+    :return:
+        Generator of bytes, one message per row.
+    """
+    names = pipeline.column_names(table)
+    # Column names are valid test codes
+    columns = [column for column in sorted(UNITS) if column in names]
+    values = dict((column, np.asarray(table[column], dtype=float))
+                  for column in columns)
+    size = len(values[columns[0]]) if columns else 0
+    ids = table['id'] if 'id' in names else [''] * size
+    dates = table['sample_date'] if 'sample_date' in names else [''] * size
+    for row in range(size):
+        date = _parse_date(str(dates[row]))
+        date = '' if np.isnat(date) else ''.join(
+            c for c in str(date) if c.isdigit())
+        lines = ['H|\\^&|||ABL800^Radiometer', 'P|1||%s' % ids[row],
+                 'O|1|%s|||||%s' % (ids[row], date)]
+        n = 0
+        for column in columns:
+            value = values[column][row]
+            if value != value:
+                continue
+            n += 1
+            lines.append('R|%d|^^^%s|%r|%s||N||F' % (
+                n, column, float(value), INPUTS[_NAMES[column]][1]))
+        lines.append('L|1|N')
+        yield ('\r'.join(lines) + '\r').encode('latin-1')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('source', nargs='?', help="file with messages")
+    parser.add_argument('target', nargs='?', help="output CSV")
+    parser.add_argument('--listen', type=int, metavar='PORT',
+                        help="read messages from TCP port instead of file")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="send FILE to --port and exit")
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--chunksize', type=int, default=1000)
+    args = parser.parse_args()
+    if args.replay:
+        replay(args.replay, args.port, args.host)
+        return
+    if args.listen:
+        chunks = listen(args.listen, args.host)
+        target = args.target or args.source
+    else:
+        chunks = read_file(args.source)
+        target = args.target
+    stream.write_csv(derive_stream(chunks, args.chunksize), target)
+
+
+if __name__ == '__main__':
+    main()
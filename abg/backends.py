@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Lazy loading of calculation backends.
+
+Short-lived workers import `abg`, `odc` or `pipeline` and often never
+touch arrays or ufloats. So heavy backends are loaded on first use only:
+
+    * 'math' - standard library, scalar floats. Default for `abg`, `odc`.
+    * 'numpy' - NumPy for `*_batch` modules, `pipeline` etc. Modules bind
+      `np = backends.lazy('numpy')`, actual import happens on first
+      attribute access.
+    * 'uncertainties' - `uncertainties.umath`, explicit ufloat mode, see
+      `abg.use_uncertainties`.
+
+Check `bench.py imports` for startup time budget.
+"""
+
+from __future__ import absolute_import
+import importlib.util
+import sys
+
+BACKENDS = {
+    'math': 'math',
+    'numpy': 'numpy',
+    'uncertainties': 'uncertainties.umath',
+}
+
+
+def load(name):
+    """Import backend now.
+
+    :param str name: Backend name, one of `BACKENDS`.
+    :return:
+        Backend module.
+    """
+    try:
+        module = BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown backend '%s', choose one of %s" % (
+            name, ', '.join(sorted(BACKENDS))))
+    return importlib.import_module(module)
+
+
+def lazy(module):
+    """Module object which is actually imported on first attribute access.
+
+    :param str module: Full module name, e.g. 'numpy'.
+    """
+    if module in sys.modules:
+        return sys.modules[module]
+    spec = importlib.util.find_spec(module)
+    if spec is None:
+        raise ImportError("No module named '%s'" % module)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    lazy_module = importlib.util.module_from_spec(spec)
+    sys.modules[module] = lazy_module
+    loader.exec_module(lazy_module)
+    return lazy_module
+
+
+def is_loaded(name):
+    """Whether backend is actually imported (not just lazily bound).
+
+    :param str name: Backend name, one of `BACKENDS`.
+    :rtype: bool
+    """
+    module = sys.modules.get(BACKENDS[name])
+    if module is None:
+        return False
+    # Lazy module changes its class back to ModuleType after loading
+    return type(module).__name__ != '_LazyModule'
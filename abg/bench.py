@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks. Results are printed as JSON to track regressions between
+releases.
+
+    $ python bench.py imports --check
+    $ python bench.py micro --size 1000 > micro.json
+    $ python bench.py jit --check
+
+`imports` measures cold-start import time of each module in a fresh
+interpreter and compares it against `IMPORT_BUDGET`. Heavy backends
+(NumPy, uncertainties) are loaded lazily (see `backends`), so the
+benchmark also reports what the same import would cost with backends
+loaded eagerly.
+
+`micro` times every `abg` formula, acid-base classification and
+`odc.ODC` hot path (fit in all three branches, `eval_pressure`,
+`eval_p50`, `eval_p50st`, `eval_pO2T`) on seeded random samples within
+physiological ranges. Each benchmark is run in 'scalar' mode
+(`abg`/`odc` called once per sample) and 'batch' mode (one
+`abg_batch`/`odc_batch` call for all samples), time is reported per
+sample.
+
+`jit` compares `jit` kernels (Numba if installed, plain Python
+otherwise) against `odc`, `odc_batch` and `abg` on the same samples and
+reports time per sample and max absolute difference of results.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import argparse
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+# Module -> cold import time budget, ms
+IMPORT_BUDGET = {
+    'abg': 20,
+    'odc': 30,
+    'cache': 40,
+    'pipeline': 50,
+}
+# Backends must stay unloaded after import of any budgeted module
+LAZY_BACKENDS = ('numpy', 'uncertainties')
+
+_IMPORT_CODE = """\
+import sys, time
+t = time.perf_counter()
+import {module}
+{eager}
+t = time.perf_counter() - t
+import backends
+print(t, ' '.join(b for b in {backends!r} if backends.is_loaded(b)))
+"""
+
+
+def _import_time(module, eager=False):
+    """Import time in fresh interpreter, s, and list of loaded backends."""
+    code = _IMPORT_CODE.format(
+        module=module, backends=LAZY_BACKENDS,
+        eager='import numpy, uncertainties.umath' if eager else '')
+    out = subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    seconds, _, loaded = out.decode().strip().partition(' ')
+    return float(seconds), loaded.split()
+
+
+def bench_imports(repeat=7):
+    """Cold-start import time for every module in `IMPORT_BUDGET`.
+
+    Minimum of `repeat` runs is reported: it is least affected by
+    other processes.
+
+    :return:
+        List of result dicts.
+    """
+    results = []
+    for module, budget in sorted(IMPORT_BUDGET.items()):
+        runs = [_import_time(module) for _ in range(repeat)]
+        lazy_ms = min(t for t, _ in runs) * 1000
+        eager_ms = min(
+            _import_time(module, eager=True)[0]
+            for _ in range(repeat)) * 1000
+        loaded = sorted(set(b for _, bs in runs for b in bs))
+        results.append({
+            'benchmark': 'import',
+            'name': module,
+            'time_ms': round(lazy_ms, 3),
+            'eager_time_ms': round(eager_ms, 3),
+            'budget_ms': budget,
+            'loaded_backends': loaded,
+            'ok': lazy_ms <= budget and not loaded,
+        })
+    return results
+
+
+# abg formula -> names of `_micro_samples` arrays passed as arguments
+FORMULA_ARGS = {
+    'calculate_anion_gap': ('Na', 'Cl', 'HCO3act', 'K'),
+    'calculate_mosm': ('Na', 'glucosae'),
+    'calculate_hco3': ('pH', 'pCO2'),
+    'calculate_hco3p': ('pH', 'pCO2'),
+    'calculate_hco3pst': ('pH', 'pCO2', 'ctHb', 'sO2'),
+    'calculate_be': ('pH', 'pCO2', 'HCO3act'),
+    'calculate_cbase': ('pH', 'pCO2', 'ctHb'),
+    'calculate_hct': ('ctHb',),
+    'calculate_pHT': ('pH', 'T'),
+    'calculate_pCO2T': ('pCO2', 'T'),
+    'calculate_ctO2': ('pO2', 'sO2', 'FCOHb', 'FMetHb', 'ctHb'),
+    'calculate_pO2_FO2_fraction': ('pO2', 'FO2'),
+    'calculate_Ca74': ('pH_Ca', 'Ca'),  # scalar raises outside pH 7.2-7.4
+    'expected_pH': ('pCO2_mmHg',),
+}
+
+
+def _micro_samples(size, seed=0):
+    """Seeded random samples within physiological ranges, `abg` units.
+
+    pO2 is consistent with sO2: it lies on reference ODC shifted by
+    displacement calculated from pH and pCO2 plus some noise, so
+    `odc.ODC.fit` behaves as on real arterial and venous samples.
+    'sO2_high', 'pO2_high' are oxygenated samples for fit branch III,
+    'p50st' is keyed p50(st) for branch II.
+
+    :return:
+        Dict of float ndarrays.
+    """
+    import numpy as np
+    import abg_batch
+    import odc_batch
+    from units import kPa
+    rng = np.random.RandomState(seed)
+    s = {}
+    s['pH'] = np.clip(rng.normal(7.38, 0.08, size), 6.9, 7.7)
+    s['pH_Ca'] = rng.uniform(7.2, 7.4, size)
+    s['pCO2'] = np.clip(rng.lognormal(np.log(5.3), 0.25, size), 2, 15)
+    s['pCO2_mmHg'] = s['pCO2'] / kPa
+    s['sO2'] = rng.uniform(0.6, 0.97, size)
+    s['FCOHb'] = rng.uniform(0.002, 0.03, size)
+    s['FMetHb'] = rng.uniform(0.002, 0.015, size)
+    s['ctHb'] = np.clip(rng.normal(8.5, 1.5, size), 4, 13)  # mmol/L
+    s['T'] = np.clip(rng.normal(37, 1, size), 33, 41)
+    ac = -0.88 * (s['pH'] - 7.40) + 0.048 * np.log(s['pCO2'] / 5.33)
+    model = odc_batch.ODCBatch()
+    s['A'] = ac + rng.normal(0, 0.03, size)
+    s['pO2'] = model.eval_pressure(sO2=s['sO2'], A=s['A'], T=37)
+    s['sO2_high'] = rng.uniform(0.975, 0.995, size)
+    s['pO2_high'] = rng.uniform(15, 60, size)
+    s['p50st'] = rng.normal(3.578, 0.2, size)
+    s['FO2'] = rng.uniform(0.21, 1, size)
+    s['Na'] = rng.normal(140, 4, size)
+    s['Cl'] = rng.normal(104, 4, size)
+    s['K'] = rng.normal(4.2, 0.5, size)
+    s['Ca'] = rng.normal(1.2, 0.08, size)
+    s['glucosae'] = np.clip(rng.normal(6, 2, size), 2, 30)
+    s['HCO3act'] = abg_batch.calculate_hco3p(s['pH'], s['pCO2'])
+    return s
+
+
+def _rows(samples, names):
+    """Per-sample argument tuples of Python floats for scalar calls."""
+    return list(zip(*[samples[name].tolist() for name in names]))
+
+
+# ODC.fit branch -> fit keyword arguments, names of `_micro_samples` arrays
+FIT_BRANCHES = {
+    'I': {'sO2': 'sO2', 'pO2': 'pO2'},
+    'II': {'sO2': 'sO2', 'pO2': 'pO2', 'p50st': 'p50st'},
+    'III': {'sO2': 'sO2_high', 'pO2': 'pO2_high'},
+}
+_FIT_COMMON = ('pCO2', 'pH', 'FCOHb', 'FMetHb')
+
+
+def _micro_cases(samples):
+    """Benchmark cases: (name, scalar callable, batch callable).
+
+    Every callable processes all samples once. Batch callable is None if
+    there is no vectorized implementation.
+    """
+    import abg
+    import abg_batch
+    import odc
+    import odc_batch
+    cases = []
+    for name, args in sorted(FORMULA_ARGS.items()):
+        rows = _rows(samples, args)
+        columns = [samples[arg] for arg in args]
+        cases.append((
+            'abg.%s' % name,
+            lambda f=getattr(abg, name), rows=rows: [f(*r) for r in rows],
+            lambda f=getattr(abg_batch, name), c=columns: f(*c)))
+
+    rows = _rows(samples, ('pH', 'pCO2_mmHg'))
+    cases.append((
+        'abg.abg',
+        lambda rows=rows: [abg.abg(*r) for r in rows],
+        lambda s=samples: abg_batch.classify(s['pH'], s['pCO2_mmHg'])))
+
+    fitted = {}
+    for branch, mapping in sorted(FIT_BRANCHES.items()):
+        kwargs = dict((k, samples[v]) for k, v in mapping.items())
+        kwargs.update((k, samples[k]) for k in _FIT_COMMON)
+        names = sorted(kwargs)
+        rows = [dict(zip(names, r)) for r in _rows(
+            dict((k, kwargs[k]) for k in names), names)]
+        models = [odc.ODC() for _ in rows]
+
+        def fit_scalar(models=models, rows=rows):
+            for model, row in zip(models, rows):
+                model.fit(**row)
+
+        batch = odc_batch.ODCBatch()
+        cases.append((
+            'odc.ODC.fit[%s]' % branch, fit_scalar,
+            lambda b=batch, kw=kwargs: b.fit(**kw)))
+        fit_scalar()
+        batch.fit(**kwargs)
+        fitted[branch] = (models, batch)
+
+    models, batch = fitted['I']
+    rows = _rows(samples, ('sO2', 'A', 'T'))
+    cases.append((
+        'odc.ODC.eval_pressure',
+        lambda m=models[0], rows=rows: [m.eval_pressure(*r) for r in rows],
+        lambda b=batch, s=samples: b.eval_pressure(s['sO2'], s['A'], s['T'])))
+    for method in ('eval_p50', 'eval_p50st'):
+        cases.append((
+            'odc.ODC.%s' % method,
+            lambda ms=models, f=getattr(odc.ODC, method): [f(m) for m in ms],
+            getattr(batch, method)))
+    rows = _rows(samples, ('ctHb', 'T'))
+    cases.append((
+        'odc.ODC.eval_pO2T',
+        lambda ms=models, rows=rows: [
+            m.eval_pO2T(*r) for m, r in zip(ms, rows)],
+        lambda b=batch, s=samples: b.eval_pO2T(s['ctHb'], s['T'])))
+    return cases
+
+
+def _best_time(func, repeat):
+    """Minimal wall time of single `func` call out of `repeat`, s."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def bench_micro(size=1000, repeat=7, seed=0):
+    """Time `abg` and `odc` hot paths in scalar and batch modes.
+
+    :param int size: Number of samples processed by every call.
+    :param int repeat: Number of runs, minimum is reported.
+    :param int seed: Random samples seed, see `_micro_samples`.
+    :return:
+        List of result dicts, `time_per_sample_ns` is None for modes
+        without implementation.
+    """
+    samples = _micro_samples(size, seed)
+    results = []
+    for name, scalar, batch in _micro_cases(samples):
+        for mode, func in (('scalar', scalar), ('batch', batch)):
+            seconds = _best_time(func, repeat) if func is not None else None
+            results.append({
+                'benchmark': 'micro',
+                'name': name,
+                'mode': mode,
+                'size': size,
+                'seed': seed,
+                'time_per_sample_ns': None if seconds is None else round(
+                    seconds / size * 1e9, 1),
+            })
+    return results
+
+
+def _jit_cases(samples):
+    """JIT benchmark cases: (name, {mode: callable returning results}).
+
+    Modes are 'scalar' (`odc.ODC`), 'jit-scalar' (`jit.JitODC`), 'batch'
+    (`odc_batch.ODCBatch`) and 'jit-batch' (`jit.JitODCBatch`).
+    """
+    import numpy as np
+    import abg
+    import jit
+    import odc
+    import odc_batch
+    classes = {
+        'scalar': odc.ODC, 'jit-scalar': jit.JitODC,
+        'batch': odc_batch.ODCBatch, 'jit-batch': jit.JitODCBatch}
+    cases = []
+    for branch, mapping in sorted(FIT_BRANCHES.items()):
+        kwargs = dict((k, samples[v]) for k, v in mapping.items())
+        kwargs.update((k, samples[k]) for k in _FIT_COMMON)
+        names = sorted(kwargs)
+        rows = [dict(zip(names, r)) for r in _rows(
+            dict((k, kwargs[k]) for k in names), names)]
+
+        def fit_scalar(cls, rows=rows):
+            models = [cls() for _ in rows]
+            for model, row in zip(models, rows):
+                model.fit(**row)
+            return np.array([m.a for m in models])
+
+        def fit_batch(cls, kwargs=kwargs):
+            model = cls()
+            model.fit(**kwargs)
+            return model.a
+
+        cases.append(('odc.ODC.fit[%s]' % branch, dict(
+            (mode, lambda f=fit_scalar if 'scalar' in mode else fit_batch,
+             cls=cls: f(cls)) for mode, cls in classes.items())))
+
+    rows = _rows(samples, ('sO2', 'A', 'T'))
+    modes = {}
+    for mode, cls in classes.items():
+        model = cls()
+        if 'scalar' in mode:
+            model.fit(sO2=0.9, pO2=7.5, pCO2=5.33, pH=7.4)  # Sets y_0
+            modes[mode] = lambda m=model, rows=rows: np.array(
+                [m.eval_pressure(*r) for r in rows])
+        else:
+            modes[mode] = lambda m=model, s=samples: m.eval_pressure(
+                s['sO2'], s['A'], s['T'])
+    cases.append(('odc.ODC.eval_pressure', modes))
+
+    rows = _rows(samples, ('pH', 'pCO2', 'ctHb'))
+    cases.append(('abg.calculate_cbase', {
+        'scalar': lambda rows=rows: np.array(
+            [abg.calculate_cbase(*r) for r in rows]),
+        'jit-scalar': lambda rows=rows: np.array(
+            [jit.calculate_cbase(*r) for r in rows]),
+    }))
+    return cases
+
+
+def bench_jit(size=1000, repeat=7, seed=0, tolerance=1e-9):
+    """Time and check `jit` kernels against `odc`, `odc_batch` and `abg`.
+
+    Every mode result is compared with 'scalar' mode, 'ok' is False if
+    they differ more than `tolerance`. Compilation is done before timing.
+
+    :return:
+        List of result dicts.
+    """
+    import numpy as np
+    import jit
+    samples = _micro_samples(size, seed)
+    results = []
+    for name, modes in _jit_cases(samples):
+        reference = modes['scalar']()
+        for mode, func in sorted(modes.items()):
+            difference = float(np.max(np.abs(func() - reference)))
+            seconds = _best_time(func, repeat)
+            results.append({
+                'benchmark': 'jit',
+                'name': name,
+                'mode': mode,
+                'numba': jit.available,
+                'size': size,
+                'seed': seed,
+                'time_per_sample_ns': round(seconds / size * 1e9, 1),
+                'max_abs_difference': difference,
+                'ok': difference <= tolerance,
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('suite', choices=('imports', 'micro', 'jit'))
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument(
+        '--size', type=int, default=1000, help="samples per micro benchmark")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--check', action='store_true',
+        help="exit with non-zero status if any budget exceeded or "
+             "JIT result differs")
+    args = parser.parse_args()
+    if args.suite == 'imports':
+        results = bench_imports(repeat=args.repeat)
+    elif args.suite == 'jit':
+        results = bench_jit(
+            size=args.size, repeat=args.repeat, seed=args.seed)
+    else:
+        results = bench_micro(
+            size=args.size, repeat=args.repeat, seed=args.seed)
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    if args.check and not all(r.get('ok', True) for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In-memory cache of fitted ODC models.
+
+Same sample may be requested many times (e.g. p50 and p50(st) on a
+dashboard refresh). `ODCCache` keeps fitted `odc.ODC` models keyed by
+rounded measured inputs, so repeated requests skip Newton-Raphson fitting.
+Results of `eval_p50()`, `eval_p50st()` and `eval_pO2T()` are memoized
+on the cached model too. Arbitrary-argument `eval_pressure()` and
+`eval_saturation()` are not, so per-model memory stays bounded.
+
+    >>> cache = ODCCache(maxsize=4096)
+    >>> cache.fit(sO2=0.453, pO2=4.49, pCO2=9.15, pH=6.919).eval_p50()
+    >>> cache.info()
+    CacheInfo(hits=0, misses=1, ...)
+
+Models returned from cache are shared between callers and must be treated
+as read-only: don't `fit()` them again.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from collections import namedtuple, OrderedDict
+import threading
+
+import odc
+
+POLICIES = ('lru', 'fifo')
+
+CacheInfo = namedtuple(
+    'CacheInfo',
+    'hits misses evictions eval_hits eval_misses maxsize currsize')
+
+
+def _round(values, digits):
+    """Round floats for use as a cache key, keep other values as is."""
+    return tuple(
+        round(v, digits) if isinstance(v, float) else v for v in values)
+
+
+class CachedODC(odc.ODC):
+
+    """Fitted ODC with memoized `eval_*` results.
+
+    Created by `ODCCache`, don't instantiate directly.
+    """
+
+    def __init__(self, cache, **kwargs):
+        super(CachedODC, self).__init__(**kwargs)
+        self._cache = cache
+        self._memo = {}
+
+    def _memoized(self, name, func, *args):
+        key = (name,) + _round(args, self._cache.digits)
+        try:
+            value = self._memo[key]
+        except KeyError:
+            self._cache.eval_misses += 1
+            value = self._memo[key] = func(*args)
+        else:
+            self._cache.eval_hits += 1
+        return value
+
+    def eval_p50(self):
+        return self._memoized('eval_p50', super(CachedODC, self).eval_p50)
+
+    def eval_p50st(self):
+        return self._memoized(
+            'eval_p50st', super(CachedODC, self).eval_p50st)
+
+    def eval_pO2T(self, ctHb, T):
+        return self._memoized(
+            'eval_pO2T', super(CachedODC, self).eval_pO2T, ctHb, T)
+
+
+class ODCCache(object):
+
+    """Bounded cache of fitted ODC models keyed by rounded inputs.
+
+    :param int maxsize: Maximum number of cached models, None for unbounded.
+    :param str policy: Eviction policy: 'lru' evicts least recently used
+        model, 'fifo' evicts oldest one.
+    :param int digits: Inputs are rounded to given number of decimal
+        digits to make a key. Samples with same rounded inputs share one
+        model, fitted with inputs of first of them.
+    :param kwargs: Passed to `odc.ODC` constructor (table, method, tol,
+        maxiter).
+    """
+
+    def __init__(self, maxsize=1024, policy='lru', digits=6, **kwargs):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy '%s', choose one of %s" % (
+                policy, ', '.join(POLICIES)))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.digits = digits
+        self.odc_kwargs = kwargs
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.eval_hits = 0
+        self.eval_misses = 0
+
+    def fit(self, sO2, pO2, pCO2, pH,
+            T=37, FCOHb=0.004, FMetHb=0.004, p50st=None):
+        """Fitted model for given measured parameters, see `odc.ODC.fit`.
+
+        :rtype: CachedODC
+        """
+        key = _round((sO2, pO2, pCO2, pH, T, FCOHb, FMetHb, p50st),
+                     self.digits)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self.hits += 1
+                if self.policy == 'lru':
+                    self._models.move_to_end(key)
+                return model
+            self.misses += 1
+        model = CachedODC(self, **self.odc_kwargs)
+        model.fit(sO2=sO2, pO2=pO2, pCO2=pCO2, pH=pH,
+                  T=T, FCOHb=FCOHb, FMetHb=FMetHb, p50st=p50st)
+        with self._lock:
+            self._models[key] = model
+            while (self.maxsize is not None and
+                   len(self._models) > self.maxsize):
+                self._models.popitem(last=False)
+                self.evictions += 1
+        return model
+
+    def fit_standard(self, p50st=3.578, **kwargs):
+        """Cached `odc.ODC.fit_standard`.
+
+        :rtype: CachedODC
+        """
+        return self.fit(p50st=p50st, **kwargs)
+
+    def info(self):
+        """Cache statistics.
+
+        :rtype: CacheInfo
+        """
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         self.eval_hits, self.eval_misses,
+                         self.maxsize, len(self._models))
+
+    def clear(self):
+        """Drop all models and reset statistics."""
+        with self._lock:
+            self._models.clear()
+            self.hits = self.misses = self.evictions = 0
+            self.eval_hits = self.eval_misses = 0
+
+    def __len__(self):
+        return len(self._models)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory-mapped columnar store of historical samples.
+
+Reparsing years of CSV exports for every retrospective analysis is slow.
+`ColumnStore` keeps every `samples.csv` column in its own fixed-dtype
+file (`sample.dtype` field types and units), so a reader maps only the
+columns it needs, without parsing and without copying:
+
+    >>> store = ColumnStore('gases')
+    >>> store.import_csv('export-2015.csv')  # Append rows
+    >>> store.update_derived()  # Derive appended rows only
+    >>> table = store.table(['pH', 'pCO2', 'derived/SBE'])
+    >>> table['pH']  # Read-only numpy.memmap
+    >>> pipeline.derive(store.table(), columns=['p50'])
+    >>> abg_batch.calculate_cbase(table['pH'], table['pCO2'] * units.kPa)
+
+Columns derived by `pipeline.derive` are stored under 'derived/' prefix
+(`DERIVED`), next to analyzer-reported columns of the same name. Derived
+columns may lag behind appended rows; `update_derived` calculates them
+for the missing tail only, and a new derived column is filled from the
+first row.
+
+Column files are version 1.0 `.npy` files (`numpy.load(path,
+mmap_mode='r')` opens them too) with fixed-size header, so rows are
+appended to the end of file and shape in header is updated in place.
+Number of rows of every column is recorded in 'columns.json', which is
+replaced atomically after data is written: readers see complete rows
+only, call `reload` to see rows appended after opening. There must be
+one writer at a time.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import argparse
+import io
+import json
+import os
+import struct
+import sys
+
+import backends
+import pipeline
+import sample
+import stream
+
+np = backends.lazy('numpy')
+
+DERIVED = 'derived/'  # Name prefix of derived columns
+
+# Units of derived columns absent in `samples.csv`
+DERIVED_UNITS = {'HCO3act': 'mmol/L'}
+
+HEADER_SIZE = 128  # Bytes of `.npy` header, including magic string
+META = 'columns.json'
+
+
+def _header(dtype, rows):
+    """`.npy` version 1.0 header of 1-D array padded to `HEADER_SIZE`."""
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (
+        dtype.str, rows)
+    prefix = b'\x93NUMPY\x01\x00' + struct.pack('<H', HEADER_SIZE - 10)
+    return prefix + header.ljust(HEADER_SIZE - 11).encode('latin-1') + b'\n'
+
+
+def _schema():
+    """Column name to (dtype, unit) of stored `samples.csv` columns."""
+    fields = sample.dtype().fields
+    schema = dict((name, (np.dtype(fields[name][0].str), sample.unit(name)))
+                  for name, _ in sample.COLUMNS)
+    schema['id'] = (np.dtype(fields['id'][0].str), '')
+    schema['sample_date'] = (np.dtype(fields['sample_date'][0].str), '')
+    for name, _, _ in pipeline.GRAPH:
+        if not name.startswith('_'):
+            unit = sample.UNITS[name] if name in sample.UNITS else (
+                DERIVED_UNITS[name])
+            schema[DERIVED + name] = (np.dtype(np.float32), unit)
+    return schema
+
+
+class ColumnStore(object):
+
+    """Directory of memory-mapped column files, see module description.
+
+    Store directory is created on first append.
+
+    :param str path: Store directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._schema = _schema()
+        self.reload()
+
+    def reload(self):
+        """Read row counts, to see rows appended by other writer."""
+        meta = os.path.join(self.path, META)
+        if os.path.exists(meta):
+            with io.open(meta, encoding='utf-8') as f:
+                self._meta = json.load(f)
+        else:
+            self._meta = {'rows': 0, 'columns': {}}
+
+    @property
+    def columns(self):
+        """Names of stored columns.
+
+        :rtype: tuple
+        """
+        return tuple(sorted(self._meta['columns']))
+
+    def __len__(self):
+        """Number of samples."""
+        return self._meta['rows']
+
+    def __contains__(self, name):
+        return name in self._meta['columns']
+
+    def unit(self, name):
+        """Unit of column, e.g. 'mmHg' for 'derived/p50'.
+
+        :rtype: str
+        """
+        try:
+            return self._schema[name][1]
+        except KeyError:
+            raise ValueError("Unknown column '%s'" % name)
+
+    def rows(self, name):
+        """Number of rows of column, may be less than `len` for derived
+        columns.
+
+        :rtype: int
+        """
+        return self._meta['columns'].get(name, {'rows': 0})['rows']
+
+    def column(self, name, start=0, stop=None):
+        """Rows of column, mapped read-only.
+
+        :param str name: Column name, `samples.csv` or 'derived/' one.
+        :param int start: First row.
+        :param int stop: Row after last one, all available rows by
+            default.
+        :rtype: numpy.memmap
+        """
+        if name not in self._meta['columns']:
+            raise KeyError("No column '%s' in %s" % (name, self.path))
+        dtype = self._schema[name][0]
+        rows = self.rows(name)
+        start, stop, _ = slice(start, stop).indices(rows)
+        if stop <= start:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(
+            self._file(name), dtype=dtype, mode='r',
+            offset=HEADER_SIZE + start * dtype.itemsize,
+            shape=(stop - start,))
+
+    def table(self, columns=None, start=0, stop=None):
+        """Mapped columns as `samples.csv`-like table, e.g. for
+        `pipeline.derive` (values are in `samples.csv` units).
+
+        :param columns: Column names, all stored `samples.csv` columns by
+            default (not derived ones).
+        :return:
+            Column name to `numpy.memmap` mapping.
+        :rtype: dict
+        """
+        if columns is None:
+            columns = [name for name in self.columns
+                       if not name.startswith(DERIVED)]
+        return dict((name, self.column(name, start, stop))
+                    for name in columns)
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def _write(self, name, values):
+        """Append values to column file and update header, row counts are
+        not updated."""
+        path = self._file(name)
+        dtype = self._schema[name][0]
+        values = np.ascontiguousarray(values, dtype=dtype)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with io.open(path, 'wb') as f:
+                f.write(_header(dtype, 0))
+        rows = self.rows(name)
+        with io.open(path, 'r+b') as f:
+            # Drop tail of interrupted write, if any
+            f.truncate(HEADER_SIZE + rows * dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(values.tobytes())
+            f.seek(0)
+            f.write(_header(dtype, rows + len(values)))
+        return rows + len(values)
+
+    def _commit(self, meta):
+        """Replace row counts atomically."""
+        path = os.path.join(self.path, META)
+        with io.open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+        self._meta = meta
+
+    def append(self, table):
+        """Append samples.
+
+        :param table: `samples.csv`-like table: sample records, DataFrame,
+            dict of arrays (e.g. `stream.read_chunks` chunk). Absent
+            columns are stored as missing values.
+        :return:
+            Number of appended rows.
+        :rtype: int
+        """
+        dtype = getattr(table, 'dtype', None)
+        if dtype is None or dtype != sample.dtype():
+            table = sample.from_table(table)
+        if not len(table):
+            return 0
+        meta = {'rows': len(self) + len(table),
+                'columns': dict(self._meta['columns'])}
+        names = ('id', 'sample_date') + tuple(
+            name for name, _ in sample.COLUMNS)
+        for name in names:
+            if self.rows(name) != len(self):
+                raise ValueError("Column '%s' has %d rows of %d" % (
+                    name, self.rows(name), len(self)))
+        for name in names:
+            meta['columns'][name] = {'rows': self._write(name, table[name])}
+        self._commit(meta)
+        return len(table)
+
+    def import_csv(self, source, chunksize=100000):
+        """Append `samples.csv`-layout file by chunks.
+
+        :param source: Path or text file object.
+        :return:
+            Number of appended rows.
+        :rtype: int
+        """
+        if isinstance(source, str):
+            with io.open(source, newline='', encoding='utf-8') as f:
+                return self.import_csv(f, chunksize)
+        numeric = ('id',) + tuple(name for name, _ in sample.COLUMNS)
+        return sum(self.append(chunk) for chunk in stream.read_chunks(
+            source, chunksize, passthrough=('sample_date',),
+            columns=numeric))
+
+    def update_derived(self, columns=None, chunksize=100000):
+        """Derive rows missing in derived columns.
+
+        :param columns: `pipeline` column names (without prefix), all by
+            default.
+        :param int chunksize: Rows mapped and derived at once.
+        :return:
+            Number of derived rows.
+        :rtype: int
+        """
+        if columns is None:
+            columns = [name for name, _, _ in pipeline.GRAPH
+                       if not name.startswith('_')]
+        columns = list(columns)
+        first = min([self.rows(DERIVED + name) for name in columns] or
+                    [len(self)])
+        inputs = [name for name in self.columns
+                  if not name.startswith(DERIVED)]
+        for start in range(first, len(self), chunksize):
+            stop = min(start + chunksize, len(self))
+            derived = pipeline.derive(
+                self.table(inputs, start, stop), columns=columns)
+            meta = {'rows': len(self),
+                    'columns': dict(self._meta['columns'])}
+            for name in columns:
+                key = DERIVED + name
+                have = self.rows(key)
+                if have >= stop:
+                    continue
+                values = derived.get(name)
+                if values is None:  # Inputs absent
+                    values = np.full(stop - start, np.nan)
+                meta['columns'][key] = {
+                    'rows': self._write(key, values[have - start:])}
+            self._commit(meta)
+        return len(self) - first
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('store', help="store directory")
+    parser.add_argument('csv', nargs='*',
+                        help="samples.csv-layout files to append")
+    parser.add_argument('--derive', action='store_true',
+                        help="derive appended rows")
+    parser.add_argument('--chunksize', type=int, default=100000)
+    args = parser.parse_args()
+    store = ColumnStore(args.store)
+    for path in args.csv:
+        store.import_csv(path, args.chunksize)
+    if args.derive:
+        store.update_derived(chunksize=args.chunksize)
+    for name in store.columns:
+        sys.stdout.write('%s\t%s\t%d\n' % (
+            name, store.unit(name), store.rows(name)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in instrumentation of `abg` and `odc` hot paths.
+
+Shows where time goes when throughput drops and whether Newton loops
+take more iterations on unusual inputs:
+
+    >>> with instrument.profile() as prof:
+    ...     pipeline.derive(table)
+    ...     odc.ODC().fit(sO2=0.453, pO2=4.49, pCO2=9.15, pH=6.919)
+    >>> print(prof.report())
+    function                                    calls     total, s   mean, us
+    pipeline._odc                                   1     0.010478   10478.35
+    odc_batch.ODCBatch.fit                          1     0.010432   10432.10
+    ...
+    >>> prof.iterations['I']  # Newton iterations -> number of fits
+    Counter({4: 1021, 5: 310, 3: 12})
+    >>> prof.not_converged
+    Counter({'III': 0, ...})
+
+Collected while enabled:
+
+    * `functions` - calls and cumulative time (nested calls included) of
+      `abg.calculate_*` and `abg_batch.calculate_*` functions, `TIMED`
+      methods of `odc.ODC` and `odc_batch.ODCBatch`, by
+      'module.Class.name', and of `pipeline.GRAPH` nodes. Nodes which are
+      `abg_batch` functions are counted under their names, others as
+      'pipeline.node'.
+    * `iterations` - histogram of shift solver iterations per `odc.ODC.fit`
+      branch ('I', 'II', 'III'), scalar and batch fits alike. Branch III
+      doesn't solve, its fits are counted with 0 iterations.
+    * `not_converged` - fits per branch where solver failed.
+    * `solves` - all solves (fit, `eval_pressure`, `eval_pO2T`...) and
+      not converged ones, by instrumented function which ran them.
+
+Disabled instrumentation costs nothing: functions are wrapped when
+profile is enabled and original ones are restored on disable. Graph holds
+its own references to `abg_batch` functions, so `pipeline.GRAPH` is
+replaced by graph of wrapped nodes. Otherwise only calls through module
+and class attributes are seen, e.g. `jit` kernels and functions imported
+with `from abg import ...` before enabling are not.
+One profile can be enabled at a time, see `enable` for long-running
+processes. Counters aren't locked, numbers are approximate if
+instrumented code runs in several threads at once.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import argparse
+from collections import Counter, namedtuple
+import functools
+import threading
+import time
+
+import abg
+import abg_batch
+import backends
+import odc
+import odc_batch
+import pipeline
+import solver
+
+np = backends.lazy('numpy')
+
+# Timed methods of `odc.ODC` and `odc_batch.ODCBatch`
+TIMED = ('fit', 'eval_pressure', 'eval_saturation', 'eval_p50',
+         'eval_p50st', 'eval_pO2T')
+
+BRANCHES = ('I', 'II', 'III')
+
+FunctionStats = namedtuple('FunctionStats', 'calls time')
+FunctionStats.__doc__ = """Calls of instrumented function, time in seconds."""
+
+SolveStats = namedtuple('SolveStats', 'solves not_converged')
+
+_active = None
+_local = threading.local()  # `stack` of running instrumented functions
+
+
+def _caller():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+class Profile(object):
+
+    """Collected statistics, see module description."""
+
+    def __init__(self):
+        self._functions = {}  # name -> [calls, seconds]
+        self._solves = {}  # name -> [solves, not converged]
+        self.iterations = dict((branch, Counter()) for branch in BRANCHES)
+        self.not_converged = Counter(dict.fromkeys(BRANCHES, 0))
+        self._patched = []  # (owner, name, original)
+
+    @property
+    def functions(self):
+        """Function name to `FunctionStats`, called ones only.
+
+        :rtype: dict
+        """
+        return dict((name, FunctionStats(*stats))
+                    for name, stats in self._functions.items() if stats[0])
+
+    @property
+    def solves(self):
+        """Function name to `SolveStats`.
+
+        :rtype: dict
+        """
+        return dict((name, SolveStats(*stats))
+                    for name, stats in self._solves.items())
+
+    def report(self):
+        """Statistics as text table.
+
+        :rtype: str
+        """
+        lines = ['%-40s %8s %12s %10s' % (
+            'function', 'calls', 'total, s', 'mean, us')]
+        for name, stats in sorted(self.functions.items(),
+                                  key=lambda item: -item[1].time):
+            lines.append('%-40s %8d %12.6f %10.2f' % (
+                name, stats.calls, stats.time, stats.time / stats.calls * 1e6))
+        lines.append('')
+        lines.append('%-6s %8s %14s  %s' % (
+            'branch', 'fits', 'not converged', 'iterations: fits'))
+        for branch in BRANCHES:
+            histogram = self.iterations[branch]
+            lines.append('%-6s %8d %14d  %s' % (
+                branch, sum(histogram.values()), self.not_converged[branch],
+                ' '.join('%d:%d' % item for item in sorted(
+                    histogram.items()))))
+        lines.append('')
+        lines.append('%-40s %8s %14s' % ('solves by', 'solves',
+                                         'not converged'))
+        for name, stats in sorted(self.solves.items()):
+            lines.append('%-40s %8d %14d' % (
+                name, stats.solves, stats.not_converged))
+        return '\n'.join(lines)
+
+    def _fitted(self, branch, iterations, converged):
+        self.iterations[BRANCHES[branch - 1]][iterations] += 1
+        if not converged:
+            self.not_converged[BRANCHES[branch - 1]] += 1
+
+    def _solved(self, solves, failed):
+        stats = self._solves.setdefault(_caller() or '-', [0, 0])
+        stats[0] += solves
+        stats[1] += failed
+
+    def _patch(self, owner, name, wrapper):
+        original = owner.__dict__[name]
+        self._patched.append((owner, name, original))
+        setattr(owner, name, functools.wraps(original)(wrapper(original)))
+
+    def _timer(self, label):
+        """Decorator counting calls and time of function under `label`."""
+        stats = self._functions.setdefault(label, [0, 0.])
+
+        def wrap(func):
+            def wrapper(*args, **kwargs):
+                stack = getattr(_local, 'stack', None)
+                if stack is None:
+                    stack = _local.stack = []
+                stack.append(label)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    stats[1] += time.perf_counter() - start
+                    stats[0] += 1
+                    stack.pop()
+            return wrapper
+        return wrap
+
+    def _timed(self, owner, name, label):
+        self._patch(owner, name, self._timer(label))
+
+    def _install_graph(self):
+        """Replace `pipeline.GRAPH` by graph of timed nodes."""
+        labels = dict((func, 'abg_batch.' + name)
+                      for name, func in vars(abg_batch).items()
+                      if name.startswith('calculate_'))
+        graph = tuple(
+            (name, deps, functools.wraps(func)(self._timer(
+                labels.get(func, 'pipeline.' + name))(func)))
+            for name, deps, func in pipeline.GRAPH)
+        self._patched.append((pipeline, 'GRAPH', pipeline.GRAPH))
+        pipeline.GRAPH = graph
+
+    def _install(self):
+        self._patch(odc.ODC, 'fit', self._wrap_fit)
+        self._patch(odc_batch.ODCBatch, 'fit', self._wrap_batch_fit)
+        self._patch(odc.ODC, '_solve', self._wrap_solve)
+        self._patch(odc_batch.ODCBatch, '_solve', self._wrap_batch_solve)
+        self._install_graph()  # Before `abg_batch` functions are wrapped
+        for module in (abg, abg_batch):
+            for name in sorted(vars(module)):
+                if name.startswith('calculate_'):
+                    self._timed(module, name,
+                                '%s.%s' % (module.__name__, name))
+        for name in TIMED:
+            self._timed(odc.ODC, name, 'odc.ODC.' + name)
+            self._timed(odc_batch.ODCBatch, name,
+                        'odc_batch.ODCBatch.' + name)
+
+    def _uninstall(self):
+        while self._patched:
+            owner, name, original = self._patched.pop()
+            setattr(owner, name, original)
+
+    def _wrap_fit(self, fit):
+        def wrapper(model, *args, **kwargs):
+            try:
+                fit(model, *args, **kwargs)
+            except solver.ConvergenceError as e:
+                self._fitted(_branch(model), e.result.iterations, False)
+                raise
+            result = model.fit_result
+            self._fitted(_branch(model),
+                         result.iterations if result else 0, True)
+        return wrapper
+
+    def _wrap_batch_fit(self, fit):
+        def wrapper(model, *args, **kwargs):
+            fit(model, *args, **kwargs)
+            branch = model.branch.ravel()
+            iterations = model.iterations.ravel()
+            # Samples with NaN inputs aren't solved
+            failed = ~model.converged.ravel() & (iterations > 0)
+            for number in (1, 2, 3):
+                mask = branch == number
+                if number != 3:
+                    mask &= iterations > 0
+                counts = np.bincount(iterations[mask])
+                histogram = self.iterations[BRANCHES[number - 1]]
+                for n in np.flatnonzero(counts).tolist():
+                    histogram[n] += int(counts[n])
+                self.not_converged[BRANCHES[number - 1]] += int(
+                    np.count_nonzero(failed & (branch == number)))
+        return wrapper
+
+    def _wrap_solve(self, solve):
+        def wrapper(*args, **kwargs):
+            try:
+                result = solve(*args, **kwargs)
+            except solver.ConvergenceError:
+                self._solved(1, 1)
+                raise
+            self._solved(1, 0)
+            return result
+        return wrapper
+
+    def _wrap_batch_solve(self, solve):
+        def wrapper(*args, **kwargs):
+            result = solve(*args, **kwargs)
+            solved = result.iterations > 0  # NaN start values are skipped
+            self._solved(int(np.count_nonzero(solved)), int(
+                np.count_nonzero(solved & ~result.converged)))
+            return result
+        return wrapper
+
+
+def _branch(model):
+    """`odc.ODC.fit` branch number of fitted model."""
+    if model.sO2 <= 0.97 and not model.p50st:
+        return 1
+    return 2 if model.p50st is not None else 3
+
+
+def enable():
+    """Start collecting into new profile.
+
+    :raises RuntimeError: If profile is already enabled.
+    :rtype: Profile
+    """
+    global _active
+    if _active is not None:
+        raise RuntimeError("Instrumentation is already enabled")
+    _active = Profile()
+    _active._install()
+    return _active
+
+
+def disable():
+    """Stop collecting, restore original functions.
+
+    :return:
+        Stopped profile, None if not enabled.
+    :rtype: Profile
+    """
+    global _active
+    prof, _active = _active, None
+    if prof is not None:
+        prof._uninstall()
+    return prof
+
+
+def current():
+    """Enabled profile, None if instrumentation is disabled.
+
+    :rtype: Profile
+    """
+    return _active
+
+
+class profile(object):
+
+    """Context manager enabling instrumentation for its block.
+
+    `with profile() as prof:` binds enabled `Profile`.
+    """
+
+    def __enter__(self):
+        return enable()
+
+    def __exit__(self, *exc_info):
+        disable()
+
+
+def main():
+    import stream
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('source', help="samples.csv-layout file")
+    parser.add_argument('--chunksize', type=int, default=10000)
+    args = parser.parse_args()
+    with profile() as prof:
+        for chunk in stream.read_chunks(args.source, args.chunksize):
+            pipeline.derive(chunk)
+    print(prof.report())
+
+
+if __name__ == '__main__':
+    main()
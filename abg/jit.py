@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Optional JIT-compiled ODC and base excess kernels.
+
+`odc.eval_x_0`, `odc.haldane_odc`, `odc.haldane_odc_diff` and
+`abg.calculate_cbase` are tiny scalar functions called from Newton
+loops, worst case for CPython. If Numba is installed, they are compiled
+with `numba.njit` along with the Newton loops of `odc.ODC.fit` and
+`odc.ODC.eval_pressure`, so whole solve runs in machine code:
+
+    >>> model = jit.JitODC()  # Drop-in `odc.ODC` replacement
+    >>> model.fit(sO2=0.453, pO2=4.49, pCO2=9.15, pH=6.919)
+    >>> batch = jit.JitODCBatch()  # Drop-in `odc_batch.ODCBatch`
+    >>> jit.calculate_cbase(7.4, 5.33, 9.3)
+
+Without Numba the same code runs as plain Python, results are identical
+(`available` tells which one is used). Compilation takes about a second
+on first call; compiled code is cached in `__pycache__`.
+
+Kernels are compiled from `odc` and `abg` functions, so they must be
+compiled in plain `math` mode, see `abg.use_uncertainties`. Halley's
+method is not compiled, `JitODC(method='halley')` uses `solver`.
+
+Parity with `odc`/`abg` and timings: `python bench.py jit --check`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import importlib.util
+import math
+
+import abg
+import backends
+import odc
+import odc_batch
+import solver
+from odc import k_0
+
+np = backends.lazy('numpy')
+
+available = importlib.util.find_spec('numba') is not None
+
+
+def jit(func):
+    """Compile function with `numba.njit` if Numba is installed.
+
+    :return:
+        Compiled function, `func` itself without Numba.
+    """
+    if not available:
+        return func
+    import numba
+    return numba.njit(cache=True)(func)
+
+
+eval_x_0 = jit(odc.eval_x_0)
+haldane_odc = jit(odc.haldane_odc)
+haldane_odc_diff = jit(odc.haldane_odc_diff)
+calculate_cbase = jit(abg.calculate_cbase)
+
+y_0 = math.log(odc.s_0 / (1 - odc.s_0))  # Eq. 46.3
+
+# Equations of `_solve`
+SHIFT = 0  # Curve displacement by measured point, `odc.ODC._solve_shift`
+PRESSURE = 1  # x by y on given curve, `odc.ODC.eval_pressure`
+
+# Compiled `solver.METHODS`
+METHODS = ('newton', 'bracket')
+
+
+@jit
+def _func(equation, x, p, q, r):
+    """Target function value and derivative.
+
+    SHIFT: x is `a`, (p, q, r) are (x_measured, y_measured, T).
+    PRESSURE: (p, q, r) are (y, x_0, A).
+    """
+    if equation == SHIFT:
+        x_0 = eval_x_0(x, r)
+        f = haldane_odc(p, x_0, y_0, x) - q
+        # d(y_i)/da = -n + tanh, as `x_0` depends on `a`
+        return f, -haldane_odc_diff(p, x_0, y_0, x) + math.tanh(
+            k_0 * (p - x_0))
+    return (haldane_odc(x, q, y_0, r) - p,
+            haldane_odc_diff(x, q, y_0, r))
+
+
+@jit
+def _solve(equation, p, q, r, x0, low, high, tol, maxiter, bracketed):
+    """Compiled `solver.solve` for 'newton' and 'bracket' methods.
+
+    :return:
+        Tuple of root, iterations, residual, converged.
+    """
+    if bracketed:
+        if _func(equation, low, p, q, r)[0] > 0:
+            low, high = high, low
+        if not min(low, high) <= x0 <= max(low, high):
+            x0 = (low + high) / 2
+    x = x0
+    f = math.nan
+    converged = False
+    iterations = 0
+    while iterations < maxiter:
+        iterations += 1
+        f, df = _func(equation, x, p, q, r)
+        if abs(f) < tol:
+            converged = True
+            break
+        if not abs(f) >= 0:  # NaN, no chance to converge
+            break
+        if bracketed:
+            if f < 0:
+                low = x
+            else:
+                high = x
+            x_new = x - f / df if df else math.nan
+            if not min(low, high) < x_new < max(low, high):
+                x_new = (low + high) / 2  # Bisection
+            x = x_new
+        else:
+            x = x - f / df
+    return x, iterations, f, converged
+
+
+@jit
+def _solve_many(equation, p, q, r, x0, low, high, tol, maxiter, bracketed,
+                root, iterations, residual, converged):
+    """`_solve` for every element of 1-D arrays, results are written to
+    `root`, `iterations`, `residual`, `converged`. Like
+    `solver.solve_array`, NaN start values are skipped and not converged
+    roots are NaN.
+    """
+    for i in range(x0.size):
+        if not abs(x0[i]) >= 0:
+            root[i] = math.nan
+            continue
+        x, n, f, ok = _solve(
+            equation, p[i], q[i], r[i], x0[i], low[i], high[i],
+            tol, maxiter, bracketed)
+        root[i] = x if ok else math.nan
+        iterations[i] = n
+        residual[i] = f
+        converged[i] = ok
+
+
+class JitODC(odc.ODC):
+
+    """`odc.ODC` with compiled Newton loops, see module description."""
+
+    def _solve_jit(self, equation, p, q, r, x0, bracket):
+        tol = odc.epsilon if self.tol is None else self.tol
+        result = solver.RootResult(*_solve(
+            equation, p, q, r, x0, bracket[0], bracket[1], tol,
+            self.maxiter, self.method == 'bracket') + (self.method,))
+        self.last_solve = result
+        if not result.converged:
+            raise solver.ConvergenceError(result)
+        return result
+
+    def _solve_shift(self, x_measured, y_measured, T):
+        if self.method not in METHODS:
+            return super(JitODC, self)._solve_shift(
+                x_measured, y_measured, T)
+        return self._solve_jit(
+            SHIFT, x_measured, y_measured, T, 0., odc.shift_bracket)
+
+    def eval_pressure(self, sO2, A, T):
+        if self.table is not None or self.method not in METHODS:
+            return super(JitODC, self).eval_pressure(sO2, A, T)
+        y = math.log(sO2 / (1 - sO2))  # 46.2
+        x_0 = eval_x_0(A, T)
+        d = y - y_0
+        h = abs(odc.h_0 + A)
+        x = self._solve_jit(
+            PRESSURE, y, x_0, A, x_0, (x_0 + d - h, x_0 + d + h)).root
+        return math.exp(x)  # Reverse 46.1
+    eval_pressure.__doc__ = odc.ODC.eval_pressure.__doc__
+
+
+class JitODCBatch(odc_batch.ODCBatch):
+
+    """`odc_batch.ODCBatch` with compiled per-sample Newton loops.
+
+    Numpy solver iterates all samples until slowest one converges, compiled
+    loop stops every sample as soon as it converges. Without Numba
+    vectorized `odc_batch.ODCBatch` solver is used, it is faster than
+    plain Python loop.
+    """
+
+    def _solve_jit(self, equation, p, q, r, x0, bracket):
+        arrays = np.broadcast_arrays(*[
+            np.asarray(v, dtype=float) for v in (
+                p, q, r, x0, bracket[0], bracket[1])])
+        p, q, r, x0, low, high = [np.ascontiguousarray(v) for v in arrays]
+        size = x0.size
+        root = np.empty(size)
+        iterations = np.zeros(size, dtype=np.intp)
+        residual = np.full(size, np.nan)
+        converged = np.zeros(size, dtype=bool)
+        _solve_many(
+            equation, p, q, r, x0, low, high,
+            odc.epsilon if self.tol is None else self.tol, self.maxiter,
+            self.method == 'bracket', root, iterations, residual, converged)
+        return solver.ArrayRootResult(
+            root, iterations, residual, converged, self.method)
+
+    def _fit_shift(self, x_measured, y_measured, T):
+        if not available or self.method not in METHODS:
+            return super(JitODCBatch, self)._fit_shift(
+                x_measured, y_measured, T)
+        a = np.where(np.isfinite(x_measured + y_measured), 0., np.nan)
+        return self._solve_jit(
+            SHIFT, x_measured, y_measured, T, a, odc.shift_bracket)
+
+    def eval_pressure(self, sO2, A, T):
+        if (not available or self.table is not None or
+                self.method not in METHODS):
+            return super(JitODCBatch, self).eval_pressure(sO2, A, T)
+        sO2, A, T = np.broadcast_arrays(
+            odc_batch._asarray(sO2), odc_batch._asarray(A),
+            odc_batch._asarray(T))
+        shape = sO2.shape
+        sO2, A, T = sO2.ravel(), A.ravel(), T.ravel()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            y = np.log(sO2 / (1 - sO2))  # 46.2
+        x_0 = odc_batch.eval_x_0(a=A, T=T)
+        d = y - y_0
+        h = np.abs(odc.h_0 + A)
+        x = np.where(np.isfinite(y), x_0, np.nan)
+        x = self._solve_jit(
+            PRESSURE, y, x_0, A, x, (x_0 + d - h, x_0 + d + h)).root
+        return np.exp(x).reshape(shape)  # Reverse 46.1
+    eval_pressure.__doc__ = odc_batch.ODCBatch.eval_pressure.__doc__
@@ -15,12 +15,14 @@ as zero (e.g. ODC reference position), sometimes no (default values).
 
 from __future__ import absolute_import
 from __future__ import division
-try:
-    from uncertainties import umath as math
-except ImportError:
-    import math
+import math
+
+import backends
+import solver
+from units import kPa, ctHb_g_dL
 
 epsilon = 0.0001  # Precision of Newton-Raphson algorithm
+shift_bracket = (-3., 3.)  # Curve displacement search range for 'bracket'
 
 norm_p50 = (24, 28)  # mmHg or ~26.6
 norm_p50st = norm_p50
@@ -39,6 +41,17 @@ cDPG = 5  # mmol\L
 # FMetHb = 0  # Standard
 
 
+def use_uncertainties(enable=True):
+    """Switch module math to `uncertainties.umath` to accept ufloat values.
+
+    Plain `math` is used by default, see `abg.use_uncertainties`.
+
+    :param bool enable: False switches back to plain `math`.
+    """
+    global math
+    math = backends.load('uncertainties' if enable else 'math')
+
+
 class ODC(object):
 
     """Oxygemoglobin dissiciation curve (ODC) model.
@@ -73,6 +86,25 @@ class ODC(object):
     .. [3] http://www.derangedphysiology.com/php/Arterial-blood-gases/p50.php
     """
 
+    def __init__(self, table=None, method='newton', tol=None,
+                 maxiter=solver.max_iterations):
+        """
+        :param odc_table.ODCTable table: Use precomputed table for
+            `eval_pressure` instead of Newton-Raphson iterations, see
+            `odc_table` for maximum error. Not applicable to ufloat values.
+        :param str method: Root finding method, see `solver.METHODS`.
+        :param float tol: Solver tolerance, `epsilon` by default.
+        :param int maxiter: Solver iteration cap. `solver.ConvergenceError`
+            is raised if exceeded.
+        """
+        self.table = table
+        self.method = method
+        self.tol = tol
+        self.maxiter = maxiter
+        self.fit_result = None  # solver.RootResult of last fit
+        self.last_solve = None  # solver.RootResult of last iterative call
+        self._constants = {}  # T -> (x_0, h), see `curve_constants`
+
     def fit(
             self, sO2, pO2, pCO2, pH,
             T=37, FCOHb=0.004, FMetHb=0.004, p50st=None):
@@ -98,7 +130,11 @@ class ODC(object):
             the p50(st) value is keyed in.
 
         Enter measured parameters to fit curve in it.
+
+        :raises ValueError: If keyed `p50st` is not positive.
         """
+        if p50st is not None and not p50st > 0:
+            raise ValueError("p50st must be positive, got %s" % p50st)
         self.FCOHb = FCOHb
         self.FMetHb = FMetHb
         self.sO2 = sO2
@@ -107,6 +143,7 @@ class ODC(object):
         self.pH = pH
         self.T = T
         self.p50st = p50st
+        self._constants = {}
 
         # Eq. 46.3
         self.y_0 = math.log(s_0 / (1 - s_0))
@@ -136,16 +173,8 @@ class ODC(object):
 
             # Newtom-Rapson method
             # http://web.mit.edu/10.001/Web/Course_Notes/NLAE/node6.html
-            a = 0  # Start value, as described in paper
-            while True:
-                x_0i = eval_x_0(a=a, T=T)
-                # n ~ 2.7 according to paper
-                y_i = haldane_odc(x=x_measured, x_0=x_0i, y_0=self.y_0, a=a)
-                if abs(y_measured - y_i) < epsilon:
-                    break
-                n = haldane_odc_diff(x=x_measured, x_0=x_0i, y_0=self.y_0, a=a)
-                a = a + (y_measured - y_i) / (
-                    -n + math.tanh(k_0 * (x_measured - x_0i)))  # Brackets
+            self.fit_result = self._solve_shift(x_measured, y_measured, T)
+            a = self.fit_result.root
             self.ac = ac
             self.a = a
             self.a6 = a - ac
@@ -162,18 +191,9 @@ class ODC(object):
                 # Рассчитать точку P0S0 по давлению p50st, сатурации 0.5
                 # Итеративно определаить `a6` (без учёта ac) при котором кривая
                 #     проходиn через рассчитанную точку P0S0
-                a6 = 0  # Start value, as described in paper
-                while True:
-                    x_0i = eval_x_0(a=a6, T=T)
-                    # n ~ 2.7 according to paper
-                    y_i = haldane_odc(
-                        x=x_measured, x_0=x_0i, y_0=self.y_0, a=a6)
-                    if abs(y_measured - y_i) < epsilon:
-                        break
-                    n = haldane_odc_diff(
-                        x=x_measured, x_0=x_0i, y_0=self.y_0, a=a6)
-                    a6 = a6 + (y_measured - y_i) / (
-                        -n + math.tanh(k_0 * (x_measured - x_0i)))  # Brackets
+                self.fit_result = self._solve_shift(
+                    x_measured, y_measured, T)
+                a6 = self.fit_result.root
                 # *Расчёт кривой p50act*
                 # К рассчитанному для p50st `a6` прибавить рассчитанный по
                 # измеряемым параметрам сдвиг 'ac'
@@ -189,10 +209,44 @@ class ODC(object):
                 # Кривая пациента приблизительно соответсвует reference-кривой,
                 #    сдвинутой на рассчитанный 'ac'
                 # a = ac  # `a6` не нужно определять
+                self.fit_result = None
                 self.ac = ac
                 self.a = ac
                 self.a6 = 0
 
+    def _solve(self, func, x0, bracket, method=None):
+        """Run configured root finding method, keep statistics."""
+        result = solver.solve(
+            func, x0, tol=epsilon if self.tol is None else self.tol,
+            method=method or self.method, maxiter=self.maxiter,
+            bracket=bracket, raise_error=False)
+        self.last_solve = result
+        if not result.converged:
+            raise solver.ConvergenceError(result)
+        return result
+
+    def _solve_shift(self, x_measured, y_measured, T):
+        """Find curve displacement at which curve passes through
+        measured point (x_measured, y_measured).
+
+        :rtype: solver.RootResult
+        """
+        halley = self.method == 'halley'
+
+        def func(a):
+            x_0i = eval_x_0(a=a, T=T)
+            # n ~ 2.7 according to paper
+            y_i = haldane_odc(x=x_measured, x_0=x_0i, y_0=self.y_0, a=a)
+            n = haldane_odc_diff(x=x_measured, x_0=x_0i, y_0=self.y_0, a=a)
+            t = math.tanh(k_0 * (x_measured - x_0i))
+            # d(y_i)/da = -n + tanh, as `x_0` depends on `a`
+            d2 = -2 * k_0 * (1 - t ** 2) * (1 + (h_0 + a) * k_0 * t) \
+                if halley else None
+            return y_i - y_measured, -n + t, d2
+
+        # Start value, as described in paper
+        return self._solve(func, 0, bracket=shift_bracket)
+
     def fit_standard(self, p50st=3.578, *args, **kwargs):
         """Not shure about *args/**kwargs trick.
 
@@ -226,21 +280,26 @@ class ODC(object):
             ODC, kPa. No hemoglobin corrections performed.
         :rtype: float
         """
+        if self.table is not None:
+            return float(self.table.pressure(sO2=sO2, A=A, T=T))
         # 46.2
         y = math.log(sO2 / (1 - sO2))
         # Newtom-Rapson iterative method
         x_0 = eval_x_0(a=A, T=T)
-        x = x_0  # Start value, as described in paper
-        while True:
+        halley = self.method == 'halley'
+
+        def func(x):
             y_i = haldane_odc(x=x, x_0=x_0, y_0=self.y_0, a=A)
-            if abs(y - y_i) < epsilon:
-                # print("FOUND x", x)
-                break
             # n ~ 2.7 according to paper
             n = haldane_odc_diff(x, x_0, self.y_0, A)
-            x = x + (y - y_i) / n
-            # print(y, y_i)
-        # print('y', y, 'x', x)
+            d2 = haldane_odc_diff2(x, x_0, self.y_0, A) if halley else None
+            return y_i - y, n, d2
+
+        # `h * tanh` term is within (-|h|, |h|), so root is within bracket
+        d = y - self.y_0
+        h = abs(h_0 + A)
+        # Start value, as described in paper
+        x = self._solve(func, x_0, bracket=(x_0 + d - h, x_0 + d + h)).root
         # print('\n%s y ~ \n%s y_hal\n' % (
         #     y, haldane_odc(x, x_0, self.y_0, A)))
         p = math.exp(x)  # Reverse 46.1
@@ -275,6 +334,55 @@ class ODC(object):
         s = 1 / (math.exp(-y) + 1)  # Reverse 46.2
         return s
 
+    def curve_constants(self, T=None):
+        """Constants of fitted curve, computed once per temperature.
+
+        :param float T: Temperature, °C. Fit temperature by default.
+        :return:
+            Tuple of `x_0` (46.4) and `h` (46.6).
+        """
+        if T is None:
+            T = self.T
+        if T not in self._constants:
+            self._constants[T] = (eval_x_0(a=self.a, T=T), h_0 + self.a)
+        return self._constants[T]
+
+    def saturation_curve(self, pO2, T=None):
+        """Saturation of fitted curve for whole array of pressures.
+
+        Vectorized, see `odc_batch.curve_saturation`. Not applicable to
+        ufloat values.
+
+        :param ndarray pO2: Partial O2 pressures, kPa.
+        :param float T: Temperature, °C. Fit temperature by default.
+        :return:
+            Saturation, fraction, same shape as `pO2`. No hemoglobin
+            corrections performed.
+        :rtype: ndarray
+        """
+        import odc_batch
+        x_0, h = self.curve_constants(T)
+        return odc_batch.curve_saturation(pO2, x_0, h)
+
+    def pressure_curve(self, sO2, T=None):
+        """Pressure of fitted curve for whole array of saturations.
+
+        Vectorized, see `odc_batch.curve_pressure`. Not applicable to
+        ufloat values.
+
+        :param ndarray sO2: Saturations, fraction.
+        :param float T: Temperature, °C. Fit temperature by default.
+        :return:
+            Partial O2 pressure, kPa, same shape as `sO2`. NaN if not
+            converged.
+        :rtype: ndarray
+        """
+        import odc_batch
+        x_0, h = self.curve_constants(T)
+        return odc_batch.curve_pressure(
+            sO2, x_0, h, tol=epsilon if self.tol is None else self.tol,
+            method=self.method, maxiter=self.maxiter)
+
     def eval_p50(self):
         """Partial pressure of oxygen at half saturation (sO2 50 %) in blood.
 
@@ -320,17 +428,17 @@ class ODC(object):
         return self.eval_pressure(sO2=0.5, A=self.a6, T=37)
 
     def eval_pO2T(self, ctHb, T):
-        # FCOHb=0.004, FMetHb=0.004
-        """Not implemented yet. Fixme: must return same O2 at 37 degrees.
-
-        pO2 of blood at patient temperature.
-
-        Standard ODC shifted with patient values is used.
-
+        """pO2 of blood at patient temperature.
 
-        Возможно некоторые параметры жёстко привязаны к текущей модели кривой.
+        Blood is a closed system, so total O2 content (hemoglobin bound
+        and dissolved, eq. 19 from paper) doesn't change with temperature.
+        Curve is shifted to temperature `T` (46.7 and pH(T) effect on
+        displacement) and pressure with same O2 content as at 37 °C is
+        found. pO2(T) at 37 °C equals measured pO2.
 
-        Note that pO2T value at 37 °C must be the same as pO2.
+        O2 content at 37 °C is calculated once per `ctHb` and cached on
+        fitted object. Solve starts from 37 °C point, see
+        `eval_pO2T_grid` for warm start across temperatures.
 
 
         References
@@ -339,63 +447,101 @@ class ODC(object):
         .. [1] Radiometer ABL800 Flex Reference Manual English US.
             chapter 6-30, p. 266, equation 14.
 
-        :param float ctHb:
+        :param float ctHb: Hemoglobin, mmol/L.
         :param float T: Body temperature, °C.
         :return:
             pO2(T), kPa
         :rtype: float
         """
-        def calc_tiT(pO2, sO2, T):
-            """O2 content. Based on eq. 19 from paper.
-            """
-            alphaO2 = 9.83 * 10 ** -3 * math.exp(
-                -1.15 * 10 ** -2 * (T - 37) + 2.1 * 10 ** -4 * (T - 37) ** 2)
-            return ctHb * (1 - self.FCOHb - self.FMetHb) * sO2 + alphaO2 * pO2
-
-        # def calc_tiT_diff(pO2, sO2, T):
-        #     # I'm not shure if it is a derivative
-        #     alphaO2 = 9.83 * 10 ** -3 * math.exp(
-        #         -1.15 * 10 ** -2 * (T - 37) + 2.1 * 10 ** -4 * (T - 37) ** 2)
-        #     return 1 + alphaO2  # * pO2
-
-        def calc_tiT_diff(pO2, sO2, T, A):
-            # Derivative from paper
-            alphaO2 = 9.83 * 10 ** -3 * math.exp(
-                -1.15 * 10 ** -2 * (T - 37) + 2.1 * 10 ** -4 * (T - 37) ** 2)
-            x = math.log(pO2)
-            x_0 = eval_x_0(a=A, T=T)
-            n = haldane_odc_diff(x=x, x_0=x_0, y_0=self.y_0, a=A)
-            return alphaO2 + ctHb * n * (1 - sO2) / pO2
+        return self._solve_pO2T(ctHb, T, self._pO2T_37(ctHb)[0])[0]
+
+    def eval_pO2T_grid(self, ctHb, T):
+        """pO2 of blood for sequence of temperatures, see `eval_pO2T`.
+
+        Every solve starts from solution for previous temperature, so
+        monotonic grid (e.g. temperature sweep of hypothermia protocol)
+        takes few iterations per point.
+
+        :param float ctHb: Hemoglobin, mmol/L.
+        :param T: Iterable of temperatures, °C.
+        :return:
+            List of pO2(T), kPa.
+        :rtype: list
+        """
+        x = self._pO2T_37(ctHb)[0]
+        result = []
+        for t in T:
+            pO2T, x = self._solve_pO2T(ctHb, t, x)
+            result.append(pO2T)
+        return result
+
+    def _pO2T_37(self, ctHb):
+        """O2 state at 37 °C shared by all `eval_pO2T` solves.
+
+        :return:
+            Tuple of `x` (46.1) of measured point, its O2 content,
+            solubility at 37 °C and measured pO2 to curve pO2 ratio.
+        """
+        key = ('pO2T', ctHb)
+        if key not in self._constants:
+            P_37 = self.pO2 + (self.pO2 / self.sO2) * (self.FCOHb / (
+                1 - self.FCOHb - self.FMetHb))  # 46.9
+            x_37 = math.log(P_37)
+            alpha_37 = eval_alphaO2(37)
+            content, _, pO2 = self._content_T(
+                x_37, A=self.a, T=37, ctHb=ctHb, alphaO2=alpha_37)
+            # Curve may not pass through measured point (branches II, III),
+            # scale to keep pO2(37) equal to measured pO2.
+            self._constants[key] = (x_37, content, alpha_37, self.pO2 / pO2)
+        return self._constants[key]
+
+    def _content_T(self, x, A, T, ctHb, alphaO2):
+        """O2 content on curve shifted by `A` at temperature `T`.
+
+        :return:
+            Tuple of content, mmol/L, its derivative by `x` and pO2, kPa.
+        """
+        P = math.exp(x)
+        x_0 = eval_x_0(a=A, T=T)
+        y = haldane_odc(x=x, x_0=x_0, y_0=self.y_0, a=A)
+        S = 1 / (math.exp(-y) + 1)  # Reverse 46.2
+        dS = haldane_odc_diff(x, x_0, self.y_0, A) * S * (1 - S)
+        # sO2 * (1 - FCOHb - FMetHb), reverse 46.11
+        q = S * (1 - self.FMetHb) - self.FCOHb
+        dq = dS * (1 - self.FMetHb)
+        pO2 = P * q / (q + self.FCOHb)  # Reverse 46.9
+        dpO2 = pO2 + P * self.FCOHb * dq / (q + self.FCOHb) ** 2
+        return ctHb * q + alphaO2 * pO2, ctHb * dq + alphaO2 * dpO2, pO2
+
+    def _solve_pO2T(self, ctHb, T, x_start):
+        """Find pO2(T), see `eval_pO2T`.
 
+        :return:
+            Tuple of pO2(T), kPa, and `x` of solution.
+        """
+        x_37, content_37, alpha_37, scale = self._pO2T_37(ctHb)
+        alphaO2 = eval_alphaO2(T)
         dpHdT = -1.46 * 10 ** -2 - 6.5 * 10 ** -3 * (self.pH - 7.4)
-        A_37 = self.ac - 1.04 * dpHdT * (T - 37)
-        P_37 = self.pO2 + (self.pO2 / self.sO2) * (self.FCOHb / (
-            1 - self.FCOHb - self.FMetHb))  # 46.9
-        S_37 = self.eval_saturation(pO2=P_37, A=A_37, T=37)
-        # P_37 = self.pO2
-        # S_37 = self.sO2
-        t_37 = calc_tiT(pO2=P_37, sO2=S_37, T=37)
-        Ai = self.ac - 1.04 * dpHdT * (T - 37)
-        P = 3  # kPa, by paper
-        counter = 0
-        while True:
-            counter += 1
-            Si = self.eval_saturation(pO2=P, A=Ai, T=T)
-            sO2iT = (Si * (1 - self.FMetHb) - self.FCOHb) / (
-                1 - self.FCOHb - self.FMetHb)
-            pO2iT = P / (
-                1 + (self.FCOHb / (sO2iT * (1 - self.FCOHb - self.FMetHb))))
-            tiT = calc_tiT(pO2=pO2iT, sO2=sO2iT, T=T)
-            # print(t_37 - tiT)
-            if (t_37 - tiT) < epsilon:
-                break
-            n = calc_tiT_diff(pO2=pO2iT, sO2=sO2iT, T=T, A=Ai)
-            P = P + (t_37 - tiT) / n
-
-            if counter > 50:
-                break
-                raise ValueError("Infinite iteration")
-        return pO2iT
+        A = self.a - 1.04 * dpHdT * (T - 37)
+
+        def func(x):
+            # Content difference as pressure of dissolved O2, kPa, so
+            # tolerance has same meaning as in other solves
+            content, dcontent, _ = self._content_T(x, A, T, ctHb, alphaO2)
+            return (content - content_37) / alpha_37, dcontent / alpha_37, \
+                None
+
+        # Root is between pure hemoglobin (x shifts with curve) and pure
+        # plasma (x shifts with solubility) cases
+        width = abs(A - self.a + 0.055 * (T - 37)) + abs(
+            math.log(alpha_37 / alphaO2)) + 0.5
+        # Plain Newton from far start (cold blood, jump across grid) leaves
+        # the curve and overflows, so always stay in bracket whatever fit
+        # method is
+        x = self._solve(
+            func, x_start, bracket=(x_37 - width, x_37 + width),
+            method='bracket').root
+        return self._content_T(x, A, T, ctHb, alphaO2)[2] * scale, x
 
     # def test_pO2T(self, ctHb, T):
     #     P_37 = self.pO2 + (self.pO2 / self.sO2) * (self.FCOHb / (
@@ -406,6 +552,15 @@ class ODC(object):
     #         1 + (self.FCOHb / (sO2iT * (1 - self.FCOHb - self.FMetHb))))
 
 
+def eval_alphaO2(T):
+    """Solubility coefficient of O2 in blood at temperature `T`, °C.
+
+    Based on eq. 19 from paper, mmol/L/kPa.
+    """
+    return 9.83 * 10 ** -3 * math.exp(
+        -1.15 * 10 ** -2 * (T - 37) + 2.1 * 10 ** -4 * (T - 37) ** 2)
+
+
 def eval_x_0(a, T):
     """Will be calculated multiple times to allow other functions get
     temperature as parameter.
@@ -433,42 +588,50 @@ def haldane_odc_diff(x, x_0, y_0, a):
     return 1 + h * k_0 * (1 - math.tanh(k_0 * (x - x_0)) ** 2)
 
 
+def haldane_odc_diff2(x, x_0, y_0, a):
+    """Second derivative of `haldane_odc` (d2y/dx2).
+    """
+    h = h_0 + a  # Eq. 46.6
+    t = math.tanh(k_0 * (x - x_0))
+    return -2 * h * k_0 ** 2 * t * (1 - t ** 2)
+
+
 def main_test():
     # sO2 = 97.2 / 100
-    # pO2 = 63.5 * 0.133322368
-    # pCO2 = 63.5 * 0.133322368
+    # pO2 = 63.5 * kPa
+    # pCO2 = 63.5 * kPa
     # pH = 7.390
     # T = 37
     # FCOHb = 5.2 / 100
     # FMetHb = -0.5 / 100
-    # ctHb = 11.9 * 0.62058  # mmol/L
+    # ctHb = 11.9 * ctHb_g_dL  # mmol/L
     # # tiT ~ 7.261  # 37 celsus
     # pO2T = 63.5
 
     # Иванова
     # sO2 = 45.3 / 100
-    # pO2 = 33.7 * 0.133322368
-    # pCO2 = 68.6 * 0.133322368
+    # pO2 = 33.7 * kPa
+    # pCO2 = 68.6 * kPa
     # pH = 6.919
     # T = 39.6
     # FCOHb = 1.6 / 100
     # FMetHb = 0.7 / 100
-    # ctHb = 12.3 * 0.62058  # mmol/L
-    # pCO2T = 77.8 * 0.133322368  # 10.372 kPa
-    # pO2T = 40.3 * 0.133322368
+    # ctHb = 12.3 * ctHb_g_dL  # mmol/L
+    # pCO2T = 77.8 * kPa  # 10.372 kPa
+    # pO2T = 40.3 * kPa
 
     # Неизвестная 1
     sO2 = 100.3 / 100
-    # pO2 = 454 * 0.133322368
-    pO2 = 454 * 0.133322368
-    pCO2 = 26.2 * 0.133322368
+    # pO2 = 454 * kPa
+    pO2 = 454 * kPa
+    pCO2 = 26.2 * kPa
     pH = 6.945
     T = 37
     FCOHb = 2.8 / 100
     FMetHb = -0.2 / 100
-    ctHb = 11.4 * 0.62058  # mmol/L
-    pCO2T = 26.2 * 0.133322368
-    pO2T = 454 * 0.133322368
+    ctHb = 11.4 * ctHb_g_dL  # mmol/L
+    pCO2T = 26.2 * kPa
+    pO2T = 454 * kPa
 
     odc = ODC()
     # odc.fit(sO2=sO2, pO2=pO2, pCO2=pCO2, pH=pH, FCOHb=FCOHb, FMetHb=FMetHb)
@@ -480,14 +643,14 @@ def main_test():
 
     # p50 = odc.eval_p50()
     # assert(round(p50, 6) == round(3.51851472023, 6))
-    # print("calculate_p50 %s kPa (%s mmHg)" % (p50, p50 / 0.133322368))
+    # print("calculate_p50 %s kPa (%s mmHg)" % (p50, p50 / kPa))
     # print("Expected                         26.3910308001 mmHg")
-    # print('eval_p50st %f' % (odc.eval_p50st() / 0.133322368))
-    print('eval_pO2T %f' % (odc.eval_pO2T(ctHb=ctHb, T=T) / 0.133322368))
-    print("expected  %s" % (pO2T / 0.133322368))
+    # print('eval_p50st %f' % (odc.eval_p50st() / kPa))
+    print('eval_pO2T %f' % (odc.eval_pO2T(ctHb=ctHb, T=T) / kPa))
+    print("expected  %s" % (pO2T / kPa))
 
-    # print("Test expected %s" % (odc.pO2 / 0.133322368))
-    # print('test_pO2T %f' % (odc.test_pO2T(ctHb=ctHb, T=T) / 0.133322368))
+    # print("Test expected %s" % (odc.pO2 / kPa))
+    # print('test_pO2T %f' % (odc.test_pO2T(ctHb=ctHb, T=T) / kPa))
 
 
 if __name__ == '__main__':
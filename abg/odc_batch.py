@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized (NumPy) ODC model for whole cohorts of blood samples.
+
+`ODCBatch` repeats `odc.ODC` logic, but each attribute is an array with
+one element per sample. All curve displacements `a`, `a6`, `ac` are solved
+together by `solver.solve_array`: every iteration works only on samples,
+which are not converged yet, so converged elements are frozen and cost
+nothing. Iterates are the same as in scalar `odc.ODC.fit`, hence results
+match within float tolerance.
+
+    >>> model = ODCBatch()
+    >>> model.fit(sO2=sO2, pO2=pO2, pCO2=pCO2, pH=pH,
+    ...           FCOHb=FCOHb, FMetHb=FMetHb)
+    >>> model.eval_p50()
+
+Whole curves of fitted samples are sampled in one call, one row per
+sample, for plotting:
+
+    >>> pO2 = np.linspace(0.5, 20, 1000)
+    >>> curves = model.saturation_curve(pO2)  # shape (samples, 1000)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import math
+
+import backends
+import solver
+from odc import epsilon, shift_bracket, k_0, h_0, T_0, s_0, p_00, FHbF, cDPG
+
+np = backends.lazy('numpy')
+
+
+def _asarray(value):
+    """Convert input to float ndarray without copying if possible."""
+    return np.asarray(value, dtype=float)
+
+
+class ODCBatch(object):
+
+    """Oxygemoglobin dissiciation curves for array of samples.
+
+    See `odc.ODC` for model description and references.
+
+    After `fit()` following arrays are available:
+
+        * `a`, `a6`, `ac` - curve displacements, like in `odc.ODC`.
+        * `branch` - which `odc.ODC.fit` branch was used (1, 2, 3).
+        * `converged` - False for samples where solver exceeded
+          iteration cap. Displacements of such samples are NaN.
+        * `iterations` - number of solver iterations per sample.
+    """
+
+    y_0 = math.log(s_0 / (1 - s_0))  # Eq. 46.3
+
+    def __init__(self, table=None, method='newton', tol=None,
+                 maxiter=solver.max_iterations):
+        """
+        :param odc_table.ODCTable table: Use precomputed table for
+            `eval_pressure` instead of Newton-Raphson iterations.
+        :param str method: Root finding method, see `solver.METHODS`.
+        :param float tol: Solver tolerance, `odc.epsilon` by default.
+        :param int maxiter: Solver iteration cap.
+        """
+        self.table = table
+        self.method = method
+        self.tol = tol
+        self.maxiter = maxiter
+        self._constants = {}
+
+    def fit(
+            self, sO2, pO2, pCO2, pH,
+            T=37, FCOHb=0.004, FMetHb=0.004, p50st=None):
+        """Evaluate ODC position for every sample, see `odc.ODC.fit`.
+
+        All parameters broadcast against each other.
+
+        :param ndarray p50st: Keyed p50(st), kPa. NaN elements (or None for
+            all samples) mean p50(st) is unknown.
+        :raises ValueError: If any keyed `p50st` is not positive.
+        """
+        if p50st is None:
+            p50st = np.nan
+        (sO2, pO2, pCO2, pH, T, FCOHb, FMetHb, p50st) = np.broadcast_arrays(
+            *[_asarray(v) for v in (
+                sO2, pO2, pCO2, pH, T, FCOHb, FMetHb, p50st)])
+        self.sO2 = sO2
+        self.pO2 = pO2
+        self.pCO2 = pCO2
+        self.pH = pH
+        self.T = T
+        self.FCOHb = FCOHb
+        self.FMetHb = FMetHb
+        self.p50st = p50st
+
+        a1 = -0.88 * (pH - 7.40)
+        a2 = 0.048 * np.log(pCO2 / 5.33)  # 5.33 pCO2
+        a3 = -0.7 * FMetHb
+        a4 = (0.06 - 0.02 * FHbF) * (cDPG - 5)
+        a5 = -0.25 * FHbF
+        ac = a1 + a2 + a3 + a4 + a5
+
+        keyed = np.isfinite(p50st)
+        if np.any(p50st[keyed] <= 0):
+            raise ValueError("p50st must be positive")
+        branch = np.full(ac.shape, 3, dtype=np.int8)
+        branch[keyed] = 2
+        branch[(sO2 <= 0.97) & ~keyed] = 1
+
+        # Branch I fits `a` to measured point, branch II fits `a6` to keyed
+        # p50(st) point. Both share same equation, so solve them together.
+        pressure = np.where(branch == 2, p50st, pO2)
+        saturation = np.where(branch == 2, 0.5, sO2)
+        P0 = pressure + (pressure / saturation) * (
+            FCOHb / (1 - FCOHb - FMetHb))  # 46.9
+        S0 = (saturation * (1 - FCOHb - FMetHb) + FCOHb) / (
+            1 - FMetHb)  # 46.11
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x_measured = np.log(P0)
+            y_measured = np.log(S0 / (1 - S0))
+
+        fitted = branch != 3
+        shift = np.zeros(ac.shape)
+        iterations = np.zeros(ac.shape, dtype=np.intp)
+        converged = np.ones(ac.shape, dtype=bool)
+        result = self._fit_shift(
+            x_measured[fitted], y_measured[fitted], T[fitted])
+        shift[fitted] = result.root
+        iterations[fitted] = result.iterations
+        converged[fitted] = result.converged
+
+        self.ac = ac
+        self.a = np.where(branch == 1, shift, np.where(
+            branch == 2, shift + ac, ac))
+        self.a6 = np.where(branch == 1, shift - ac, np.where(
+            branch == 2, shift, 0.))
+        self.branch = branch
+        self.iterations = iterations
+        self.converged = converged
+        self._constants = {}
+
+    def fit_table(self, table, p50st=None):
+        """Fit curves for every row of `samples.csv`-like table.
+
+        Columns are converted by `pipeline.normalize`, missing FCOHb and
+        FMetHb columns take `fit` defaults.
+
+        :param table: DataFrame, dict of arrays or structured ndarray,
+            e.g. `sample` records.
+        :param ndarray p50st: Keyed p50(st), kPa, see `fit`.
+        """
+        import pipeline
+        values = pipeline.normalize(table)
+        kwargs = dict((name, values[name]) for name in (
+            'sO2', 'pO2', 'pCO2', 'pH', 'FCOHb', 'FMetHb') if name in values)
+        self.fit(p50st=p50st, **kwargs)
+
+    def eval_pressure(self, sO2, A, T):
+        """Calculate O2 pressure by saturation, see `odc.ODC.eval_pressure`.
+
+        :param ndarray sO2: hemoglobin saturation, fraction (46.2)
+        :param ndarray A: curve displacement along axis x (46.5).
+        :param ndarray T: Body temperature, °C (46.7).
+        :return:
+            p, partial O2 pressure, kPa. NaN if not converged.
+        :rtype: ndarray
+        """
+        if self.table is not None:
+            return self.table.pressure(sO2=sO2, A=A, T=T)
+        sO2, A, T = np.broadcast_arrays(
+            _asarray(sO2), _asarray(A), _asarray(T))
+        shape = sO2.shape
+        sO2, A, T = sO2.ravel(), A.ravel(), T.ravel()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            y = np.log(sO2 / (1 - sO2))  # 46.2
+        x_0 = eval_x_0(a=A, T=T)
+        halley = self.method == 'halley'
+
+        def func(x, idx):
+            x_0i, Ai = x_0[idx], A[idx]
+            y_i = haldane_odc(x=x, x_0=x_0i, y_0=self.y_0, a=Ai)
+            n = haldane_odc_diff(x, x_0i, self.y_0, Ai)
+            d2 = haldane_odc_diff2(x, x_0i, self.y_0, Ai) if halley else None
+            return y_i - y[idx], n, d2
+
+        # `h * tanh` term is within (-|h|, |h|), so root is within bracket
+        d = y - self.y_0
+        h = np.abs(h_0 + A)
+        # Start value, as described in paper
+        x = np.where(np.isfinite(y), x_0, np.nan)
+        x = self._solve(func, x, bracket=(x_0 + d - h, x_0 + d + h)).root
+        return np.exp(x).reshape(shape)  # Reverse 46.1
+
+    def eval_saturation(self, pO2, A, T):
+        """Calculate saturation by curve, see `odc.ODC.eval_saturation`.
+
+        :param ndarray pO2: partial O2 pressure, kPa (46.1)
+        :param ndarray A: curve displacement along axis x (46.5).
+        :param ndarray T: Body temperature, °C (46.7).
+        :return:
+            s, hemoglobin saturation, fraction.
+        :rtype: ndarray
+        """
+        x_0 = eval_x_0(a=A, T=T)
+        y = haldane_odc(x=np.log(_asarray(pO2)), x_0=x_0, y_0=self.y_0, a=A)
+        return 1 / (np.exp(-y) + 1)  # Reverse 46.2
+
+    def eval_p50(self):
+        """p50 for every sample, see `odc.ODC.eval_p50`.
+
+        :return:
+            p50, kPa.
+        :rtype: ndarray
+        """
+        S = (0.5 * (1 - self.FCOHb - self.FMetHb) + self.FCOHb) / (
+            1 - self.FMetHb)
+        P = self.eval_pressure(sO2=S, A=self.a, T=37)
+        return P / (1 + (self.FCOHb / 0.5 * (1 - self.FCOHb - self.FMetHb)))
+
+    def eval_p50st(self):
+        """p50(st) for every sample, see `odc.ODC.eval_p50st`.
+
+        :return:
+            p50(st), kPa.
+        :rtype: ndarray
+        """
+        return self.eval_pressure(sO2=0.5, A=self.a6, T=37)
+
+    def eval_pO2T(self, ctHb, T):
+        """pO2 at patient temperature for every sample, see
+        `odc.ODC.eval_pO2T`.
+
+        `ctHb` and `T` broadcast against samples, so temperature grid for
+        every sample is evaluated in one call with `T` of shape
+        `(temperatures, 1)`. O2 content at 37 °C is calculated once per
+        sample and all solves start from 37 °C point.
+
+        :param ndarray ctHb: Hemoglobin, mmol/L.
+        :param ndarray T: Body temperature, °C.
+        :return:
+            pO2(T), kPa. NaN if not converged.
+        :rtype: ndarray
+        """
+        FCOHb, FMetHb = self.FCOHb, self.FMetHb
+        P_37 = self.pO2 + (self.pO2 / self.sO2) * (FCOHb / (
+            1 - FCOHb - FMetHb))  # 46.9
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x_37 = np.log(P_37)
+        alpha_37 = eval_alphaO2(37)
+        content_37, _, pO2_37 = _content_T(
+            x_37, self.a, 37, ctHb, alpha_37, FCOHb, FMetHb)
+        scale = self.pO2 / pO2_37  # Keep pO2(37) equal to measured pO2
+        T = _asarray(T)
+        alphaO2 = eval_alphaO2(T)
+        dpHdT = -1.46 * 10 ** -2 - 6.5 * 10 ** -3 * (self.pH - 7.4)
+        A = self.a - 1.04 * dpHdT * (T - 37)
+        width = np.abs(A - self.a + 0.055 * (T - 37)) + np.abs(
+            np.log(alpha_37 / alphaO2)) + 0.5
+        arrays = np.broadcast_arrays(
+            x_37, content_37, scale, A, T, alphaO2, _asarray(ctHb),
+            FCOHb, FMetHb, width)
+        shape = arrays[0].shape
+        (x_37, content_37, scale, A, T, alphaO2, ctHb, FCOHb, FMetHb,
+            width) = [v.ravel() for v in arrays]
+
+        def func(x, idx):
+            content, dcontent, _ = _content_T(
+                x, A[idx], T[idx], ctHb[idx], alphaO2[idx], FCOHb[idx],
+                FMetHb[idx])
+            return (content - content_37[idx]) / alpha_37, \
+                dcontent / alpha_37, None
+
+        # Always in bracket, same as `odc.ODC._solve_pO2T`. Saturation at
+        # bracket ends may overflow to exact 0 or 1
+        with np.errstate(over='ignore'):
+            x = solver.solve_array(
+                func, x_37, tol=epsilon if self.tol is None else self.tol,
+                method='bracket', maxiter=self.maxiter,
+                bracket=(x_37 - width, x_37 + width)).root
+            pO2T = _content_T(
+                x, A, T, ctHb, alphaO2, FCOHb, FMetHb)[2] * scale
+        return pO2T.reshape(shape)
+
+    def curve_constants(self, T=None):
+        """Per-curve constants of fitted samples, computed once.
+
+        :param float T: Temperature, °C. Fit temperature by default.
+        :return:
+            Tuple of `x_0` (46.4) and `h` (46.6) arrays, one element
+            per sample.
+        """
+        key = None if T is None else float(T)
+        if key not in self._constants:
+            self._constants[key] = (
+                eval_x_0(a=self.a, T=self.T if T is None else T),
+                h_0 + self.a)
+        return self._constants[key]
+
+    def saturation_curve(self, pO2, T=None):
+        """Sample fitted curves at many pressures, see `curve_saturation`.
+
+        :param ndarray pO2: Partial O2 pressures, kPa, shared by all
+            samples.
+        :param float T: Temperature, °C. Fit temperature by default.
+        :return:
+            Saturation, fraction, shape is samples shape + `pO2` shape.
+            No hemoglobin corrections performed.
+        :rtype: ndarray
+        """
+        x_0, h = self.curve_constants(T)
+        return curve_saturation(pO2, x_0, h)
+
+    def pressure_curve(self, sO2, T=None):
+        """Sample inverse of fitted curves, see `curve_pressure`.
+
+        :param ndarray sO2: Saturations, fraction, shared by all samples.
+        :param float T: Temperature, °C. Fit temperature by default.
+        :return:
+            Partial O2 pressure, kPa, shape is samples shape + `sO2`
+            shape. NaN if not converged.
+        :rtype: ndarray
+        """
+        x_0, h = self.curve_constants(T)
+        return curve_pressure(
+            sO2, x_0, h, tol=epsilon if self.tol is None else self.tol,
+            method=self.method, maxiter=self.maxiter)
+
+    def _solve(self, func, x0, bracket):
+        """Run configured root finding method on arrays."""
+        return solver.solve_array(
+            func, x0, tol=epsilon if self.tol is None else self.tol,
+            method=self.method, maxiter=self.maxiter, bracket=bracket)
+
+    def _fit_shift(self, x_measured, y_measured, T):
+        """Find curve displacements passing through measured points.
+
+        Same equation as `odc.ODC._solve_shift`, start value is zero.
+
+        :rtype: solver.ArrayRootResult
+        """
+        halley = self.method == 'halley'
+
+        def func(a, idx):
+            xm = x_measured[idx]
+            x_0i = eval_x_0(a=a, T=T[idx])
+            y_i = haldane_odc(x=xm, x_0=x_0i, y_0=self.y_0, a=a)
+            n = haldane_odc_diff(x=xm, x_0=x_0i, y_0=self.y_0, a=a)
+            t = np.tanh(k_0 * (xm - x_0i))
+            d2 = -2 * k_0 * (1 - t ** 2) * (1 + (h_0 + a) * k_0 * t) \
+                if halley else None
+            return y_i - y_measured[idx], -n + t, d2
+
+        a = np.where(np.isfinite(x_measured + y_measured), 0., np.nan)
+        return self._solve(func, a, bracket=shift_bracket)
+
+
+def eval_alphaO2(T):
+    """Vectorized `odc.eval_alphaO2`."""
+    T = _asarray(T)
+    return 9.83 * 10 ** -3 * np.exp(
+        -1.15 * 10 ** -2 * (T - 37) + 2.1 * 10 ** -4 * (T - 37) ** 2)
+
+
+def _content_T(x, A, T, ctHb, alphaO2, FCOHb, FMetHb):
+    """Vectorized `odc.ODC._content_T`."""
+    P = np.exp(x)
+    x_0 = eval_x_0(a=A, T=T)
+    y = haldane_odc(x=x, x_0=x_0, y_0=ODCBatch.y_0, a=A)
+    S = 1 / (np.exp(-y) + 1)  # Reverse 46.2
+    dS = haldane_odc_diff(x, x_0, ODCBatch.y_0, A) * S * (1 - S)
+    q = S * (1 - FMetHb) - FCOHb  # sO2 * (1 - FCOHb - FMetHb)
+    dq = dS * (1 - FMetHb)
+    pO2 = P * q / (q + FCOHb)  # Reverse 46.9
+    dpO2 = pO2 + P * FCOHb * dq / (q + FCOHb) ** 2
+    return ctHb * q + alphaO2 * pO2, ctHb * dq + alphaO2 * dpO2, pO2
+
+
+def eval_x_0(a, T):
+    """Vectorized `odc.eval_x_0`."""
+    b = 0.055 * (_asarray(T) - T_0)  # Eq. 46.7
+    return np.log(p_00) + a + b  # Eq. 46.4
+
+
+def haldane_odc(x, x_0, y_0, a):
+    """Vectorized `odc.haldane_odc`."""
+    h = h_0 + a  # Eq. 46.6
+    return y_0 + (x - x_0) + h * np.tanh(k_0 * (x - x_0))  # Eq. 46
+
+
+def haldane_odc_diff(x, x_0, y_0, a):
+    """Vectorized `odc.haldane_odc_diff`."""
+    h = h_0 + a  # Eq. 46.6
+    return 1 + h * k_0 * (1 - np.tanh(k_0 * (x - x_0)) ** 2)
+
+
+def haldane_odc_diff2(x, x_0, y_0, a):
+    """Vectorized `odc.haldane_odc_diff2`."""
+    h = h_0 + a  # Eq. 46.6
+    t = np.tanh(k_0 * (x - x_0))
+    return -2 * h * k_0 ** 2 * t * (1 - t ** 2)
+
+
+def _outer(curve, points):
+    """Reshape per-curve array to broadcast against array of points."""
+    curve, points = _asarray(curve), _asarray(points)
+    return curve.reshape(curve.shape + (1,) * points.ndim), points
+
+
+def curve_saturation(pO2, x_0, h):
+    """Saturation of curves with given constants at every pressure.
+
+    Eq. 46 in terms of `u = x - x_0`, so no per-point `eval_x_0` call.
+
+    :param ndarray pO2: Partial O2 pressures, kPa.
+    :param ndarray x_0: Curve positions (46.4), one per curve.
+    :param ndarray h: Curve `h` (46.6), one per curve.
+    :return:
+        Saturation, fraction, shape `x_0.shape + pO2.shape`.
+    :rtype: ndarray
+    """
+    x_0, pO2 = _outer(x_0, pO2)
+    h = _outer(h, pO2)[0]
+    u = np.log(pO2) - x_0  # 46.1
+    y = ODCBatch.y_0 + u + h * np.tanh(k_0 * u)  # Eq. 46
+    return 1 / (np.exp(-y) + 1)  # Reverse 46.2
+
+
+def curve_pressure(sO2, x_0, h, tol=epsilon, method='newton',
+                   maxiter=solver.max_iterations):
+    """Pressure of curves with given constants at every saturation.
+
+    All points of all curves are solved together by
+    `solver.solve_array`. Start value is tangent of curve at `x_0`,
+    root is bracketed like in `ODCBatch.eval_pressure`.
+
+    :param ndarray sO2: Saturations, fraction.
+    :param ndarray x_0: Curve positions (46.4), one per curve.
+    :param ndarray h: Curve `h` (46.6), one per curve.
+    :return:
+        Partial O2 pressure, kPa, shape `x_0.shape + sO2.shape`. NaN if
+        not converged.
+    :rtype: ndarray
+    """
+    x_0, sO2 = _outer(x_0, sO2)
+    h = _outer(h, sO2)[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        d = np.log(sO2 / (1 - sO2)) - ODCBatch.y_0  # 46.2
+    d, h, x_0 = np.broadcast_arrays(d, h, x_0)
+    shape = d.shape
+    d, h = d.ravel(), h.ravel()
+    halley = method == 'halley'
+
+    def func(u, idx):
+        hi = h[idx]
+        t = np.tanh(k_0 * u)
+        d2 = -2 * hi * k_0 ** 2 * t * (1 - t ** 2) if halley else None
+        return u + hi * t - d[idx], 1 + hi * k_0 * (1 - t ** 2), d2
+
+    # `h * tanh` term is within (-|h|, |h|), so root is within bracket
+    habs = np.abs(h)
+    u = solver.solve_array(
+        func, d / (1 + h * k_0), tol=tol, method=method, maxiter=maxiter,
+        bracket=(d - habs, d + habs)).root
+    return np.exp(x_0 + u.reshape(shape))  # Reverse 46.1
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tabulated inverse of the ODC equation for fast pressure lookups.
+
+`odc.ODC.eval_pressure` inverts Eq. 46 by Newton-Raphson iterations on
+every call. But with `u = x - x_0` Eq. 46 becomes
+
+    y - y_0 = u + (h_0 + A) * tanh(k_0 * u)
+
+so `u` depends only on `d = y - y_0` and `A`, temperature only shifts
+`x_0` (Eq. 46.4, 46.7). `ODCTable` solves this equation once on a
+(d, A) grid and then answers inverse queries with cubic Hermite
+interpolation along `d` (exact derivatives stored with the table, so the
+interpolant is monotone as the curve itself) and linear interpolation
+along `A`.
+
+Maximum error with default grid, checked against the Newton-Raphson
+solution converged to machine precision (see `ODCTable.max_error`):
+
+    |ln(p_table) - ln(p_exact)| < 3e-6
+
+i.e. relative pressure error is below 0.0003 %. That is much less than
+`odc.epsilon` tolerance of `odc.ODC.eval_pressure` itself. Default domain
+is |d| <= 8 (sO2 from 0.0022 to 0.99995) and A from -1 to 1; queries
+outside of it are solved by Newton-Raphson method.
+
+    >>> table = odc_table.default()
+    >>> model = odc.ODC(table=table)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import math
+
+import backends
+import odc_batch
+import solver
+from odc import k_0, h_0, s_0
+
+np = backends.lazy('numpy')
+
+y_0 = math.log(s_0 / (1 - s_0))  # Eq. 46.3
+MAX_ERROR = 3e-6  # Documented max ln(p) error for default grid
+
+_default = None
+
+
+def default():
+    """Table with default grid, built once on first call.
+
+    :rtype: ODCTable
+    """
+    global _default
+    if _default is None:
+        _default = ODCTable()
+    return _default
+
+
+class ODCTable(object):
+
+    """Precomputed inverse of Eq. 46 over (y - y_0, A) grid.
+
+    Build takes few dozen milliseconds for default grid.
+
+    :param tuple d_range: Range of `y - y_0` (logit of saturation minus
+        `y_0`).
+    :param float d_step: Grid step along `d`.
+    :param tuple a_range: Range of curve displacement A.
+    :param float a_step: Grid step along `A`. Interpolation error is
+        proportional to `a_step ** 2`.
+    """
+
+    def __init__(self, d_range=(-8., 8.), d_step=0.05,
+                 a_range=(-1., 1.), a_step=0.01):
+        self.d = np.linspace(d_range[0], d_range[1], int(round(
+            (d_range[1] - d_range[0]) / d_step)) + 1)
+        self.A = np.linspace(a_range[0], a_range[1], int(round(
+            (a_range[1] - a_range[0]) / a_step)) + 1)
+        self.d_step = self.d[1] - self.d[0]
+        self.a_step = self.A[1] - self.A[0]
+        self.u = solve_u(self.d[:, None], self.A[None, :])
+        h = h_0 + self.A[None, :]  # Eq. 46.6
+        t = np.tanh(k_0 * self.u)
+        # du/dd, derivative of inverse function, scaled for Hermite basis
+        self.du = self.d_step / (1 + h * k_0 * (1 - t ** 2))
+
+    def lookup_u(self, d, A):
+        """Interpolate `u = x - x_0` for given `d = y - y_0` and `A`.
+
+        :return:
+            u, NaN outside of the table domain.
+        :rtype: ndarray
+        """
+        d, A = np.broadcast_arrays(
+            np.asarray(d, dtype=float), np.asarray(A, dtype=float))
+        fd = (d - self.d[0]) / self.d_step
+        fa = (A - self.A[0]) / self.a_step
+        with np.errstate(invalid='ignore'):
+            inside = ((fd >= 0) & (fd <= self.d.size - 1) &
+                      (fa >= 0) & (fa <= self.A.size - 1))
+        fd = np.where(inside, fd, 0)
+        fa = np.where(inside, fa, 0)
+        i = np.minimum(fd.astype(np.intp), self.d.size - 2)
+        j = np.minimum(fa.astype(np.intp), self.A.size - 2)
+        s = fd - i
+        r = fa - j
+        # Cubic Hermite basis along `d`
+        s2 = s * s
+        s3 = s2 * s
+        h00 = 2 * s3 - 3 * s2 + 1
+        h10 = s3 - 2 * s2 + s
+        h01 = -2 * s3 + 3 * s2
+        h11 = s3 - s2
+
+        def hermite(col):
+            return (h00 * self.u[i, col] + h10 * self.du[i, col] +
+                    h01 * self.u[i + 1, col] + h11 * self.du[i + 1, col])
+
+        u = hermite(j) * (1 - r) + hermite(j + 1) * r
+        return np.where(inside, u, np.nan)
+
+    def pressure(self, sO2, A, T):
+        """Table version of `odc.ODC.eval_pressure`.
+
+        :param ndarray sO2: hemoglobin saturation, fraction (46.2)
+        :param ndarray A: curve displacement along axis x (46.5).
+        :param ndarray T: Body temperature, °C (46.7).
+        :return:
+            p, partial O2 pressure, kPa.
+        :rtype: ndarray
+        """
+        sO2, A, T = np.broadcast_arrays(
+            np.asarray(sO2, dtype=float), np.asarray(A, dtype=float),
+            np.asarray(T, dtype=float))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            d = np.log(sO2 / (1 - sO2)) - y_0  # 46.2
+        u = self.lookup_u(d, A)
+        outside = np.isnan(u) & np.isfinite(d)
+        x = odc_batch.eval_x_0(a=A, T=T) + u
+        p = np.asarray(np.exp(x))  # Reverse 46.1, 0-d array for scalars
+        if outside.any():
+            p[outside] = odc_batch.ODCBatch().eval_pressure(
+                sO2[outside], A[outside], T[outside])
+        return p
+
+    def saturation(self, pO2, A, T):
+        """Vectorized `odc.ODC.eval_saturation`, no table needed.
+
+        :param ndarray pO2: partial O2 pressure, kPa (46.1)
+        :param ndarray A: curve displacement along axis x (46.5).
+        :param ndarray T: Body temperature, °C (46.7).
+        :return:
+            s, hemoglobin saturation, fraction.
+        :rtype: ndarray
+        """
+        return odc_batch.ODCBatch().eval_saturation(pO2, A, T)
+
+    def max_error(self, size=200000, seed=0):
+        """Measure max |ln(p) error| of lookup over random domain points.
+
+        :param int size: Number of random points.
+        :return:
+            Max absolute error of `u` (equal to ln(p) error).
+        :rtype: float
+        """
+        rng = np.random.RandomState(seed)
+        d = rng.uniform(self.d[0], self.d[-1], size)
+        A = rng.uniform(self.A[0], self.A[-1], size)
+        return float(np.max(np.abs(self.lookup_u(d, A) - solve_u(d, A))))
+
+
+def solve_u(d, A, tol=1e-13):
+    """Solve `d = u + (h_0 + A) * tanh(k_0 * u)` to machine precision.
+
+    Left side is monotone in `u`, so safeguarded Newton-Raphson method
+    converges for whole table domain.
+
+    :return:
+        u, ndarray
+    """
+    d, A = np.broadcast_arrays(
+        np.asarray(d, dtype=float), np.asarray(A, dtype=float))
+    shape = d.shape
+    d, A = d.ravel(), A.ravel()
+    h = h_0 + A  # Eq. 46.6
+
+    def func(u, idx):
+        t = np.tanh(k_0 * u)
+        return (u + h[idx] * t - d[idx],
+                1 + h[idx] * k_0 * (1 - t ** 2), None)
+
+    result = solver.solve_array(
+        func, d / (1 + h * k_0), tol=tol, method='bracket',
+        bracket=(d - np.abs(h), d + np.abs(h)))
+    return result.root.reshape(shape)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Derive full ABL800 Flex report panel for a table of samples.
+
+Input table has `samples.csv` column layout: pandas DataFrame, dict of
+arrays or anything indexable by column name. Columns are converted to
+formula units once, see `units.ingest`.
+
+    >>> data = pd.read_csv("samples.csv")
+    >>> derived = derive(data)
+    >>> derived['SBE'] - data['SBE']
+
+Calculations are described by a dependency graph. Each node (derived
+column or intermediate value) is evaluated once for whole table, so
+shared intermediates like HCO3act or ABE are never recalculated for
+every consumer.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import abg_batch
+import odc_batch
+from units import ingest, kPa, ctO2_Vol
+
+
+def _fit_odc(sO2, pO2, pCO2, pH, FCOHb, FMetHb):
+    model = odc_batch.ODCBatch()
+    model.fit(sO2=sO2, pO2=pO2, pCO2=pCO2, pH=pH, FCOHb=FCOHb, FMetHb=FMetHb)
+    return model
+
+
+# Dependency graph in topological order: (name, dependencies, function).
+# Names starting with underscore are intermediate values, not columns.
+# Derived columns have `samples.csv` units.
+GRAPH = (
+    ('HCO3act', ('pH', 'pCO2'), abg_batch.calculate_hco3p),
+    ('SBE', ('pH', 'pCO2'), abg_batch.calculate_cbase),
+    ('ABE', ('pH', 'pCO2', 'ctHb'), abg_batch.calculate_cbase),
+    ('HCO3st', ('pH', 'pCO2', 'ctHb', 'sO2', 'ABE'),
+        abg_batch.calculate_hco3pst),
+    ('AnionGap', ('Na', 'Cl', 'HCO3act'), abg_batch.calculate_anion_gap),
+    ('AnionGapK', ('Na', 'Cl', 'HCO3act', 'K'),
+        abg_batch.calculate_anion_gap),
+    ('mOsm', ('Na', 'glucosae'), abg_batch.calculate_mosm),
+    ('Hct', ('ctHb',), lambda ctHb: abg_batch.calculate_hct(ctHb) * 100),
+    ('pHT', ('pH', 'T'), abg_batch.calculate_pHT),
+    ('pCO2T', ('pCO2', 'T'),
+        lambda pCO2, T: abg_batch.calculate_pCO2T(pCO2, T) / kPa),
+    ('ctO2', ('pO2', 'sO2', 'FCOHb', 'FMetHb', 'ctHb'),
+        lambda *args: abg_batch.calculate_ctO2(*args) * ctO2_Vol),  # Vol%
+    ('_odc', ('sO2', 'pO2', 'pCO2', 'pH', 'FCOHb', 'FMetHb'), _fit_odc),
+    ('p50', ('_odc',), lambda model: model.eval_p50() / kPa),
+    ('RespIdx', ('pO2', 'FO2'), abg_batch.calculate_pO2_FO2_fraction),
+)
+
+
+def normalize(table, units=None):
+    """Convert `samples.csv` columns to units expected by formulas.
+
+    Missing columns are skipped. See `units.ingest`.
+
+    :param table: DataFrame, dict of arrays or structured ndarray.
+    :param dict units: Column name to unit for columns not in
+        `samples.csv` units (structured arrays may carry units in dtype).
+    :raises units.UnitError: If any column has unit not accepted for it.
+    :return:
+        Input name to float ndarray mapping.
+    :rtype: dict
+    """
+    return ingest(table, units)
+
+
+def derive(table, columns=None, units=None):
+    """Calculate derived ABL800 parameters for every table row.
+
+    :param table: `samples.csv`-like table: DataFrame, dict of arrays
+        or structured ndarray.
+    :param columns: Iterable of derived column names to calculate,
+        all derivable columns by default. Only required part of
+        dependency graph evaluated.
+    :param dict units: Input column units, see `normalize`.
+    :return:
+        DataFrame with same index for DataFrame input, dict of ndarray
+        otherwise. Columns which can't be derived due to missing input
+        columns are omitted.
+    """
+    values = normalize(table, units)
+    wanted = set(name for name, _, _ in GRAPH if not name.startswith('_'))
+    if columns is not None:
+        columns = set(columns)
+        unknown = columns - wanted
+        if unknown:
+            raise ValueError("Can't derive %s" % ', '.join(sorted(unknown)))
+        wanted = columns
+    # Walk graph backwards to collect nodes required for wanted columns
+    needed = set(wanted)
+    for name, deps, _ in reversed(GRAPH):
+        if name in needed:
+            needed.update(deps)
+    for name, deps, func in GRAPH:
+        if name in needed and all(d in values for d in deps):
+            values[name] = func(*[values[d] for d in deps])
+    derived = dict(
+        (name, values[name]) for name, _, _ in GRAPH
+        if name in wanted and name in values)
+    if hasattr(table, 'iloc'):  # pandas.DataFrame
+        import pandas as pd
+        return pd.DataFrame(derived, index=table.index)
+    return derived
+
+
+def column_names(table):
+    """Column names of `samples.csv`-like table.
+
+    :param table: DataFrame, dict of arrays or structured ndarray.
+    :rtype: set
+    """
+    dtype = getattr(table, 'dtype', None)
+    if dtype is not None and dtype.names is not None:
+        return set(dtype.names)
+    return set(table.keys())
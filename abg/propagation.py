@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batched analytic error propagation for `abg_batch` formulas.
+
+`abg.use_uncertainties()` builds one ufloat graph per value, which is too
+slow for whole archives. Here every formula has hand-derived partial
+derivatives evaluated over arrays, and standard deviation of the result is
+propagated with first-order (linear) approximation, same as ufloat does:
+
+    sd(f)**2 = sum((df/dx_i * sd(x_i))**2)
+
+Input errors are assumed independent.
+
+    >>> value, sd = propagate(
+    ...     'calculate_hco3p', pH=pH, pCO2=pCO2,
+    ...     sd={'pH': ABL800_SD['pH'], 'pCO2': ABL800_SD['pCO2']})
+
+Inputs and standard deviations are in units of `abg` formulas (kPa,
+fraction, mmol/L).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import math
+
+import abg_batch
+import backends
+from units import kPa, ctHb_g_dL
+
+np = backends.lazy('numpy')
+
+LN10 = math.log(10)
+
+# Measurement standard deviations, used to check calculations against
+# ABL800 Flex report (see test_abg.py). Units of `abg` formulas.
+ABL800_SD = {
+    'pH': 0.001,
+    'pCO2': 0.1 * kPa,
+    'pO2': 1 * kPa,
+    'sO2': 0.001,
+    'ctHb': 0.1 * ctHb_g_dL,
+    'FCOHb': 0.001,
+    'FMetHb': 0.001,
+    'Na': 1.,
+    'Cl': 1.,
+    'glucosae': 0.1,
+}
+
+
+def _a(v):
+    return np.asarray(v, dtype=float)
+
+
+def _anion_gap(Na, Cl, HCO3act, K=0.0, albuminum=None):
+    value = abg_batch.calculate_anion_gap(Na, Cl, HCO3act, K, albuminum)
+    partials = {'Na': 1., 'K': 1., 'Cl': -1., 'HCO3act': -1.}
+    if albuminum is not None:
+        partials['albuminum'] = -2.5
+    return value, partials
+
+
+def _mosm(Na, glucosae):
+    return abg_batch.calculate_mosm(Na, glucosae), {
+        'Na': 2., 'glucosae': 1.}
+
+
+def _hco3(pH, pCO2):
+    value = abg_batch.calculate_hco3(pH, pCO2)
+    return value, {'pH': value * LN10, 'pCO2': value / _a(pCO2)}
+
+
+def _hco3p(pH, pCO2):
+    value = abg_batch.calculate_hco3p(pH, pCO2)
+    q = 10 ** (_a(pH) - 8.7)
+    q = q / (1 + q)  # -d(pKp)/d(pH)
+    return value, {'pH': value * LN10 * (1 + q), 'pCO2': value / _a(pCO2)}
+
+
+def _cbase(pH, pCO2, ctHb=3):
+    pH, pCO2, ctHb = _a(pH), _a(pCO2), _a(ctHb)
+    a = 4.04 * 10 ** -3 + 4.25 * 10 ** -4 * ctHb
+    pHHb = 4.06 * 10 ** -2 * ctHb + 5.98 - 1.92 * 10 ** (-0.16169 * ctHb)
+    log_pCO2Hb = -1.7674 * (10 ** -2) * ctHb + 3.4046 + 2.12 * 10 ** (
+        -0.15158 * ctHb)
+    g = np.log10(5.33 / pCO2)
+    L = log_pCO2Hb - np.log10(7.5006 * pCO2)
+    pHst = pH + g * ((pHHb - pH) / L)
+    cHCO3_533 = 0.23 * 5.33 * 10 ** ((pHst - 6.161) / 0.9524)
+    B = (0.919 - 8 * a) / a
+    D = B ** 2 - 4 * ((24.47 - cHCO3_533) / a)
+    value = -0.5 * B + 0.5 * np.sqrt(D)
+
+    # Chain rule, innermost first
+    dpHHb = 4.06 * 10 ** -2 + 1.92 * 0.16169 * LN10 * 10 ** (
+        -0.16169 * ctHb)
+    dlog_pCO2Hb = -1.7674 * (10 ** -2) - 2.12 * 0.15158 * LN10 * 10 ** (
+        -0.15158 * ctHb)
+    dpHst_dpH = 1 - g / L
+    dg = -1 / (pCO2 * LN10)  # dL/dpCO2 == dg/dpCO2
+    dpHst_dpCO2 = dg * (pHHb - pH) / L - g * (pHHb - pH) * dg / L ** 2
+    dpHst_dctHb = g * (dpHHb * L - (pHHb - pH) * dlog_pCO2Hb) / L ** 2
+    dc_dpHst = cHCO3_533 * LN10 / 0.9524
+    dv_dc = 1 / (a * np.sqrt(D))
+    dB_da = -0.919 / a ** 2
+    dD_da = 2 * B * dB_da + 4 * (24.47 - cHCO3_533) / a ** 2
+    dv_da = -0.5 * dB_da + 0.25 * dD_da / np.sqrt(D)
+    return value, {
+        'pH': dv_dc * dc_dpHst * dpHst_dpH,
+        'pCO2': dv_dc * dc_dpHst * dpHst_dpCO2,
+        'ctHb': dv_da * 4.25 * 10 ** -4 + dv_dc * dc_dpHst * dpHst_dctHb,
+    }
+
+
+def _hco3pst(pH, pCO2, ctHb, sO2):
+    ctHb, sO2 = _a(ctHb), _a(sO2)
+    cBase, d_cBase = _cbase(pH, pCO2, ctHb)
+    a = 4.04 * 10 ** -3 + 4.25 * 10 ** -4 * ctHb
+    Z = cBase - 0.3062 * ctHb * (1 - sO2)
+    value = 24.47 + 0.919 * Z + Z * a * (Z - 8)
+    dv_dZ = 0.919 + a * (2 * Z - 8)
+    return value, {
+        'pH': dv_dZ * d_cBase['pH'],
+        'pCO2': dv_dZ * d_cBase['pCO2'],
+        'ctHb': dv_dZ * (d_cBase['ctHb'] - 0.3062 * (1 - sO2)) +
+        Z * (Z - 8) * 4.25 * 10 ** -4,
+        'sO2': dv_dZ * 0.3062 * ctHb,
+    }
+
+
+def _be(pH, pCO2, HCO3act):
+    return abg_batch.calculate_be(pH, pCO2, HCO3act), {
+        'pH': 13.77, 'pCO2': 0., 'HCO3act': 0.9287}
+
+
+def _hct(ctHb):
+    return abg_batch.calculate_hct(ctHb), {'ctHb': 0.0485}
+
+
+def _pHT(pH, t):
+    pH, t = _a(pH), _a(t)
+    return abg_batch.calculate_pHT(pH, t), {
+        'pH': 1 - 0.0065 * (t - 37),
+        't': -(0.0146 + 0.0065 * (pH - 7.40))}
+
+
+def _pCO2T(pCO2, t):
+    factor = 10 ** (0.021 * (_a(t) - 37))
+    value = _a(pCO2) * factor
+    return value, {'pCO2': factor, 't': value * 0.021 * LN10}
+
+
+def _ctO2(pO2, sO2, FCOHb, FMetHb, ctHb):
+    sO2, ctHb = _a(sO2), _a(ctHb)
+    Hb = 1 - _a(FCOHb) - _a(FMetHb)
+    return abg_batch.calculate_ctO2(pO2, sO2, FCOHb, FMetHb, ctHb), {
+        'pO2': 9.83 * 10 ** -3,
+        'sO2': Hb * ctHb,
+        'FCOHb': -sO2 * ctHb,
+        'FMetHb': -sO2 * ctHb,
+        'ctHb': sO2 * Hb}
+
+
+def _pO2_FO2_fraction(pO2, FO2):
+    value = abg_batch.calculate_pO2_FO2_fraction(pO2, FO2)
+    return value, {'pO2': 1 / (kPa * _a(FO2)), 'FO2': -value / _a(FO2)}
+
+
+def _Ca74(pH, Ca):
+    return abg_batch.calculate_Ca74(pH, Ca), {
+        'pH': 0.53 * _a(Ca), 'Ca': 1 - 0.53 * (7.4 - _a(pH))}
+
+
+def _expected_pH(pCO2, status='acute'):
+    st = {'acute': 0.008, 'chronic': 0.003}
+    return abg_batch.expected_pH(pCO2, status), {'pCO2': -st[status]}
+
+
+# Formula name -> function returning value and partial derivatives
+GRADIENTS = {
+    'calculate_anion_gap': _anion_gap,
+    'calculate_mosm': _mosm,
+    'calculate_hco3': _hco3,
+    'calculate_hco3p': _hco3p,
+    'calculate_hco3pst': _hco3pst,
+    'calculate_be': _be,
+    'calculate_cbase': _cbase,
+    'calculate_hct': _hct,
+    'calculate_pHT': _pHT,
+    'calculate_pCO2T': _pCO2T,
+    'calculate_ctO2': _ctO2,
+    'calculate_pO2_FO2_fraction': _pO2_FO2_fraction,
+    'calculate_Ca74': _Ca74,
+    'expected_pH': _expected_pH,
+}
+
+
+def gradient(name, **kwargs):
+    """Value and partial derivatives of `abg_batch` formula.
+
+    :param str name: Formula name, e.g. 'calculate_cbase'.
+    :param kwargs: Formula arguments, arrays broadcast.
+    :return:
+        Tuple of value and dict of partial derivatives by argument name.
+    """
+    try:
+        func = GRADIENTS[name]
+    except KeyError:
+        raise ValueError("No analytic derivatives for '%s'" % name)
+    return func(**kwargs)
+
+
+def propagate(name, sd, **kwargs):
+    """Value and standard deviation of `abg_batch` formula.
+
+    :param str name: Formula name, e.g. 'calculate_cbase'.
+    :param dict sd: Standard deviations by argument name, arrays or
+        scalars. Arguments without SD considered exact.
+    :param kwargs: Formula arguments, arrays broadcast.
+    :return:
+        Tuple of value and standard deviation ndarrays.
+    """
+    value, partials = gradient(name, **kwargs)
+    unknown = set(sd) - set(partials)
+    if unknown:
+        raise ValueError("'%s' doesn't depend on %s" % (
+            name, ', '.join(sorted(unknown))))
+    variance = np.zeros(np.shape(value))
+    for arg, deviation in sd.items():
+        variance = variance + (partials[arg] * _a(deviation)) ** 2
+    return value, np.sqrt(variance)
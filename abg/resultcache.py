@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent on-disk cache of derived panels.
+
+Warehouse rebuilds re-import the same analyzer slips every night, so
+`pipeline.derive` (ODC fit and every `calculate_*` chain) is repeated for
+samples which haven't changed. `ResultCache` stores derived panels in
+SQLite, keyed by hash of normalized inputs of each sample (canonical units,
+rounded to `digits`) and formula version:
+
+    >>> with ResultCache('panels.sqlite', maxsize=10 ** 6) as cache:
+    ...     for chunk in stream.read_chunks('warehouse.csv'):
+    ...         derived = cache.derive(chunk)  # Same as pipeline.derive
+    ...     cache.info()
+    ResultCacheInfo(hits=..., misses=..., evictions=0, maxsize=1000000,
+                    currsize=..., bytes=...)
+
+Vectorized `pipeline.derive` takes about a microsecond per sample, a
+single SQLite lookup several times more. So lookups never touch SQLite per
+sample:
+
+    * Keys are 128-bit, hashed with numpy for all samples of a table at
+      once. Sample id and date are not part of the key, so shifted,
+      reordered or partly changed exports still hit.
+    * Keys of current version are kept in memory in a sorted array, loaded
+      when cache is opened (16 bytes per sample), and looked up with
+      `searchsorted`.
+    * Panels are stored in pages of up to `pagesize` samples, one SQLite
+      row per page. A table hit reads few pages, not rows.
+
+Only samples which missed are derived, and stored as new pages.
+
+Version defaults to hash of source of formula modules (`VERSION_MODULES`),
+so cache is invalidated automatically when formulas change. Entries of
+other versions are never returned and are evicted first.
+
+Size is bounded by number of stored samples: least recently used pages
+are evicted when cache grows above `maxsize`. In-memory index is private
+to `ResultCache` instance, use one writer per database.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from collections import namedtuple
+import hashlib
+import io
+import os
+import sqlite3
+
+import backends
+import pipeline
+from units import INPUTS, canonical, ingest
+
+np = backends.lazy('numpy')
+
+# Modules whose source defines derived values
+VERSION_MODULES = (
+    'abg', 'abg_batch', 'odc', 'odc_batch', 'pipeline', 'solver', 'units')
+
+# Derived columns, order of values in stored panels
+COLUMNS = tuple(name for name, _, _ in pipeline.GRAPH
+                if not name.startswith('_'))
+
+# Key inputs, `units.INPUTS` names in fixed order
+_KEY_INPUTS = tuple(sorted(INPUTS))
+
+ResultCacheInfo = namedtuple(
+    'ResultCacheInfo', 'hits misses evictions maxsize currsize bytes')
+ResultCacheInfo.__doc__ = """Cache statistics.
+
+hits, misses, evictions, maxsize, currsize - numbers of samples.
+bytes - size of database and its write-ahead log files.
+"""
+
+# `keys` - 128-bit sample keys, int64 first halves, then second halves;
+# `panels` - float64 matrix, row per sample, column per `COLUMNS`. Blobs
+# are in separate table, SQLite rewrites whole row on update of `used`.
+# No index on `used`: LRU order is scanned on eviction only
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    page INTEGER PRIMARY KEY,
+    version TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    used INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_version ON pages (version);
+CREATE TABLE IF NOT EXISTS page_data (
+    page INTEGER PRIMARY KEY,
+    keys BLOB NOT NULL,
+    panels BLOB NOT NULL
+);
+"""
+
+_SLOT_BITS = 32  # Index location is `page << _SLOT_BITS | slot`
+
+
+def _derivable(values):
+    """Derived columns `pipeline.derive` can calculate from inputs."""
+    available = set(values)
+    for name, deps, _ in pipeline.GRAPH:
+        if all(d in available for d in deps):
+            available.add(name)
+    return available
+
+
+def formula_version():
+    """Hash of source of `VERSION_MODULES`.
+
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module in VERSION_MODULES:
+        with io.open(os.path.join(here, module + '.py'), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def _mix(h):
+    """SplitMix64 finalizer, in place on uint64 array."""
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xbf58476d1ce4e5b9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94d049bb133111eb)
+    h ^= h >> np.uint64(31)
+
+
+class ResultCache(object):
+
+    """SQLite-backed cache of `pipeline.derive` results.
+
+    :param str path: Database file, ':memory:' for temporary cache.
+    :param int maxsize: Maximum number of stored samples, None for
+        unbounded. Index takes 16 bytes of memory per sample.
+    :param int pagesize: Maximum samples per stored page.
+    :param int digits: Normalized inputs are rounded to given number of
+        decimal digits to make a key.
+    :param str version: Formula version, `formula_version()` by default.
+    """
+
+    def __init__(self, path, maxsize=1000000, pagesize=10000, digits=6,
+                 version=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.pagesize = pagesize
+        self.digits = digits
+        self.version = version or formula_version()
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        # Lost last commits on power failure are just misses
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.executescript(_SCHEMA)
+        used, size = self._db.execute(
+            'SELECT MAX(used), SUM(rows) FROM pages').fetchone()
+        self._used = used or 0  # LRU clock, incremented by `derive`
+        self._size = size or 0
+        self._load_index()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _load_index(self):
+        """Build in-memory index of current version keys.
+
+        `_index` is sorted array of first halves of keys, `_index_low`
+        second halves and `_index_loc` page and slot of each key.
+        """
+        high, low, loc = [], [], []
+        for page, keys in self._db.execute(
+                'SELECT page, keys FROM pages JOIN page_data USING (page) '
+                'WHERE version = ?',
+                (self.version,)):
+            keys = np.frombuffer(keys, dtype=np.int64).reshape(2, -1)
+            high.append(keys[0])
+            low.append(keys[1])
+            loc.append((page << _SLOT_BITS) + np.arange(keys.shape[1]))
+        if not high:
+            self._index = np.empty(0, dtype=np.int64)
+            self._index_low = np.empty(0, dtype=np.int64)
+            self._index_loc = np.empty(0, dtype=np.int64)
+            return
+        high = np.concatenate(high)
+        order = np.argsort(high, kind='stable')
+        self._index = high[order]
+        self._index_low = np.concatenate(low)[order]
+        self._index_loc = np.concatenate(loc).astype(np.int64)[order]
+
+    def keys(self, values, size):
+        """Cache keys of samples.
+
+        :param dict values: Inputs as returned by `units.ingest`.
+        :param int size: Number of samples.
+        :return:
+            ndarray of shape `(2, size)`, int64 halves of 128-bit keys.
+        """
+        names = [name for name in _KEY_INPUTS if name in values]
+        # Set of present inputs is part of key, derivable panel depends on it
+        seed = hashlib.blake2b(
+            (self.version + ':' + ','.join(names)).encode('utf-8'),
+            digest_size=16).digest()
+        keys = np.empty((2, size), dtype=np.uint64)
+        keys[:] = np.frombuffer(seed, dtype=np.uint64)[:, None]
+        # Different odd multipliers keep halves independent. Each column
+        # step is a bijection of the key, full mixing is done once
+        factors = np.array([[0x9e3779b97f4a7c15], [0xc2b2ae3d27d4eb4f]],
+                           dtype=np.uint64)
+        shift = np.uint64(29)
+        for name in names:
+            column = np.round(np.asarray(values[name], dtype=float),
+                              self.digits)
+            column += 0.  # No negative zeros
+            column[np.isnan(column)] = np.nan  # Single NaN bit pattern
+            keys ^= column.view(np.uint64)
+            keys *= factors
+            keys ^= keys >> shift
+        _mix(keys)
+        return keys.view(np.int64)
+
+    def derive(self, table, columns=None, units=None):
+        """Cached `pipeline.derive`.
+
+        :param table: `samples.csv`-like table.
+        :param columns: Derived columns to return, all by default.
+        :param dict units: Input column units, see `pipeline.normalize`.
+        :return:
+            Dict of ndarray, DataFrame for DataFrame input.
+        """
+        wanted = COLUMNS if columns is None else tuple(columns)
+        unknown = set(wanted) - set(COLUMNS)
+        if unknown:
+            raise ValueError("Can't derive %s" % ', '.join(sorted(unknown)))
+        values = ingest(table, units)
+        size = len(next(iter(values.values()))) if values else 0
+        keys = self.keys(values, size)
+        panels = np.empty((size, len(COLUMNS)))
+        self._used += 1
+        found = self._load(keys, panels)
+        missing = np.flatnonzero(~found)
+        if missing.size:
+            self._store(values, keys, missing, panels)
+        hits = size - missing.size
+        self.hits += hits
+        self.misses += missing.size
+        available = _derivable(values)
+        derived = dict((name, panels[:, COLUMNS.index(name)])
+                       for name in wanted if name in available)
+        if hasattr(table, 'iloc'):  # pandas.DataFrame
+            import pandas as pd
+            return pd.DataFrame(derived, index=table.index)
+        return derived
+
+    def _find(self, keys):
+        """Index locations of `keys`, -1 for not stored."""
+        index = self._index
+        loc = np.full(keys.shape[1], -1, dtype=np.int64)
+        if not index.size:
+            return loc
+        # Sorted queries walk index in order, several times faster
+        order = np.argsort(keys[0])
+        high, low = keys[0, order], keys[1, order]
+        pos = np.searchsorted(index, high)
+        np.minimum(pos, index.size - 1, out=pos)
+        # First halves collide once in 2 ** 64, such sample just misses
+        hit = (index[pos] == high) & (self._index_low[pos] == low)
+        loc[order[hit]] = self._index_loc[pos[hit]]
+        return loc
+
+    def _load(self, keys, panels):
+        """Fill rows of `panels` found in cache, mark their pages used.
+
+        :return:
+            Boolean ndarray, True for found samples.
+        """
+        loc = self._find(keys)
+        rows = np.flatnonzero(loc >= 0)
+        found = np.zeros(keys.shape[1], dtype=bool)
+        if not rows.size:
+            return found
+        loc = loc[rows]
+        # Page ids are few and dense, lookup table is cheaper than sort
+        page_of = loc >> _SLOT_BITS
+        first = page_of.min()
+        page_of -= first
+        present = np.zeros(page_of.max() + 1, dtype=bool)
+        present[page_of] = True
+        pages = [int(page) for page in np.flatnonzero(present) + first]
+        # Offsets of pages in `stored`, -1 for evicted by another writer
+        offsets = np.full(present.size, -1, dtype=np.int64)
+        stored = []
+        size = 0
+        for chunk in range(0, len(pages), 500):  # SQLite parameter limit
+            ids = pages[chunk:chunk + 500]
+            marks = ','.join('?' * len(ids))
+            blobs = dict(self._db.execute(
+                'SELECT page, panels FROM page_data WHERE page IN (%s)' %
+                marks, ids))
+            with self._db:
+                self._db.execute(
+                    'UPDATE pages SET used = ? WHERE page IN (%s)' % marks,
+                    [self._used] + ids)
+            for page in ids:
+                if page in blobs:
+                    stored.append(np.frombuffer(blobs[page]).reshape(
+                        -1, len(COLUMNS)))
+                    offsets[page - first] = size
+                    size += len(stored[-1])
+        if not stored:
+            return found
+        offsets = offsets[page_of]
+        offsets += loc & ((1 << _SLOT_BITS) - 1)
+        loaded = offsets >= 0
+        if not loaded.all():
+            rows, offsets = rows[loaded], offsets[loaded]
+        stored = np.concatenate(stored)
+        if rows.size == len(panels):
+            np.take(stored, offsets, axis=0, out=panels)
+        else:
+            panels[rows] = stored[offsets]
+        found[rows] = True
+        return found
+
+    def _store(self, values, keys, missing, panels):
+        """Derive missing samples, store them and evict above `maxsize`."""
+        subset = dict((INPUTS[name][0], v[missing])
+                      for name, v in values.items())
+        derived = pipeline.derive(subset, units=dict(
+            (INPUTS[name][0], canonical(name)) for name in values))
+        for j, name in enumerate(COLUMNS):
+            panels[missing, j] = derived.get(name, np.nan)
+        # Same sample may repeat in table, store it once
+        _, first = np.unique(keys[0, missing], return_index=True)
+        unique = missing[np.sort(first)]
+        added_keys, added_loc = [], []
+        with self._db:
+            for start in range(0, unique.size, self.pagesize):
+                rows = unique[start:start + self.pagesize]
+                page = self._db.execute(
+                    'INSERT INTO pages (version, rows, used) VALUES (?, ?, ?)',
+                    (self.version, rows.size, self._used)).lastrowid
+                self._db.execute(
+                    'INSERT INTO page_data VALUES (?, ?, ?)',
+                    (page, keys[:, rows].tobytes(),
+                     np.ascontiguousarray(panels[rows]).tobytes()))
+                added_keys.append(keys[:, rows])
+                added_loc.append((page << _SLOT_BITS) + np.arange(rows.size))
+                self._size += rows.size
+            self._add_index(np.concatenate(added_keys, axis=1),
+                            np.concatenate(added_loc).astype(np.int64))
+            self._evict()
+
+    def _add_index(self, keys, loc):
+        """Insert keys into sorted in-memory index."""
+        order = np.argsort(keys[0], kind='stable')
+        keys, loc = keys[:, order], loc[order]
+        pos = np.searchsorted(self._index, keys[0])
+        self._index = np.insert(self._index, pos, keys[0])
+        self._index_low = np.insert(self._index_low, pos, keys[1])
+        self._index_loc = np.insert(self._index_loc, pos, loc)
+
+    def _evict(self):
+        if self.maxsize is None or self._size <= self.maxsize:
+            return
+        # Other versions can't be hit, drop them before least recent ones
+        victims = self._db.execute(
+            'SELECT page, rows FROM pages ORDER BY version = ?, used',
+            (self.version,))
+        excess = self._size - self.maxsize
+        pages = []
+        for page, rows in victims:
+            if excess <= 0:
+                break
+            pages.append(page)
+            excess -= rows
+            self._size -= rows
+            self.evictions += rows
+        for table in ('pages', 'page_data'):
+            self._db.executemany('DELETE FROM %s WHERE page = ?' % table,
+                                 [(page,) for page in pages])
+        keep = ~np.isin(self._index_loc >> _SLOT_BITS, pages)
+        self._index = self._index[keep]
+        self._index_low = self._index_low[keep]
+        self._index_loc = self._index_loc[keep]
+
+    def info(self):
+        """Cache statistics.
+
+        :rtype: ResultCacheInfo
+        """
+        size = sum(os.path.getsize(path)
+                   for path in (self.path, self.path + '-wal')
+                   if os.path.exists(path))
+        return ResultCacheInfo(self.hits, self.misses, self.evictions,
+                               self.maxsize, self._size, size)
+
+    def clear(self):
+        """Drop all panels and reset statistics."""
+        with self._db:
+            self._db.execute('DELETE FROM pages')
+            self._db.execute('DELETE FROM page_data')
+        self._size = 0
+        self._load_index()
+        self.hits = self.misses = self.evictions = 0
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        """Number of stored samples."""
+        return self._size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compact typed representation of blood gas samples.
+
+A sample is one record of NumPy structured array with `samples.csv`
+columns. Values are kept in `samples.csv` units (mmHg, %, g/dL), unit of
+every field is stored in dtype metadata:
+
+    >>> records = sample.read_csv("samples.csv")
+    >>> sample.unit('pCO2')
+    'mmHg'
+    >>> records.dtype.fields['pCO2'][0].metadata
+    mappingproxy({'unit': 'mmHg'})
+
+Measurements are stored as float32: analyzers report 3-4 significant
+digits, so it is more than enough and record takes `itemsize` bytes
+(136) regardless of content, i.e. a million samples take 136 MB. Missing
+values are NaN (NaT for dates, -1 for ids).
+
+Structured arrays are accepted as tables by `pipeline.derive`,
+`stream.derive_chunks` and `odc_batch.ODCBatch.fit_table`; formulas get
+float64 arrays in their own units after `pipeline.normalize`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import io
+
+import backends
+import stream
+from pipeline import column_names
+
+np = backends.lazy('numpy')
+
+# Numeric `samples.csv` columns and their units, order of record fields
+COLUMNS = (
+    ('temp', '°C'),
+    ('FO2', '%'),
+    ('pH', ''),
+    ('pHT', ''),
+    ('pCO2', 'mmHg'),
+    ('pCO2T', 'mmHg'),
+    ('pO2', 'mmHg'),
+    ('pO2T', 'mmHg'),
+    ('ctO2', 'Vol%'),
+    ('sO2', '%'),
+    ('ctHb', 'g/dL'),
+    ('FO2Hb', '%'),
+    ('FCOHb', '%'),
+    ('FHHb', '%'),
+    ('FMetHb', '%'),
+    ('Hct', '%'),
+    ('cK', 'mmol/L'),
+    ('cNa', 'mmol/L'),
+    ('cCa', 'mmol/L'),
+    ('cCl', 'mmol/L'),
+    ('AnionGap', 'mmol/L'),
+    ('AnionGapK', 'mmol/L'),
+    ('mOsm', 'mmol/kg'),
+    ('cGlu', 'mmol/L'),
+    ('cLac', 'mmol/L'),
+    ('p50', 'mmHg'),
+    ('RespIdx', 'mmHg'),
+    ('HCO3st', 'mmol/L'),
+    ('SBE', 'mmol/L'),
+    ('ABE', 'mmol/L'),
+)
+UNITS = dict(COLUMNS)
+
+_dtype = None
+
+
+def dtype():
+    """Structured dtype of sample record, built once on first call.
+
+    Fields are 'id' (int64), 'sample_date' (datetime64[m]) and
+    `COLUMNS` (float32, unit in field metadata).
+
+    :rtype: numpy.dtype
+    """
+    global _dtype
+    if _dtype is None:
+        fields = [('id', np.int64), ('sample_date', 'datetime64[m]')]
+        for name, unit in COLUMNS:
+            fields.append((name, np.dtype(np.float32, metadata={
+                'unit': unit})))
+        _dtype = np.dtype(fields)
+    return _dtype
+
+
+def unit(name):
+    """Unit of sample field, e.g. 'mmHg' for 'pO2'.
+
+    :param str name: Field name, one of `COLUMNS`.
+    :rtype: str
+    """
+    try:
+        return UNITS[name]
+    except KeyError:
+        raise ValueError("Unknown sample field '%s'" % name)
+
+
+def empty(size):
+    """Array of `size` samples with all values missing.
+
+    :rtype: ndarray
+    """
+    records = np.empty(size, dtype=dtype())
+    records['id'] = -1
+    records['sample_date'] = np.datetime64('NaT')
+    for name, _ in COLUMNS:
+        records[name] = np.nan
+    return records
+
+
+def from_table(table):
+    """Convert `samples.csv`-like table to sample records.
+
+    Columns absent in table are left missing, extra columns are dropped.
+
+    :param table: DataFrame, dict of arrays or structured ndarray with
+        `samples.csv` column names and units.
+    :rtype: ndarray
+    """
+    names = column_names(table)
+    size = len(table[next(iter(names))]) if names else 0
+    records = empty(size)
+    if 'id' in names:
+        ids = np.asarray(table['id'], dtype=float)
+        records['id'] = np.where(np.isfinite(ids), ids, -1)
+    if 'sample_date' in names:
+        records['sample_date'] = [
+            _parse_date(d) for d in np.asarray(
+                table['sample_date'], dtype=object)]
+    for name, _ in COLUMNS:
+        if name in names:
+            records[name] = np.asarray(table[name], dtype=float)
+    return records
+
+
+def _parse_date(value):
+    """ISO date or date and time, NaT for anything else.
+
+    Reports are often typed by hand, so times without date and partial
+    dates are common.
+    """
+    if isinstance(value, str):
+        try:
+            return np.datetime64(value.strip(), 'm')
+        except ValueError:
+            pass
+    return np.datetime64('NaT')
+
+
+def read_csv(source):
+    """Read `samples.csv`-layout file to sample records.
+
+    :param source: Path or text file object.
+    :rtype: ndarray
+    """
+    if isinstance(source, str):
+        with io.open(source, newline='', encoding='utf-8') as f:
+            return read_csv(f)
+    numeric = ('id',) + tuple(name for name, _ in COLUMNS)
+    chunks = [from_table(chunk) for chunk in stream.read_chunks(
+        source, columns=numeric, passthrough=('sample_date',))]
+    if not chunks:
+        return empty(0)
+    return np.concatenate(chunks)
+
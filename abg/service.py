@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local HTTP/JSON calculation service with request micro-batching.
+
+Bedside devices post one sample per request. Calling scalar `abg`/`odc`
+functions per request doesn't scale under burst load, so concurrent
+requests are collected into micro-batches: batch is closed `window`
+seconds after its first request or when it has `max_batch` requests,
+whichever comes first. Whole batch is derived by one `pipeline.derive`
+call (vectorized `abg_batch` formulas and `odc_batch` fit), results are
+fanned back out to waiting requests. If batch call raises, its samples
+are derived one by one, so error is answered to failing request only.
+
+    $ python service.py serve --port 8080 --window 2 --max-batch 256
+    $ curl -d '{"pH": 7.39, "pCO2": 31.9, "ctHb": 11.9}' localhost:8080/derive
+    {"HCO3act": 18.8..., "SBE": -5.2..., ...}
+    $ curl localhost:8080/stats
+    {"requests": 1, "batches": 1, "p50_ms": 2.4, "p99_ms": 2.4, ...}
+
+Endpoints:
+
+    * POST /derive - JSON object with `samples.csv` input columns and
+      units (see `units.INPUTS`), or list of such objects. Response is
+      derived panel (list of panels), missing values are null.
+    * GET /stats - request latency percentiles (p50, p99) over last
+      `latency_window` requests, batch counters.
+
+Batching gain under load can be measured with
+`python service.py bench --requests 5000 --concurrency 200`: it compares
+batched service with `max_batch=1` one.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sys
+import time
+
+import backends
+import pipeline
+from units import INPUTS
+
+np = backends.lazy('numpy')
+
+INPUT_COLUMNS = tuple(sorted(set(
+    column for column, _, _ in INPUTS.values())))
+latency_window = 10000  # Number of last requests for latency percentiles
+max_body = 1 << 20  # Max request body, bytes
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+
+    """Malformed request, answered with `status` and connection closed."""
+
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+def derive_batch(samples):
+    """Derive panels for list of samples at once, see `pipeline.derive`.
+
+    :param list samples: Dicts of `INPUT_COLUMNS` to numbers or None.
+    :return:
+        List of dicts, one per sample: derived column to float or None.
+        Dicts are empty if inputs are insufficient for any column.
+    :rtype: list
+    """
+    present = [c for c in INPUT_COLUMNS if any(c in s for s in samples)]
+    table = dict(
+        (column, np.array([s.get(column) for s in samples], dtype=float))
+        for column in present)
+    derived = pipeline.derive(table)
+    names = sorted(derived)
+    columns = [derived[name].tolist() for name in names]
+    return [dict((name, None if v != v else v)
+                 for name, v in zip(names, [c[i] for c in columns]))
+            for i in range(len(samples))]
+
+
+def _parse_sample(value):
+    """Validate one sample of request body, keep input columns only."""
+    if not isinstance(value, dict):
+        raise ValueError("sample must be JSON object")
+    sample = {}
+    for column in INPUT_COLUMNS:
+        v = value.get(column)
+        if v is None:
+            continue
+        if isinstance(v, bool) or not isinstance(v, (int, float)):
+            raise ValueError("'%s' must be number" % column)
+        sample[column] = v
+    return sample
+
+
+class MicroBatcher(object):
+
+    """Collect concurrent calls into batches for `func`.
+
+    If `func` raises for batch, items are run by `func` one by one, so only
+    futures of failing items get exception.
+
+    :param callable func: Takes list of items, returns list of results of
+        same length. Run in separate thread, so event loop keeps accepting
+        requests while batch is computed.
+    :param float window: Max seconds first item of batch waits for others.
+    :param int max_batch: Batch is run as soon as it has that many items.
+    """
+
+    def __init__(self, func, window=0.002, max_batch=256):
+        self.func = func
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._timer = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.batches = 0
+        self.items = 0
+        self.split = 0  # Failed batches run item by item
+
+    async def submit(self, item):
+        """Result of `func` for `item`, computed in some batch."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self.batches += 1
+            self.items += len(batch)
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self._executor, self.func, [item for item, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # E.g. one sample out of solver domain, don't fail others
+                self.split += 1
+                for pair in batch:
+                    await self._run([pair])
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+        if len(results) != len(batch):
+            error = RuntimeError("%d results for batch of %d" % (
+                len(results), len(batch)))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class Service(object):
+
+    """HTTP/1.1 JSON service, see module description.
+
+    :param float window: Batching window, seconds.
+    :param int max_batch: Max samples per batch, 1 disables batching.
+    """
+
+    def __init__(self, window=0.002, max_batch=256):
+        self.batcher = MicroBatcher(derive_batch, window, max_batch)
+        self.latencies = deque(maxlen=latency_window)  # Seconds
+        self.requests = 0
+        self.errors = 0
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """Start listening, port 0 picks free port (see `port`)."""
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.close()
+
+    def stats(self):
+        """Latency percentiles in ms and batch counters.
+
+        :rtype: dict
+        """
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            if not latencies:
+                return None
+            i = min(int(q * len(latencies)), len(latencies) - 1)
+            return round(latencies[i] * 1000, 3)
+
+        batches = self.batcher.batches
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': batches,
+            'split_batches': self.batcher.split,
+            'mean_batch_size': round(
+                self.batcher.items / batches, 2) if batches else None,
+            'window_ms': self.batcher.window * 1000,
+            'max_batch': self.batcher.max_batch,
+            'p50_ms': percentile(0.5),
+            'p99_ms': percentile(0.99),
+        }
+
+    async def derive(self, body):
+        """Derived panel(s) for parsed request body."""
+        if isinstance(body, list):
+            samples = [_parse_sample(s) for s in body]
+            return await asyncio.gather(*[
+                self.batcher.submit(s) for s in samples])
+        return await self.batcher.submit(_parse_sample(body))
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_message(reader)
+                except HTTPError as e:
+                    self.errors += 1
+                    _write_response(writer, e.status, {'error': str(e)},
+                                    keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                start = time.perf_counter()
+                status, payload = await self._route(method, path, body)
+                if path == '/derive':
+                    self.requests += 1
+                    self.errors += status != 200
+                    self.latencies.append(time.perf_counter() - start)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                _write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        if path == '/stats':
+            return 200, self.stats()
+        if path != '/derive':
+            return 404, {'error': "unknown path '%s'" % path}
+        if method != 'POST':
+            return 405, {'error': 'use POST'}
+        try:
+            return 200, await self.derive(json.loads(body.decode('utf-8')))
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': repr(e)}
+
+
+async def _read_message(reader):
+    """Parse HTTP/1.1 request or response, None on closed connection.
+
+    :raises HTTPError: For malformed start line or Content-Length, body
+        exceeding `max_body`.
+    :return:
+        Tuple of first two words of start line (method and path for
+        request), headers (lower case names), body bytes.
+    """
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    words = line.decode('latin-1').split()
+    if len(words) < 2:
+        raise HTTPError(400, 'malformed start line')
+    method, path = words[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    value = headers.get('content-length', '0')
+    try:
+        length = int(value)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HTTPError(400, "bad Content-Length '%s'" % value)
+    if length > max_body:
+        raise HTTPError(413, 'body exceeds %d bytes' % max_body)
+    body = await reader.readexactly(length) if length else b''
+    return method, path.split('?')[0], headers, body
+
+
+def _write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write((
+        'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+        'Content-Length: %d\r\nConnection: %s\r\n\r\n' % (
+            status, REASONS[status], len(body),
+            'keep-alive' if keep_alive else 'close')).encode('latin-1'))
+    writer.write(body)
+
+
+async def _client(host, port, samples):
+    """Post samples one by one over keep-alive connection."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for sample in samples:
+            body = json.dumps(sample).encode('utf-8')
+            writer.write((
+                'POST /derive HTTP/1.1\r\nHost: %s\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: %d\r\n\r\n' % (host, len(body))).encode(
+                    'latin-1') + body)
+            await writer.drain()
+            await _read_message(reader)
+    finally:
+        writer.close()
+
+
+async def load(host, port, samples, concurrency=100):
+    """Post samples from `concurrency` connections at once.
+
+    :return:
+        Requests per second.
+    :rtype: float
+    """
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        _client(host, port, samples[i::concurrency])
+        for i in range(concurrency)])
+    return len(samples) / (time.perf_counter() - start)
+
+
+async def _bench(requests, concurrency, window, max_batch, seed):
+    import synth
+    records = synth.generate(requests, seed=seed)
+    samples = [dict((c, float(records[c][i])) for c in INPUT_COLUMNS
+                    if c in records.dtype.names)
+               for i in range(requests)]
+    results = []
+    for batch in (max_batch, 1):
+        service = Service(window=window, max_batch=batch)
+        await service.start(port=0)
+        rate = await load('127.0.0.1', service.port, samples, concurrency)
+        result = service.stats()
+        result['requests_per_s'] = round(rate, 1)
+        result['concurrency'] = concurrency
+        results.append(result)
+        await service.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('command', choices=('serve', 'bench'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--window', type=float, default=2.,
+                        help="batching window, ms")
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--requests', type=int, default=5000,
+                        help="bench: number of requests")
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help="bench: number of connections")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    window = args.window / 1000
+    if args.command == 'bench':
+        results = asyncio.run(_bench(
+            args.requests, args.concurrency, window, args.max_batch,
+            args.seed))
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    async def serve():
+        service = Service(window=window, max_batch=args.max_batch)
+        server = await service.start(args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bounded root finding for ODC equations.
+
+All iterative parts of the ODC model (curve fitting, pressure by saturation,
+pO2 temperature correction) are solved here. Every solve has an iteration
+cap, so pathological input can't hang the caller, and reports number of
+iterations and final residual.
+
+Available methods:
+
+    * 'newton' - Newton-Raphson method, as described in paper.
+    * 'halley' - Halley's method, cubic convergence, needs second derivative.
+    * 'bracket' - Newton-Raphson safeguarded by bisection, always stays in
+      given bracket and converges if bracket contains a root.
+
+Target function `func(x)` must return tuple `(f, f', f'')`: value and
+derivatives at `x`. Second derivative is used only by Halley's method and
+may be None for others. Convergence criterion is `|f(x)| < tol`.
+
+Pathological input must not crash the caller with arithmetic errors:
+`OverflowError` or `ZeroDivisionError` raised by target function or step
+(zero derivative) ends scalar solve as not converged.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from collections import namedtuple
+
+import backends
+
+np = backends.lazy('numpy')
+
+METHODS = ('newton', 'halley', 'bracket')
+max_iterations = 100  # Default iteration cap
+
+RootResult = namedtuple(
+    'RootResult', 'root iterations residual converged method')
+RootResult.__doc__ = """Outcome of a single solve.
+
+iterations - number of target function evaluations.
+residual - target function value at `root`.
+"""
+
+
+class ConvergenceError(ValueError):
+
+    """Raised if solver exceeds iteration cap or gets non-finite value."""
+
+    def __init__(self, result):
+        super(ConvergenceError, self).__init__(
+            "%s method not converged after %d iterations, residual %s" % (
+                result.method, result.iterations, result.residual))
+        self.result = result
+
+
+def _step(method, x, f, df, d2f):
+    """Newton-Raphson or Halley's step from `x`."""
+    if method == 'halley':
+        return x - 2 * f * df / (2 * df ** 2 - f * d2f)
+    return x - f / df
+
+
+def solve(func, x0, tol, method='newton', maxiter=max_iterations,
+          bracket=None, raise_error=True):
+    """Find root of scalar function.
+
+    :param callable func: Returns `(f, f', f'')` for given `x`.
+    :param float x0: Start value.
+    :param float tol: Stop when `|f(x)| < tol`.
+    :param str method: One of `METHODS`.
+    :param int maxiter: Iteration cap, guarantees worst-case latency.
+    :param tuple bracket: `(low, high)` values with opposite function signs.
+        Required for 'bracket' method.
+    :param bool raise_error: Raise `ConvergenceError` if not converged,
+        otherwise return result with `converged == False`.
+    :raises ConvergenceError: Also if `func` or step overflows or divides
+        by zero.
+    :rtype: RootResult
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown method '%s', choose one of %s" % (
+            method, ', '.join(METHODS)))
+    if method == 'bracket':
+        if bracket is None:
+            raise ValueError("'bracket' method requires bracket")
+        low, high = bracket
+        if func(low)[0] > 0:  # Orient bracket so f(low) < 0 < f(high)
+            low, high = high, low
+        if not min(low, high) <= x0 <= max(low, high):
+            x0 = (low + high) / 2
+    x = x0
+    f = float('nan')
+    converged = False
+    iterations = 0
+    while iterations < maxiter:
+        iterations += 1
+        try:
+            f, df, d2f = func(x)
+        except (OverflowError, ZeroDivisionError):
+            f = float('nan')  # Left function domain
+            break
+        if abs(f) < tol:
+            converged = True
+            break
+        if not abs(f) >= 0:  # NaN, no chance to converge
+            break
+        if method == 'bracket':
+            if f < 0:
+                low = x
+            else:
+                high = x
+            x_new = x - f / df if df else None
+            if x_new is None or not min(low, high) < x_new < max(low, high):
+                x_new = (low + high) / 2  # Bisection
+            x = x_new
+        else:
+            try:
+                x = _step(method, x, f, df, d2f)
+            except (OverflowError, ZeroDivisionError):
+                break  # Flat function, no step
+    result = RootResult(x, iterations, f, converged, method)
+    if not converged and raise_error:
+        raise ConvergenceError(result)
+    return result
+
+
+ArrayRootResult = namedtuple(
+    'ArrayRootResult', 'root iterations residual converged method')
+ArrayRootResult.__doc__ = """Outcome of array solve, one element per problem.
+
+Not converged roots are NaN, see `converged` mask.
+"""
+
+
+def solve_array(func, x0, tol, method='newton', maxiter=max_iterations,
+                bracket=None):
+    """Find roots of many independent scalar functions at once.
+
+    Converged elements are frozen and excluded from further iterations.
+
+    :param callable func: `func(x, index)` returns `(f, f', f'')` arrays
+        for 1-D arrays `x` and `index` - flat indices of not converged
+        problems. Use `index` to select problem parameters.
+    :param ndarray x0: Start values, 1-D.
+    :param float tol: Stop when `|f(x)| < tol`.
+    :param str method: One of `METHODS`.
+    :param int maxiter: Iteration cap.
+    :param tuple bracket: `(low, high)` arrays with opposite function signs.
+    :rtype: ArrayRootResult
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown method '%s', choose one of %s" % (
+            method, ', '.join(METHODS)))
+    x = np.array(x0, dtype=float, ndmin=1)
+    size = x.size
+    iterations = np.zeros(size, dtype=np.intp)
+    residual = np.full(size, np.nan)
+    converged = np.zeros(size, dtype=bool)
+    active = np.flatnonzero(np.isfinite(x))
+    if method == 'bracket':
+        if bracket is None:
+            raise ValueError("'bracket' method requires bracket")
+        low = np.array(np.broadcast_to(bracket[0], x.shape), dtype=float)
+        high = np.array(np.broadcast_to(bracket[1], x.shape), dtype=float)
+        f_low = np.full(size, np.nan)
+        f_low[active] = func(low[active], active)[0]
+        swap = f_low > 0  # Orient brackets so f(low) < 0 < f(high)
+        low[swap], high[swap] = high[swap], low[swap]
+        lo, hi = np.minimum(low, high), np.maximum(low, high)
+        outside = ~((lo <= x) & (x <= hi))
+        x[outside] = (low[outside] + high[outside]) / 2
+    for _ in range(maxiter):
+        if not active.size:
+            break
+        xa = x[active]
+        f, df, d2f = func(xa, active)
+        iterations[active] += 1
+        residual[active] = f
+        done = np.abs(f) < tol
+        converged[active[done]] = True
+        keep = ~done & np.isfinite(f)
+        active, xa, f, df = active[keep], xa[keep], f[keep], df[keep]
+        if method == 'bracket':
+            neg = f < 0
+            low[active[neg]] = xa[neg]
+            high[active[~neg]] = xa[~neg]
+            la, ha = low[active], high[active]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_new = xa - f / df
+            inside = (np.minimum(la, ha) < x_new) & (
+                x_new < np.maximum(la, ha))
+            x[active] = np.where(inside, x_new, (la + ha) / 2)
+        else:
+            if method == 'halley':
+                d2f = d2f[keep]
+            x[active] = _step(method, xa, f, df, d2f)
+    x[~converged] = np.nan
+    return ArrayRootResult(x, iterations, residual, converged, method)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming derivation of ABL800 parameters for analyzer exports.
+
+Exports may be many gigabytes, so CSV (`samples.csv` layout) is read in
+chunks of `chunksize` rows, every chunk is passed to `pipeline.derive`
+and written out before next one is read. Peak memory depends on chunk
+size only, not on file size.
+
+    $ python stream.py export.csv derived.csv --chunksize 50000
+
+Or from Python:
+
+    >>> for chunk in derive_chunks(read_chunks('export.csv')):
+    ...     process(chunk['SBE'])
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import argparse
+import csv
+import io
+import itertools
+
+import backends
+import pipeline
+from units import INPUTS
+
+np = backends.lazy('numpy')
+
+# Non-numeric columns copied to output as is, to identify samples
+PASSTHROUGH = ('id', 'sample_date')
+
+
+def _to_float(values):
+    """Parse list of strings to float ndarray, empty or bad values to NaN."""
+    try:
+        return np.array([v or 'nan' for v in values], dtype=float)
+    except ValueError:
+        parsed = np.empty(len(values))
+        for i, v in enumerate(values):
+            try:
+                parsed[i] = float(v)
+            except ValueError:
+                parsed[i] = np.nan
+        return parsed
+
+
+def read_chunks(source, chunksize=10000, passthrough=PASSTHROUGH,
+                columns=None):
+    """Read `samples.csv`-layout CSV by chunks.
+
+    Only numeric `columns` and `passthrough` columns are kept.
+
+    :param source: Path or text file object.
+    :param int chunksize: Max rows per chunk.
+    :param tuple passthrough: Non-numeric columns kept as str arrays.
+    :param columns: Numeric columns kept as float arrays, columns used
+        by `pipeline` by default.
+    :return:
+        Generator of dicts: column name to ndarray.
+    """
+    if isinstance(source, str):
+        with io.open(source, newline='', encoding='utf-8') as f:
+            for chunk in read_chunks(f, chunksize, passthrough, columns):
+                yield chunk
+        return
+    reader = csv.reader(source)
+    wanted, numeric = _wanted(next(reader), passthrough, columns)
+    rows = []
+    for row in reader:
+        rows.append(row)
+        if len(rows) == chunksize:
+            yield _columns(rows, wanted, numeric)
+            rows = []
+    if rows:
+        yield _columns(rows, wanted, numeric)
+
+
+def read_blocks(source, chunksize=10000):
+    """Split CSV to blocks of raw records without parsing them.
+
+    Splitting is cheap, so blocks can be parsed by `parse_block` in
+    worker processes (see `validate`). Quoted fields may span lines.
+
+    :param source: Path or text file object.
+    :param int chunksize: Max records per block.
+    :return:
+        Generator of tuples: header line and list of record strings.
+    """
+    if isinstance(source, str):
+        with io.open(source, newline='', encoding='utf-8') as f:
+            for block in read_blocks(f, chunksize):
+                yield block
+        return
+    header = next(source)
+    records = []
+    record = ''
+    for line in source:
+        record += line
+        if record.count('"') % 2:  # Newline inside quoted field
+            continue
+        records.append(record)
+        record = ''
+        if len(records) == chunksize:
+            yield header, records
+            records = []
+    if record:
+        records.append(record)
+    if records:
+        yield header, records
+
+
+def parse_block(header, records, passthrough=PASSTHROUGH, columns=None):
+    """Parse block of `read_blocks` to chunk like `read_chunks` does.
+
+    :rtype: dict
+    """
+    reader = csv.reader([header] + records)
+    wanted, numeric = _wanted(next(reader), passthrough, columns)
+    return _columns(list(reader), wanted, numeric)
+
+
+def _wanted(header, passthrough, columns):
+    """Indices and names of kept columns, set of numeric ones."""
+    if columns is None:
+        columns = (column for column, _, _ in INPUTS.values())
+    numeric = set(columns)
+    wanted = [(i, name) for i, name in enumerate(header)
+              if name in numeric or name in passthrough]
+    return wanted, numeric
+
+
+def _columns(rows, wanted, numeric):
+    # Transpose once, short rows are padded with empty values
+    table = list(itertools.zip_longest(*rows, fillvalue=''))
+    chunk = {}
+    for i, name in wanted:
+        values = table[i] if i < len(table) else [''] * len(rows)
+        if name in numeric:
+            chunk[name] = _to_float(values)
+        else:
+            chunk[name] = np.array(values, dtype=str)
+    return chunk
+
+
+def derive_chunks(chunks, columns=None, passthrough=PASSTHROUGH):
+    """Derive parameters for every chunk, see `pipeline.derive`.
+
+    :param chunks: Iterable of `samples.csv`-like tables, e.g. `sample`
+        records.
+    :param columns: Derived columns to calculate, all by default.
+    :param tuple passthrough: Columns copied from input chunk.
+    :return:
+        Generator of dicts: passthrough and derived columns.
+    """
+    for chunk in chunks:
+        derived = {}
+        names = pipeline.column_names(chunk)
+        for name in passthrough:
+            if name in names:
+                derived[name] = chunk[name]
+        derived.update(pipeline.derive(chunk, columns=columns))
+        yield derived
+
+
+def write_csv(chunks, target):
+    """Write derived chunks to CSV, one chunk in memory at a time.
+
+    Column order is set by first chunk.
+
+    :param chunks: Iterable of dicts of equally sized arrays.
+    :param target: Path or text file object.
+    :return:
+        Number of rows written.
+    """
+    if isinstance(target, str):
+        with io.open(target, 'w', newline='', encoding='utf-8') as f:
+            return write_csv(chunks, f)
+    writer = csv.writer(target)
+    header = None
+    count = 0
+    for chunk in chunks:
+        if header is None:
+            header = list(chunk)
+            writer.writerow(header)
+        columns = [_format(chunk[name]) for name in header]
+        writer.writerows(zip(*columns))
+        count += len(columns[0]) if columns else 0
+    return count
+
+
+def _format(values):
+    if values.dtype.kind == 'f':
+        return ['' if v != v else repr(v) for v in values.tolist()]
+    return values.tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('source', help="samples.csv-layout CSV")
+    parser.add_argument('target', help="output CSV with derived columns")
+    parser.add_argument('--chunksize', type=int, default=10000)
+    args = parser.parse_args()
+    write_csv(derive_chunks(read_chunks(
+        args.source, chunksize=args.chunksize)), args.target)
+
+
+if __name__ == '__main__':
+    main()
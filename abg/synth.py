@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic blood gas samples for load tests and benchmarks.
+
+Measured parameters (pH, pCO2, ctHb, FCOHb, FMetHb, temperature, keyed
+p50(st), electrolytes) are drawn within physiological ranges, everything
+else comes from the forward models, so records are internally consistent:
+
+    * sO2 lies on patient ODC (`odc_batch.ODCBatch`) positioned by
+      p50(st), pH and pCO2 at the drawn pO2.
+    * Derived columns (HCO3st, SBE, ABE, ctO2, p50, pHT...) are calculated
+      by `pipeline.derive`, pO2T by `odc_batch.ODCBatch.eval_pO2T`.
+
+About a quarter of samples are saturated (sO2 > 0.97). Their p50 is
+derived without keyed p50(st), i.e. by approximate fit III, as analyzer
+reports it; so branch III is included on purpose. pO2T is calculated on
+patient curve (fits I and II only).
+
+Output is `sample` records in `samples.csv` units:
+
+    >>> records = synth.generate(10 ** 6, seed=42)
+    >>> for chunk in synth.generate_chunks(10 ** 7, seed=42):
+    ...     process(chunk)
+
+    $ python synth.py 1000000 synthetic.csv --seed 42
+
+Same `seed` and `chunksize` give the same records. Every chunk has its
+own random stream (`numpy.random.SeedSequence` spawn key is chunk
+number), so chunks may be generated independently, e.g. in parallel.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import argparse
+
+import backends
+import odc_batch
+import pipeline
+import sample
+import stream
+from abg import live_pH
+from units import kPa
+
+np = backends.lazy('numpy')
+
+start_date = '2020-01-01T00:00'  # sample_date of first record
+sample_interval = 5  # Minutes between consecutive records
+arterial_fraction = 0.7  # Arterial samples share, rest are venous
+
+
+def _draw(rng, size):
+    """Measured parameters, `samples.csv` units except pO2 and p50st
+    (kPa).
+
+    :rtype: dict
+    """
+    s = {}
+    s['pCO2'] = np.clip(
+        rng.lognormal(np.log(40), 0.2, size), 15, 110)  # mmHg
+    # Metabolic component with partial compensation of respiratory one,
+    # pH by Henderson-Hasselbalch, so acid-base disorders are plausible
+    HCO3 = np.clip(
+        rng.normal(24, 3, size) + 0.2 * (s['pCO2'] - 40), 5, 50)
+    s['pH'] = np.clip(
+        6.1 + np.log10(HCO3 / (0.0307 * s['pCO2'])), *live_pH)
+    s['ctHb'] = np.clip(rng.normal(12.5, 2, size), 5, 20)  # g/dL
+    s['FCOHb'] = np.clip(rng.lognormal(np.log(1.2), 0.6, size), 0.1, 15)
+    s['FMetHb'] = rng.uniform(0.2, 1.5, size)
+    s['temp'] = np.clip(rng.normal(37, 0.8, size), 33, 41)
+    s['FO2'] = rng.choice([21., 30., 40., 50., 60., 100.], size,
+                          p=[0.55, 0.15, 0.12, 0.08, 0.05, 0.05])
+    s['cNa'] = rng.normal(140, 4, size)
+    s['cCl'] = rng.normal(104, 4, size)
+    s['cK'] = np.clip(rng.normal(4.2, 0.5, size), 2, 8)
+    s['cCa'] = np.clip(rng.normal(1.2, 0.07, size), 0.7, 1.7)
+    s['cGlu'] = np.clip(rng.lognormal(np.log(6), 0.3, size), 2, 30)
+    s['cLac'] = np.clip(rng.lognormal(np.log(1.2), 0.5, size), 0.3, 20)
+    arterial = rng.uniform(size=size) < arterial_fraction
+    s['_pO2'] = np.where(
+        arterial,
+        rng.lognormal(np.log(11), 0.3, size),
+        rng.lognormal(np.log(5.3), 0.2, size))  # kPa
+    s['_p50st'] = np.clip(rng.normal(3.578, 0.2, size), 2.5, 5)  # kPa
+    return s
+
+
+def _saturation(model, pO2, A, FCOHb, FMetHb, maxiter=50):
+    """sO2 which `odc.ODC.fit` maps back to curve `A` with pO2.
+
+    Fit corrects measured point for COHb (46.9, 46.11) with correction
+    depending on sO2 itself, so point is found by fixed-point iteration.
+    Correction is small (FCOHb / sO2), iteration converges in a few steps.
+    """
+    free = 1 - FCOHb - FMetHb
+    sO2 = model.eval_saturation(pO2=pO2, A=A, T=37)
+    for _ in range(maxiter):
+        P0 = pO2 + (pO2 / sO2) * (FCOHb / free)  # 46.9
+        S0 = model.eval_saturation(pO2=P0, A=A, T=37)
+        previous, sO2 = sO2, (S0 * (1 - FMetHb) - FCOHb) / free  # 46.11
+        if np.max(np.abs(sO2 - previous)) < odc_batch.epsilon:
+            break
+    return sO2
+
+
+def _chunk(size, seed, number, start=0):
+    rng = np.random.default_rng(
+        np.random.SeedSequence(seed, spawn_key=(number,)))
+    s = _draw(rng, size)
+    pO2, p50st = s.pop('_pO2'), s.pop('_p50st')
+    values = pipeline.normalize(s)
+    # Keyed p50(st) positions patient curve, pH and pCO2 shift it (fit II)
+    model = odc_batch.ODCBatch()
+    model.fit(sO2=0.5, pO2=p50st, pCO2=values['pCO2'], pH=values['pH'],
+              FCOHb=values['FCOHb'], FMetHb=values['FMetHb'], p50st=p50st)
+    sO2 = _saturation(
+        model, pO2, model.a, values['FCOHb'], values['FMetHb'])
+    s['pO2'] = pO2 / kPa
+    s['sO2'] = sO2 * 100
+    free = 100 - s['FCOHb'] - s['FMetHb']
+    s['FO2Hb'] = sO2 * free
+    s['FHHb'] = (1 - sO2) * free
+    s.update(pipeline.derive(s))
+    # Refit as analyzer would (fit I). Saturated samples (sO2 > 0.97)
+    # would fall to approximate fit III, they are refitted with keyed
+    # p50(st) (fit II), so pO2T of every sample is on its own curve.
+    model.fit(sO2=sO2, pO2=pO2, pCO2=values['pCO2'], pH=values['pH'],
+              FCOHb=values['FCOHb'], FMetHb=values['FMetHb'],
+              p50st=np.where(sO2 > 0.97, p50st, np.nan))
+    s['pO2T'] = model.eval_pO2T(
+        ctHb=values['ctHb'], T=values['T']) / kPa
+
+    records = sample.empty(size)
+    records['id'] = start + np.arange(size)
+    records['sample_date'] = np.datetime64(start_date, 'm') + (
+        start + np.arange(size)) * np.timedelta64(sample_interval, 'm')
+    for name, _ in sample.COLUMNS:
+        if name in s:
+            records[name] = s[name]
+    return records
+
+
+def generate_chunks(size, chunksize=100000, seed=0):
+    """Generate synthetic samples by chunks.
+
+    :param int size: Total number of samples.
+    :param int chunksize: Max samples per chunk.
+    :param int seed: Random seed.
+    :return:
+        Generator of `sample` records. Ids are row numbers.
+    """
+    for number, start in enumerate(range(0, size, chunksize)):
+        yield _chunk(min(chunksize, size - start), seed, number, start)
+
+
+def generate(size, chunksize=100000, seed=0):
+    """Generate synthetic samples, see `generate_chunks`.
+
+    :rtype: ndarray
+    """
+    chunks = list(generate_chunks(size, chunksize, seed))
+    if not chunks:
+        return sample.empty(0)
+    return np.concatenate(chunks)
+
+
+def _table(records):
+    """`samples.csv` columns of records for `stream.write_csv`."""
+    table = {'id': records['id'].astype(str)}
+    table['sample_date'] = np.datetime_as_string(
+        records['sample_date'], unit='m')
+    for name, _ in sample.COLUMNS:
+        table[name] = records[name].astype(float)
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('size', type=int, help="number of samples")
+    parser.add_argument('target', help="output samples.csv-layout CSV")
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    stream.write_csv(
+        (_table(chunk) for chunk in generate_chunks(
+            args.size, chunksize=args.chunksize, seed=args.seed)),
+        args.target)
+
+
+if __name__ == '__main__':
+    main()
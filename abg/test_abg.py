@@ -10,8 +10,11 @@ import pandas as pd
 from uncertainties import ufloat
 import abg
 import odc
+from units import kPa, ctHb_g_dL, ctO2_Vol
+
+abg.use_uncertainties()
+odc.use_uncertainties()
 
-kPa = 0.133322368
 # kPa = 0.133322  # By Radiometer
 
 
@@ -49,7 +52,7 @@ def main_test():
         T = r['temp']
 
         ID = r['id']
-        ctHb = ufloat(r['ctHb'], 0.1) * 0.62058  # mmol/L
+        ctHb = ufloat(r['ctHb'], 0.1) * ctHb_g_dL  # mmol/L
         Hct = ufloat(r['Hct'], 0.1) / 100  # Fraction
         Na = ufloat(r['cNa'], 1)
         Cl = ufloat(r['cCl'], 1)
@@ -68,7 +71,7 @@ def main_test():
         p50 = ufloat(r['p50'], 0.01) * kPa  # mmHg to kPa
         pO2T = ufloat(r['pO2T'], 0.1) * kPa  # mmHg to kPa
 
-        ctO2 = ufloat(r['ctO2'], 0.1) / 2.241  # mmol/L
+        ctO2 = ufloat(r['ctO2'], 0.1) / ctO2_Vol  # mmol/L
         sO2 = ufloat(r['sO2'], 0.1) / 100
         FCOHb = ufloat(r['FCOHb'], 0.1) / 100
         FMetHb = ufloat(r['FMetHb'], 0.1) / 100
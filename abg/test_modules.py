@@ -0,0 +1,861 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Behavior checks of batch formulas, solver and data services.
+
+Run as script (`python test_modules.py`) or collect with pytest. Unlike
+`test_abg.py` checks run in plain `math` mode.
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from uncertainties import ufloat
+
+import abg
+import abg_batch
+import astm
+import cache
+import colstore
+import instrument
+import odc
+import odc_batch
+import odc_table
+import pipeline
+import propagation
+import resultcache
+import sample
+import service
+import solver
+import stream
+import synth
+import trend
+import units
+import validate
+
+# `test_abg` switches to `uncertainties` on import
+abg.use_uncertainties(False)
+odc.use_uncertainties(False)
+
+# pH, pCO2 kPa, ctHb mmol/L, sO2, pO2 kPa, FCOHb, FMetHb, Na, Cl, glucosae
+SAMPLES = (
+    (7.40, 5.33, 9.3, 0.97, 12.0, 0.004, 0.004, 140., 104., 5.5),
+    (6.919, 9.15, 7.4, 0.453, 4.49, 0.012, 0.006, 131., 99., 11.2),
+    (7.61, 2.9, 10.1, 0.99, 16.8, 0.02, 0.01, 147., 109., 4.1),
+    (7.21, 6.8, 5.9, 0.81, 6.1, 0.004, 0.004, 136., 110., 7.9),
+)
+
+
+def _columns():
+    return [np.array(column) for column in zip(*SAMPLES)]
+
+
+def _close(batch, scalar, tol=1e-9):
+    return np.allclose(batch, scalar, rtol=tol, atol=tol, equal_nan=True)
+
+
+def _raises(error, func, *args, **kwargs):
+    try:
+        func(*args, **kwargs)
+    except error:
+        return True
+    return False
+
+
+def test_abg_batch_parity():
+    pH, pCO2, ctHb, sO2, pO2, FCOHb, FMetHb, Na, Cl, glu = _columns()
+    checks = (
+        ('calculate_hco3p', (pH, pCO2)),
+        ('calculate_cbase', (pH, pCO2)),
+        ('calculate_cbase', (pH, pCO2, ctHb)),
+        ('calculate_hco3pst', (pH, pCO2, ctHb, sO2)),
+        ('calculate_mosm', (Na, glu)),
+        ('calculate_hct', (ctHb,)),
+        ('calculate_pHT', (pH, np.full(pH.shape, 36.6))),
+        ('calculate_pCO2T', (pCO2, np.full(pH.shape, 38.2))),
+        ('calculate_ctO2', (pO2, sO2, FCOHb, FMetHb, ctHb)),
+        ('calculate_pO2_FO2_fraction', (pO2, np.full(pH.shape, 0.21))),
+    )
+    for name, args in checks:
+        batch = getattr(abg_batch, name)(*args)
+        scalar = [getattr(abg, name)(*row) for row in zip(*args)]
+        assert _close(batch, scalar), name
+
+
+def test_odc_batch_parity():
+    pH, pCO2, _, sO2, pO2, FCOHb, FMetHb = _columns()[:7]
+    for p50st in (None, 3.578):
+        batch = odc_batch.ODCBatch()
+        batch.fit(sO2=sO2, pO2=pO2, pCO2=pCO2, pH=pH, FCOHb=FCOHb,
+                  FMetHb=FMetHb, p50st=p50st)
+        for i in range(len(pH)):
+            model = odc.ODC()
+            model.fit(sO2=sO2[i], pO2=pO2[i], pCO2=pCO2[i], pH=pH[i],
+                      FCOHb=FCOHb[i], FMetHb=FMetHb[i], p50st=p50st)
+            assert _close(batch.a[i], model.a, 1e-7), (p50st, i)
+            assert _close(batch.eval_p50()[i], model.eval_p50(), 1e-7)
+    assert batch.branch.tolist() == [2, 2, 2, 2]
+    # sO2 > 0.97 without p50(st) is branch III
+    batch.fit(sO2=sO2, pO2=pO2, pCO2=pCO2, pH=pH)
+    assert batch.branch.tolist() == [1, 1, 3, 1]
+
+
+def test_p50st_rejected():
+    for p50st in (0., -1.):
+        assert _raises(ValueError, odc.ODC().fit, 0.9, 8., 5.33, 7.4,
+                       p50st=p50st)
+        assert _raises(ValueError, odc_batch.ODCBatch().fit, [0.9, 0.99],
+                       [8., 12.], 5.33, 7.4, p50st=[np.nan, p50st])
+
+
+def _atan(x):
+    """Newton's method diverges for `atan` from |x0| > 1.39."""
+    return np.arctan(x), 1 / (1 + x ** 2), -2 * x / (1 + x ** 2) ** 2
+
+
+def _flat(x):
+    """No root, zero derivative at 0."""
+    return x * x + 1., 2. * x, 2.
+
+
+def _exp(x):
+    """`math.exp` overflows above 709, underflows to zero slope below."""
+    return math.exp(x) - 1., math.exp(x), math.exp(x)
+
+
+def test_solver_bracket():
+    try:
+        with np.errstate(all='ignore'):  # Diverges to inf and NaN
+            solver.solve(_atan, 2., 1e-12)
+    except solver.ConvergenceError as e:
+        assert not e.result.converged
+    else:
+        raise AssertionError("Newton converged from x0=2")
+    result = solver.solve(_atan, 2., 1e-12, method='bracket',
+                          bracket=(3., -1.))
+    assert result.converged and abs(result.root) < 1e-12
+    with np.errstate(all='ignore'):
+        result = solver.solve(_atan, 2., 1e-12, maxiter=3,
+                              raise_error=False)
+    assert not result.converged and result.iterations == 3
+    result = solver.solve_array(
+        lambda x, idx: _atan(x), np.array([2., 0.5, np.nan]), 1e-12,
+        method='bracket', bracket=(-1., 3.))
+    assert result.converged.tolist() == [True, True, False]
+    assert result.iterations[2] == 0 and np.isnan(result.root[2])
+    # Zero derivative and overflow end solve, not worker
+    for func, x0 in ((_flat, 0.), (_exp, 1000.), (_exp, -800.)):
+        for method in ('newton', 'halley'):
+            assert _raises(solver.ConvergenceError, solver.solve, func,
+                           x0, 1e-12, method=method)
+            result = solver.solve(func, x0, 1e-12, method=method,
+                                  raise_error=False)
+            assert not result.converged
+    for method, bracket in (('secant', None), ('bracket', None)):
+        try:
+            solver.solve(_atan, 2., 1e-12, method=method, bracket=bracket)
+        except ValueError as e:
+            assert not isinstance(e, solver.ConvergenceError)
+        else:
+            raise AssertionError(method)
+
+
+def test_odc_convergence_error():
+    model = odc.ODC(maxiter=1)
+    try:
+        model.fit(sO2=0.453, pO2=4.49, pCO2=9.15, pH=6.919)
+    except solver.ConvergenceError as e:
+        assert e.result.iterations == 1
+    else:
+        raise AssertionError("ODC.fit converged in one iteration")
+    batch = odc_batch.ODCBatch(maxiter=1)
+    batch.fit(sO2=[0.453, 0.8], pO2=[4.49, 6.], pCO2=9.15, pH=6.919)
+    assert not batch.converged.any() and np.isnan(batch.a).all()
+
+
+def test_pO2T_cold():
+    values = pipeline.normalize(sample.read_csv(SAMPLES_CSV))
+    inputs = dict((name, values[name]) for name in (
+        'sO2', 'pO2', 'pCO2', 'pH', 'FCOHb', 'FMetHb'))
+    batch = odc_batch.ODCBatch()
+    batch.fit(**inputs)
+    for T in (20, 25):
+        scalar = []
+        for row in zip(*[inputs[name] for name in inputs]):
+            model = odc.ODC()  # Default Newton fit, pO2(T) stays bracketed
+            model.fit(**dict(zip(inputs, row)))
+            scalar.append(model.eval_pO2T(ctHb=9.3, T=T))
+        with np.errstate(all='raise'):
+            vector = batch.eval_pO2T(ctHb=9.3, T=T)
+        assert np.isfinite(scalar).all() and _close(vector, scalar), T
+    model = odc.ODC()
+    model.fit(sO2=0.51, pO2=4.52, pCO2=6.1, pH=7.35)
+    grid = [37, 39.6, 30, 42, 20]  # Not monotonic
+    assert _close(model.eval_pO2T_grid(9.3, grid),
+                  [model.eval_pO2T(9.3, T) for T in grid], 1e-6)
+    assert model.eval_pO2T_grid(9.3, grid)[0] == model.pO2
+
+
+def test_units():
+    table = {'pH': np.array([7.4]), 'pCO2': np.array([40.]),
+             'sO2': np.array([97.])}
+    values = units.ingest(table)
+    assert _close(values['pCO2'], 40 * units.kPa)
+    assert _close(values['sO2'], 0.97)
+    values = units.ingest(table, {'pCO2': 'kPa', 'sO2': 'fraction'})
+    assert values['pCO2'][0] == 40. and values['sO2'][0] == 97.
+    # Whole table is rejected, before any column is converted
+    assert _raises(units.UnitError, units.ingest, table, {'pCO2': 'mmol/L'})
+    assert _raises(units.UnitError, units.ingest, table, {'pO2X': 'kPa'})
+    assert _raises(units.UnitError, pipeline.derive, table,
+                   units={'pCO2': 'g/dL'})
+    # Units in `sample` dtype metadata
+    records = sample.from_table(table)
+    assert _close(units.ingest(records)['pCO2'], 40 * units.kPa)
+    assert units.canonical('pCO2') == 'kPa'
+
+
+def test_synth():
+    records = synth.generate(500, chunksize=200, seed=7)
+    again = synth.generate(500, chunksize=200, seed=7)
+    assert records.tobytes() == again.tobytes()
+    assert (records['sO2'] > 97).any() and (records['sO2'] <= 97).any()
+    # pO2T is on patient curve for saturated samples too
+    assert np.isfinite(records['pO2T']).all()
+    derived = pipeline.derive(records, columns=['SBE'])
+    assert _close(derived['SBE'], records['SBE'], 1e-4)
+
+
+def _same(func, reference, args):
+    """Compiled kernel matches reference, `math` domain errors may become
+    NaN."""
+    try:
+        expected = reference(*args)
+    except ValueError:
+        try:
+            return math.isnan(func(*args))
+        except ValueError:
+            return True
+    return _close(func(*args), expected)
+
+
+def test_jit_parity():
+    """Runs compiled kernels if Numba is installed, fallback otherwise."""
+    import jit
+    if jit.available:
+        assert hasattr(jit.haldane_odc, 'py_func')  # numba Dispatcher
+    nan = float('nan')
+    values = (-0.3, 0., 0.7, 2.5, nan, float('inf'))
+    for args in zip(values, (36., 37., 42., 20., 37., 37.)):
+        assert _same(jit.eval_x_0, odc.eval_x_0, args)
+    for x in values:
+        for a in (-0.5, 0., 0.4, nan):
+            args = (x, 1.3, 0.2, a)
+            assert _same(jit.haldane_odc, odc.haldane_odc, args)
+            assert _same(jit.haldane_odc_diff, odc.haldane_odc_diff, args)
+    # Out of `abg.live_pH`, extreme pCO2 and ctHb, NaN
+    for pH in (6.0, 6.919, 7.4, 8.2, nan):
+        for pCO2 in (0.5, 5.33, 25., nan):
+            for ctHb in (0., 3., 9.3, 30.):
+                assert _same(jit.calculate_cbase, abg.calculate_cbase,
+                             (pH, pCO2, ctHb)), (pH, pCO2, ctHb)
+
+    pH, pCO2, _, sO2, pO2, FCOHb, FMetHb = _columns()[:7]
+    sO2 = np.append(sO2, [nan, 0.5, 0.9])
+    pO2 = np.append(pO2, [5., nan, 60.])  # Last is off-curve
+    pCO2, pH = np.append(pCO2, [5.33] * 3), np.append(pH, [7.4, 7.4, 6.5])
+    for p50st in (None, 3.578):
+        model, compiled = odc_batch.ODCBatch(), jit.JitODCBatch()
+        for m in (model, compiled):
+            m.fit(sO2=sO2, pO2=pO2, pCO2=pCO2, pH=pH, p50st=p50st)
+        assert _close(compiled.a, model.a)
+        assert compiled.converged.tolist() == model.converged.tolist()
+        sat = np.array([0.01, 0.5, 0.97, 0.999999, 0., 1., 1.2, nan])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            assert _close(compiled.eval_pressure(sat, 0.1, 37),
+                          model.eval_pressure(sat, 0.1, 37))
+        for i in range(len(sO2)):
+            results = []
+            for cls in (odc.ODC, jit.JitODC):
+                try:
+                    m = cls()
+                    m.fit(sO2=sO2[i], pO2=pO2[i], pCO2=pCO2[i], pH=pH[i],
+                          p50st=p50st)
+                    results.append((m.a, m.eval_p50()))
+                except (solver.ConvergenceError, ValueError) as e:
+                    results.append(type(e))
+            assert results[0] == results[1] or _close(
+                results[0], results[1]), (i, p50st, results)
+
+
+def test_trend_idle_without_time():
+    engine = trend.TrendEngine(idle=60)
+    engine.update('a', {'SBE': -2.}, None)  # Before any timed sample
+    engine.update('b', {'SBE': 1.}, 0)
+    engine.update('c', {'SBE': 3.}, float('nan'))  # Seen at 0
+    engine.update('d', {'SBE': 0.}, 200)
+    # NaN-time head doesn't keep idle patients behind it
+    assert 'a' not in engine and 'b' not in engine and 'c' not in engine
+    engine.update('e', {'SBE': 0.5}, None)  # Seen at 200
+    engine.update('f', {'SBE': 0.5}, 250)
+    assert 'd' in engine and 'e' in engine
+    engine.update('g', {'SBE': 0.5}, 400)
+    assert list(engine._states) == ['g']
+    assert engine.info().expired == 6
+    assert engine.trend('g')['SBE'].last == 0.5
+    # Samples without time are weighted, not expired, without `idle`
+    engine = trend.TrendEngine()
+    for value in (1., 3.):
+        engine.update('a', {'SBE': value}, None)
+    result = engine.trend('a')['SBE']
+    assert (result.last, result.ewma, result.count) == (3., 2., 2)
+
+
+def _trends(engine):
+    # repr() compares NaN fields equal
+    return repr(sorted((patient, engine.trend(patient))
+                       for patient in engine._states))
+
+
+def test_trend_reimport():
+    records = sample.read_csv(SAMPLES_CSV)
+    records = records[~np.isnat(records['sample_date'])]
+    engine = trend.TrendEngine()
+    assert engine.update_table(records) == len(records)
+    before, updates = _trends(engine), engine.updates
+    # Last sample of every patient has same time as applied one
+    assert engine.update_table(records) == 0
+    assert _trends(engine) == before and engine.updates == updates
+    assert engine.stale == len(records)
+    # Untimed samples can't be recognized and are applied
+    assert engine.update('x', {'SBE': 1.}) and engine.update('x', {'SBE': 1.})
+
+
+async def _service_checks():
+    app = service.Service(window=0.01)
+    # Empty and pH-only payloads in one batch with complete sample
+    results = await asyncio.wait_for(asyncio.gather(
+        app.derive({}), app.derive({'pH': 7.4}),
+        app.derive({'pH': 7.4, 'pCO2': 40.})), 5)
+    assert all(v is None for r in results[:2] for v in r.values())
+    assert abs(results[2]['SBE'] - abg.calculate_cbase(
+        7.4, 40 * units.kPa)) < 1e-9
+    assert await asyncio.wait_for(app.derive([{}, {}]), 5) == [{}, {}]
+    assert await asyncio.wait_for(app.derive({'pH': 7.4}), 5) == {}
+
+    # Batch function returning too few results fails every request
+    batcher = service.MicroBatcher(lambda items: items[:1], window=0.01)
+    results = await asyncio.wait_for(asyncio.gather(
+        batcher.submit(1), batcher.submit(2), return_exceptions=True), 5)
+    assert results[0] == 1 and isinstance(results[1], RuntimeError)
+    batcher.close()
+
+    # Sample failing batch call gets error alone, others are derived
+    def derive_batch(samples):
+        if any(s.get('pH') == 0 for s in samples):
+            solver.solve(_flat, 0., 1e-9)  # Raises ConvergenceError
+        return service.derive_batch(samples)
+
+    app.batcher.func = derive_batch
+    bad, good = {'pH': 0}, {'pH': 7.4, 'pCO2': 40.}
+    results = await asyncio.wait_for(asyncio.gather(
+        app._route('POST', '/derive', json.dumps(good).encode()),
+        app._route('POST', '/derive', json.dumps(bad).encode()),
+        app._route('POST', '/derive', json.dumps([good, good]).encode())), 5)
+    assert results[0] == (200, service.derive_batch([good])[0])
+    assert results[1][0] == 400 and 'not converged' in results[1][1]['error']
+    assert results[2][0] == 200 and results[2][1] == [results[0][1]] * 2
+    assert app.stats()['split_batches'] == 1
+    app.batcher.func = service.derive_batch
+
+    await app.start(port=0)
+    try:
+        for length, status in (('abc', 400), ('-5', 400), ('', 400),
+                               (str(service.max_body + 1), 413)):
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', app.port)
+            writer.write(('POST /derive HTTP/1.1\r\nContent-Length: %s'
+                          '\r\n\r\n{}' % length).encode('latin-1'))
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            assert response.startswith(
+                ('HTTP/1.1 %d' % status).encode('latin-1')), response
+    finally:
+        await app.close()
+
+
+def test_service():
+    asyncio.run(_service_checks())
+
+
+SAMPLES_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'samples.csv')
+
+
+def _frames(data):
+    """Wrap every record to LIS1-A frame."""
+    lines = [line for line in data.split(b'\r') if line]
+    return b''.join(b'\x02%d%s\r\x03%02X\r\n' % (
+        (i + 1) % 8, line, sum(line) % 256) for i, line in enumerate(lines))
+
+
+def test_astm_round_trip():
+    records = sample.read_csv(SAMPLES_CSV)
+    data = b''.join(astm.encode(records))
+    whole = list(astm.parse([data]))
+    assert len(whole) == len(records)
+    for size in (1, 7, 4096):
+        for stream_ in (data, _frames(data)):
+            pieces = [stream_[i:i + size]
+                      for i in range(0, len(stream_), size)]
+            assert list(astm.parse(pieces)) == whole, size
+    derived = list(astm.derive_stream([data], chunksize=10))
+    assert [len(chunk['id']) for chunk in derived] == [10, 10, 9]
+    expected = pipeline.derive(records)
+    for name in ('SBE', 'HCO3st', 'p50', 'ctO2'):
+        got = np.concatenate([chunk[name] for chunk in derived])
+        assert np.allclose(got, expected[name], rtol=1e-4, atol=1e-3,
+                           equal_nan=True), name
+    assert [s['id'] for s in whole] == [str(i) for i in records['id']]
+
+
+def _same_panels(derived, expected):
+    assert sorted(derived) == sorted(expected)
+    for name in expected:
+        assert _close(derived[name], expected[name]), name
+
+
+def test_result_cache():
+    records = synth.generate(300, seed=3)
+    records['pH'][5] = np.nan  # Underivable sample
+    cache = resultcache.ResultCache(':memory:', pagesize=100, version='a')
+    _same_panels(cache.derive(records), pipeline.derive(records))
+    assert cache.info()[:2] == (0, 300) and len(cache) == 300
+    _same_panels(cache.derive(records), pipeline.derive(records))
+    assert cache.info()[:2] == (300, 300)
+    # Shifted export with changed sample, only that one is derived
+    shifted = records[1:].copy()
+    shifted['pCO2'][0] *= 1.1
+    _same_panels(cache.derive(shifted), pipeline.derive(shifted))
+    assert cache.info()[:2] == (598, 301) and len(cache) == 301
+    # Set of inputs is part of key
+    subset = dict((name, shifted[name]) for name in ('pH', 'pCO2'))
+    _same_panels(cache.derive(subset), pipeline.derive(subset))
+    assert cache.info()[:2] == (598, 600)
+    derived = cache.derive(subset, columns=['SBE'])
+    assert list(derived) == ['SBE'] and cache.info()[:2] == (897, 600)
+    # Repeated samples are stored once
+    cache.clear()
+    twice = np.concatenate([records[:10], records[:10]])
+    _same_panels(cache.derive(twice), pipeline.derive(twice))
+    assert cache.info()[:2] == (0, 20) and len(cache) == 10
+    assert _raises(ValueError, cache.derive, records, columns=['pH'])
+
+
+def test_result_cache_eviction():
+    records = synth.generate(300, seed=3)
+    path = tempfile.mkdtemp()
+    try:
+        db = os.path.join(path, 'panels.sqlite')
+        with resultcache.ResultCache(db, maxsize=250, pagesize=100,
+                                     version='a') as cache:
+            cache.derive(records[:200])
+            cache.derive(records[:100])  # Second page is least recent now
+            cache.derive(records[200:])
+            assert len(cache) == 200 and cache.evictions == 100
+            cache.derive(records[100:200])
+            assert cache.info()[:2] == (100, 400) and len(cache) == 200
+        # Other version misses
+        with resultcache.ResultCache(db, maxsize=None, pagesize=100,
+                                     version='b') as cache:
+            cache.derive(records[:50])
+            assert cache.info()[:2] == (0, 50) and len(cache) == 250
+        # Index is rebuilt on open, other version is evicted first
+        with resultcache.ResultCache(db, maxsize=260, pagesize=100,
+                                     version='a') as cache:
+            _same_panels(cache.derive(records[100:]),
+                         pipeline.derive(records[100:]))
+            assert cache.info()[:2] == (200, 0)
+            cache.derive(records[:10])
+            cache.derive(synth.generate(10, seed=4))
+            assert cache.evictions == 50 and len(cache) == 220
+            cache.derive(records[100:])
+            assert cache.info()[:2] == (400, 20)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_instrument():
+    graph = pipeline.GRAPH
+    cbase = abg_batch.calculate_cbase
+    records = synth.generate(200, seed=5)
+    expected = pipeline.derive(records)
+    with instrument.profile() as prof:
+        _same_panels(pipeline.derive(records), expected)
+    assert pipeline.GRAPH is graph and abg_batch.calculate_cbase is cbase
+    functions = prof.functions
+    assert functions['abg_batch.calculate_cbase'].calls == 2  # SBE, ABE
+    for name in ('abg_batch.calculate_hct', 'pipeline.Hct', 'pipeline._odc',
+                 'odc_batch.ODCBatch.fit'):
+        assert functions[name].calls == 1, name
+    fits = sum(sum(prof.iterations[branch].values())
+               for branch in instrument.BRANCHES)
+    assert fits == np.isfinite(records['sO2']).sum()
+    assert instrument.current() is None
+
+
+# Agreement of `pipeline.derive` with analyzer printout of samples.csv,
+# tolerance is printout rounding plus formula differences
+PRINTOUT_TOLERANCE = {
+    'SBE': 0.1, 'ABE': 0.15, 'HCO3st': 0.1, 'AnionGap': 1.,
+    'AnionGapK': 1., 'mOsm': 1.5, 'Hct': 0.2, 'pHT': 0.001, 'pCO2T': 0.1,
+    'ctO2': 0.3, 'p50': 0.7, 'RespIdx': 2.5,
+}
+
+
+def test_pipeline_samples():
+    records = sample.read_csv(SAMPLES_CSV)
+    derived = pipeline.derive(records)
+    assert sorted(derived) == sorted(list(PRINTOUT_TOLERANCE) + ['HCO3act'])
+    for name, tolerance in PRINTOUT_TOLERANCE.items():
+        assert np.isfinite(derived[name]).all(), name
+        report = records[name].astype(float)
+        known = np.isfinite(report)
+        assert np.all(np.abs(derived[name] - report)[known] <= tolerance), \
+            name
+    # Same values from dict of columns, subset of columns
+    table = dict((name, records[name]) for name in records.dtype.names)
+    subset = pipeline.derive(table, columns=['SBE', 'p50'])
+    assert sorted(subset) == ['SBE', 'p50']
+    assert _close(subset['p50'], derived['p50'])
+    # Scalar formulas give same values
+    row = records[0]
+    assert _close(derived['HCO3act'][0], abg.calculate_hco3p(
+        float(row['pH']), float(row['pCO2']) * units.kPa))
+    assert pipeline.column_names(table) == pipeline.column_names(records)
+
+
+def test_odc_table():
+    table = odc_table.default()
+    assert table is odc_table.default()
+    assert table.max_error(size=20000) < odc_table.MAX_ERROR
+    # Against scalar Newton-Raphson model, inside and outside of domain
+    exact = odc.ODC(tol=1e-13)
+    tabulated = odc.ODC(table=table)
+    for model in (exact, tabulated):
+        model.fit(sO2=0.453, pO2=4.49, pCO2=9.15, pH=6.919)
+    # Last two are outside of table, solved with `odc.epsilon` tolerance
+    for sO2, A, T, bound in (
+            (0.453, 0.12, 37, odc_table.MAX_ERROR),
+            (0.97, -0.3, 30., odc_table.MAX_ERROR),
+            (0.02, 0.5, 40, odc_table.MAX_ERROR),
+            (0.99999, 0., 37, odc.epsilon), (0.5, 1.5, 37, odc.epsilon)):
+        p = exact.eval_pressure(sO2, A, T)
+        assert abs(math.log(tabulated.eval_pressure(sO2, A, T) / p)) < \
+            bound, (sO2, A, T)
+        assert _close(exact.eval_saturation(p, A, T), sO2, 1e-9)
+    assert _close(tabulated.eval_p50(), exact.eval_p50(), 1e-5)
+
+
+def _fit(models, row):
+    pH, pCO2, _, sO2, pO2 = row[:5]
+    return models.fit(sO2=sO2, pO2=pO2, pCO2=pCO2, pH=pH)
+
+
+def test_odc_cache():
+    for policy in ('lru', 'fifo'):
+        models = cache.ODCCache(maxsize=2, policy=policy)
+        first = _fit(models, SAMPLES[0])
+        _fit(models, SAMPLES[1])
+        assert _fit(models, SAMPLES[0]) is first  # First is recent for LRU
+        _fit(models, SAMPLES[2])
+        assert models.info()[:3] == (1, 3, 1) and len(models) == 2
+        kept = _fit(models, SAMPLES[0]) is first
+        assert kept == (policy == 'lru'), policy
+    # Rounded inputs share model, memoized results equal plain model ones
+    models = cache.ODCCache(maxsize=None)
+    pH, pCO2, ctHb, sO2, pO2 = SAMPLES[1][:5]
+    model = _fit(models, SAMPLES[1])
+    assert models.fit(sO2=sO2 + 1e-9, pO2=pO2, pCO2=pCO2, pH=pH) is model
+    plain = odc.ODC()
+    plain.fit(sO2=sO2, pO2=pO2, pCO2=pCO2, pH=pH)
+    for _ in range(2):
+        assert model.eval_p50() == plain.eval_p50()
+        assert model.eval_p50st() == plain.eval_p50st()
+        assert model.eval_pO2T(ctHb, 30.) == plain.eval_pO2T(ctHb, 30.)
+    info = models.info()
+    assert (info.hits, info.misses, info.eval_hits, info.eval_misses,
+            info.currsize) == (1, 1, 3, 3, 1)
+    models.clear()
+    assert models.info() == cache.CacheInfo(0, 0, 0, 0, 0, None, 0)
+    assert _raises(ValueError, cache.ODCCache, policy='lfu')
+
+
+def test_propagation():
+    pH, pCO2, ctHb, sO2, pO2, FCOHb, FMetHb, Na, Cl, glu = _columns()
+    sd = propagation.ABL800_SD
+    checks = (
+        ('calculate_hco3p', dict(pH=pH, pCO2=pCO2)),
+        ('calculate_cbase', dict(pH=pH, pCO2=pCO2, ctHb=ctHb)),
+        ('calculate_hco3pst', dict(pH=pH, pCO2=pCO2, ctHb=ctHb, sO2=sO2)),
+        ('calculate_ctO2', dict(pO2=pO2, sO2=sO2, FCOHb=FCOHb,
+                                FMetHb=FMetHb, ctHb=ctHb)),
+        ('calculate_mosm', dict(Na=Na, glucosae=glu)),
+    )
+    abg.use_uncertainties()
+    try:
+        for name, kwargs in checks:
+            value, deviation = propagation.propagate(
+                name, {arg: sd[arg] for arg in kwargs}, **kwargs)
+            for i in range(len(pH)):
+                expected = getattr(abg, name)(**{
+                    arg: ufloat(v[i], sd[arg]) for arg, v in kwargs.items()})
+                assert _close(value[i], expected.nominal_value), name
+                assert _close(deviation[i], expected.std_dev, 1e-6), name
+    finally:
+        abg.use_uncertainties(False)
+    # Exact arguments add nothing, unknown ones are rejected
+    _, deviation = propagation.propagate(
+        'calculate_hco3p', {'pH': 0.}, pH=pH, pCO2=pCO2)
+    assert not deviation.any()
+    assert _raises(ValueError, propagation.propagate, 'calculate_hco3p',
+                   {'ctHb': 1.}, pH=pH, pCO2=pCO2)
+    assert _raises(ValueError, propagation.gradient, 'calculate_p50')
+
+
+def _concat(chunks):
+    chunks = list(chunks)
+    return dict((name, np.concatenate([chunk[name] for chunk in chunks]))
+                for name in chunks[0])
+
+
+def test_stream_chunks():
+    whole = next(stream.read_chunks(SAMPLES_CSV, chunksize=10 ** 6))
+    expected = pipeline.derive(whole)
+    for chunksize in (1, 7, 1000):
+        derived = _concat(stream.derive_chunks(
+            stream.read_chunks(SAMPLES_CSV, chunksize=chunksize)))
+        assert list(derived) == list(stream.PASSTHROUGH) + list(expected)
+        for name in expected:
+            assert np.array_equal(derived[name], expected[name],
+                                  equal_nan=True), (chunksize, name)
+        assert (derived['id'] == whole['id']).all()
+    # Blocks parsed apart give same chunks
+    blocks = [stream.parse_block(header, records) for header, records in
+              stream.read_blocks(SAMPLES_CSV, chunksize=7)]
+    for name, values in _concat(blocks).items():
+        assert np.array_equal(values, whole[name], equal_nan=(
+            values.dtype.kind == 'f')), name
+    # Written CSV is read back as is
+    target = io.StringIO()
+    count = stream.write_csv(stream.derive_chunks(
+        stream.read_chunks(SAMPLES_CSV, chunksize=7)), target)
+    target.seek(0)
+    back = next(stream.read_chunks(
+        target, chunksize=10 ** 6, columns=list(expected)))
+    assert count == len(whole['id']) == len(back['id'])
+    for name in expected:
+        assert np.array_equal(back[name], expected[name], equal_nan=True)
+
+
+def test_curves():
+    pH, pCO2, _, sO2, pO2 = _columns()[:5]
+    pressures = np.array([0.5, 2., 3.578, 7., 13.3, 30.])
+    saturations = np.array([0.05, 0.3, 0.5, 0.9, 0.98])
+    batch = odc_batch.ODCBatch(tol=1e-12)
+    batch.fit(sO2=sO2, pO2=pO2, pCO2=pCO2, pH=pH)
+    for T in (None, 30.):
+        batch_s = batch.saturation_curve(pressures, T)
+        batch_p = batch.pressure_curve(saturations, T)
+        assert batch_s.shape == (4, 6) and batch_p.shape == (4, 5)
+        for i in range(len(pH)):
+            model = odc.ODC(tol=1e-12)
+            model.fit(sO2=sO2[i], pO2=pO2[i], pCO2=pCO2[i], pH=pH[i])
+            t = model.T if T is None else T
+            s = [model.eval_saturation(p, model.a, t) for p in pressures]
+            p = [model.eval_pressure(s, model.a, t) for s in saturations]
+            assert _close(model.saturation_curve(pressures, T), s), (T, i)
+            assert _close(model.pressure_curve(saturations, T), p, 1e-8)
+            assert _close(batch_s[i], s, 1e-8), (T, i)
+            assert _close(batch_p[i], p, 1e-8), (T, i)
+    # Pressure curve is inverse of saturation one
+    x_0, h = batch.curve_constants()
+    for i, p in enumerate(batch.pressure_curve(saturations)):
+        assert _close(odc_batch.curve_saturation(p, x_0[i], h[i]),
+                      saturations), i
+
+
+def test_sample_records():
+    dtype = sample.dtype()
+    assert dtype is sample.dtype() and dtype.itemsize == 136
+    assert dtype.names == ('id', 'sample_date') + tuple(
+        name for name, _ in sample.COLUMNS)
+    assert dtype.fields['pCO2'][0].metadata['unit'] == 'mmHg'
+    assert sample.unit('sO2') == '%'
+    assert _raises(ValueError, sample.unit, 'HCO3act')
+    records = sample.empty(2)
+    assert (records['id'] == -1).all() and np.isnat(
+        records['sample_date']).all()
+    assert np.isnan(records['pH']).all()
+    # Missing, bad and extra values
+    records = sample.from_table({
+        'id': [7., np.nan], 'sample_date': ['2015-04-29 10:21', '10:21'],
+        'pH': [7.39, np.nan], 'note': ['a', 'b']})
+    assert records['id'].tolist() == [7, -1]
+    assert records['sample_date'][0] == np.datetime64('2015-04-29T10:21')
+    assert np.isnat(records['sample_date'][1])
+    assert records['pH'][0] == np.float32(7.39) and np.isnan(
+        records['pH'][1]) and np.isnan(records['pO2']).all()
+    # CSV values are kept as float32 of analyzer printout
+    records = sample.read_csv(SAMPLES_CSV)
+    raw = next(stream.read_chunks(SAMPLES_CSV, chunksize=10 ** 6,
+                                  columns=list(sample.UNITS)))
+    assert len(records) == len(raw['pH'])
+    for name in sample.UNITS:
+        assert np.array_equal(records[name], raw[name].astype(np.float32),
+                              equal_nan=True), name
+    assert len(sample.read_csv(io.StringIO('"id","pH"\n'))) == 0
+
+
+def _abg_grid():
+    """pH and pCO2 mmHg grid crossing all decision table boundaries."""
+    pH = [6.9, 7.2, 7.35, 7.37, 7.39, 7.4, 7.41, 7.43, 7.45, 7.5, 7.7,
+          np.nan]
+    pCO2 = [20., 34.9, 35., 38., 40., 42., 45., 45.1, 70., np.nan]
+    return [a.ravel() for a in np.meshgrid(pH, pCO2)]
+
+
+def test_classify_parity():
+    pH, pCO2 = _abg_grid()
+    result = abg_batch.classify(pH, pCO2)
+    assert result.code.dtype == np.int8
+    texts = abg_batch.opinions(result)
+    for i in range(len(pH)):
+        code = abg.classify(pH[i], pCO2[i])
+        assert result.code[i] == code, (pH[i], pCO2[i])
+        assert texts[i] == abg.abg(pH[i], pCO2[i]), (pH[i], pCO2[i])
+        assert _close(result.expected_pH[i], abg.expected_pH(pCO2[i]))
+    codes = set(result.code.tolist())
+    assert codes == set(range(abg.MET_ALK + 1)), codes
+    # Broadcasting, 2-d input
+    result = abg_batch.classify(pH.reshape(10, 12), 40.)
+    assert result.code.shape == (10, 12)
+    assert (result.code.ravel() == abg_batch.classify(pH, 40.).code).all()
+
+
+def test_compensation_parity():
+    pH, pCO2 = _abg_grid()
+    HCO3 = np.linspace(10., 40., len(pH))
+    for given in (None, HCO3):
+        result = abg_batch.compensation(pH, pCO2, given)
+        for i in np.flatnonzero(pCO2 != 40.):
+            expected = abg.compensation(
+                pH[i], pCO2[i], None if given is None else HCO3[i])
+            for name, value in result._asdict().items():
+                assert _close(value[i], getattr(expected, name)), (name, i)
+    ratio = result.ratio[pCO2 == 40.]
+    assert (np.isinf(ratio) | np.isnan(ratio)).all()
+    # Reports equal printed ones
+    known = np.isfinite(pH) & np.isfinite(pCO2) & (pCO2 != 40.)
+    pH, pCO2 = pH[known], pCO2[known]
+    texts = abg_batch.render(pH, pCO2, abg_batch.describe(pH, pCO2))
+    for i in range(len(pH)):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            assert texts[i] == abg.describe(pH[i], pCO2[i])
+        assert out.getvalue() == texts[i] + '\n'
+
+
+def _same_reports(report, expected):
+    assert sorted(report) == sorted(expected)
+    for name, stats in expected.items():
+        for key, value in stats.items():
+            if isinstance(value, float):
+                assert _close(report[name][key], value), (name, key)
+            else:
+                assert report[name][key] == value, (name, key)
+
+
+def test_validate_pool():
+    serial = validate.validate(SAMPLES_CSV, workers=0, chunksize=10 ** 6)
+    assert serial['ABE']['checked'] > 0 and serial['ABE']['agreement'] > 0.5
+    mismatches = sum(len(stats['mismatches']) for stats in serial.values())
+    assert mismatches, "mismatch lists aren't checked"
+    # Small blocks, merged out of process
+    _same_reports(validate.validate(SAMPLES_CSV, workers=2, chunksize=7),
+                  serial)
+    _same_reports(validate.validate(SAMPLES_CSV, workers=0, chunksize=7),
+                  serial)
+    # Mismatch lists are capped, first rows are kept
+    capped = validate.validate(SAMPLES_CSV, workers=2, chunksize=7, limit=1)
+    for name, stats in serial.items():
+        assert capped[name]['mismatches'] == stats['mismatches'][:1], name
+
+
+def _same_values(values, expected):
+    """Equal arrays, missing values (NaN, NaT) included."""
+    if values.dtype.kind == 'M':
+        values, expected = values.view(np.int64), expected.view(np.int64)
+    return np.array_equal(values, expected,
+                          equal_nan=values.dtype.kind == 'f')
+
+
+def test_column_store():
+    records = sample.read_csv(SAMPLES_CSV)
+    size = len(records)
+    path = tempfile.mkdtemp()
+    try:
+        store = colstore.ColumnStore(os.path.join(path, 'gases'))
+        assert len(store) == 0 and store.columns == ()
+        assert store.import_csv(SAMPLES_CSV, chunksize=7) == size
+        reader = colstore.ColumnStore(store.path)
+        for name in records.dtype.names:
+            values = store.column(name)
+            assert values.dtype == records.dtype.fields[name][0], name
+            assert _same_values(values, records[name]), name
+            # Plain `.npy` files
+            assert _same_values(np.load(os.path.join(
+                store.path, name + '.npy'), mmap_mode='r'), values), name
+        assert np.array_equal(store.column('pH', 3, 6), records['pH'][3:6])
+        # Derived columns are filled incrementally
+        assert store.update_derived(['SBE'], chunksize=5) == size
+        assert store.update_derived(['SBE']) == 0
+        assert store.append(records[:10]) == 10 and len(store) == size + 10
+        assert store.rows('derived/SBE') == size
+        assert store.update_derived(['SBE'], chunksize=4) == 10
+        assert store.update_derived(chunksize=50) == size + 10
+        twice = np.concatenate([records, records[:10]])
+        expected = pipeline.derive(twice)
+        for name, values in expected.items():
+            column = store.column(colstore.DERIVED + name)
+            assert len(column) == size + 10, name
+            assert _same_values(column, values.astype(np.float32)), name
+            assert _same_values(np.load(os.path.join(
+                store.path, colstore.DERIVED + name + '.npy')), column), name
+        assert store.unit('derived/HCO3act') == 'mmol/L'
+        assert _raises(ValueError, store.unit, 'derived/pH')
+        assert _raises(KeyError, store.column, 'derived/pH')
+        # Reader sees appended rows after reload only
+        assert len(reader) == size and len(reader.column('pH')) == size
+        reader.reload()
+        assert len(reader) == size + 10 and 'derived/p50' in reader
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print('%s ok' % name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-patient trends of serial blood gases.
+
+`TrendEngine` keeps running state for every patient `id`: last value,
+delta from previous sample, exponentially weighted moving average (EWMA)
+and EWMA of rate of change of `TRENDED` parameters. Each sample updates
+state in constant time, history is never stored or rescanned:
+
+    >>> engine = TrendEngine(halflife=240, maxsize=10000, idle=48 * 60)
+    >>> engine.update(13594, {'SBE': -5.2, 'p50': 25.1}, '2015-04-29T08:10')
+    >>> for chunk in stream.read_chunks('feed.csv'):
+    ...     engine.update_table(chunk)  # Missing derived columns are derived
+    >>> engine.trend(13594)['SBE']
+    Trend(last=-5.2, delta=nan, ewma=-5.2, slope=nan, count=1)
+
+Weight of new sample depends on time since previous one: EWMA forgets
+half of its past in `halflife` minutes, so irregular sampling is handled.
+Slope is EWMA of (delta / elapsed hours).
+
+Memory is bounded: at most `maxsize` patients are tracked (least
+recently updated one is evicted), patients without samples for `idle`
+minutes are evicted as well. Sample without time counts as seen at
+newest sample time seen so far; patients seen before any timed sample
+are idle once timed samples arrive. Timed samples not newer than patient's
+last one (e.g. re-imported archive) are skipped and counted as 'stale'.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from collections import namedtuple, OrderedDict
+import threading
+
+import backends
+
+np = backends.lazy('numpy')
+
+# Tracked parameters, `samples.csv` names and units. RespIdx is pO2/FO2.
+TRENDED = ('SBE', 'HCO3st', 'p50', 'RespIdx')
+
+Trend = namedtuple('Trend', 'last delta ewma slope count')
+Trend.__doc__ = """Trend of one parameter of one patient.
+
+delta - last minus previous value, NaN after first sample.
+slope - EWMA of rate of change, units per hour.
+count - number of samples with this parameter.
+"""
+
+TrendInfo = namedtuple(
+    'TrendInfo', 'updates stale evictions expired maxsize currsize')
+
+_nan = float('nan')
+
+
+def _minutes(value):
+    """Sample time as float minutes since epoch, NaN if unknown.
+
+    :param value: `numpy.datetime64`, ISO string, number of minutes or
+        None.
+    """
+    if value is None:
+        return _nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        value = np.datetime64(value.strip() if isinstance(value, str)
+                              else value, 'm')
+    except ValueError:
+        return _nan
+    if np.isnat(value):
+        return _nan
+    return float(value.astype(np.int64))
+
+
+class _State(object):
+
+    """Running state of one patient, `TRENDED` values in lists."""
+
+    __slots__ = ('time', 'seen', 'last', 'delta', 'ewma', 'slope', 'count')
+
+    def __init__(self):
+        n = len(TRENDED)
+        self.time = _nan  # Last sample time
+        self.seen = _nan  # Last update time for `idle` eviction
+        self.last = [_nan] * n
+        self.delta = [_nan] * n
+        self.ewma = [_nan] * n
+        self.slope = [_nan] * n
+        self.count = [0] * n
+
+
+class TrendEngine(object):
+
+    """Incremental per-patient trends, see module description.
+
+    :param float halflife: EWMA half-life, minutes. Samples without time
+        are weighted as if one half-life passed.
+    :param int maxsize: Maximum number of tracked patients, None for
+        unbounded.
+    :param float idle: Patients without samples for given number of
+        minutes (by newest sample time seen) are evicted. None keeps them
+        until `maxsize` is reached.
+    """
+
+    def __init__(self, halflife=240, maxsize=10000, idle=None):
+        self.halflife = halflife
+        self.maxsize = maxsize
+        self.idle = idle
+        self._states = OrderedDict()  # id -> _State, least recent first
+        self._lock = threading.Lock()
+        self._now = _nan  # Newest sample time seen, minutes
+        self.updates = 0
+        self.stale = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def update(self, patient, values, time=None):
+        """Add sample of patient.
+
+        :param patient: Patient id, any hashable.
+        :param dict values: `TRENDED` parameter to value, missing or NaN
+            values leave parameter trend unchanged.
+        :param time: Sample time, see `_minutes`.
+        :return:
+            False if sample is not newer than last one of patient and
+            skipped.
+        :rtype: bool
+        """
+        minutes = _minutes(time)
+        with self._lock:
+            state = self._states.get(patient)
+            if state is None:
+                state = self._states[patient] = _State()
+            else:
+                if minutes <= state.time:  # Re-import repeats last one
+                    self.stale += 1
+                    return False
+                self._states.move_to_end(patient)
+            self._apply(state, values, minutes)
+            self.updates += 1
+            if minutes > self._now or self._now != self._now:
+                self._now = minutes
+            state.seen = minutes if minutes == minutes else self._now
+            self._evict()
+        return True
+
+    def _apply(self, state, values, minutes):
+        elapsed = minutes - state.time  # NaN if any time unknown
+        if elapsed == elapsed:
+            weight = 1 - 0.5 ** (elapsed / self.halflife)
+        else:
+            weight = 0.5
+        hours = elapsed / 60
+        for i, name in enumerate(TRENDED):
+            value = values.get(name, _nan)
+            if value is None or value != value:
+                continue
+            value = float(value)
+            if state.count[i]:
+                delta = value - state.last[i]
+                state.delta[i] = delta
+                state.ewma[i] += weight * (value - state.ewma[i])
+                if hours > 0:
+                    rate = delta / hours
+                    if state.slope[i] != state.slope[i]:
+                        state.slope[i] = rate
+                    else:
+                        state.slope[i] += weight * (rate - state.slope[i])
+            else:
+                state.ewma[i] = value
+            state.last[i] = value
+            state.count[i] += 1
+        if minutes == minutes:
+            state.time = minutes
+
+    def _evict(self):
+        """Drop idle patients and least recent ones above `maxsize`.
+
+        States are ordered by update, so only head of queue is checked.
+        Head without `seen` time (updated before any timed sample) is
+        expired, otherwise it would keep every state behind it.
+        """
+        if self.idle is not None and self._now == self._now:
+            while self._states:
+                state = next(iter(self._states.values()))
+                if state.seen >= self._now - self.idle:
+                    break
+                self._states.popitem(last=False)
+                self.expired += 1
+        while self.maxsize is not None and len(self._states) > self.maxsize:
+            self._states.popitem(last=False)
+            self.evictions += 1
+
+    def update_table(self, table, ids='id', times='sample_date'):
+        """Add every row of table in order.
+
+        `TRENDED` columns absent in table are derived by `pipeline.derive`
+        if inputs are present.
+
+        :param table: `samples.csv`-like table, e.g. chunk of
+            `stream.read_chunks` or `sample` records.
+        :param str ids: Patient id column.
+        :param str times: Sample time column, optional.
+        :return:
+            Number of rows applied (not stale).
+        :rtype: int
+        """
+        import pipeline
+        names = pipeline.column_names(table)
+        missing = [name for name in TRENDED if name not in names]
+        derived = pipeline.derive(table, columns=missing) if missing else {}
+        columns = [(name, np.asarray(
+            derived[name] if name in derived else table[name],
+            dtype=float).tolist())
+            for name in TRENDED if name in names or name in derived]
+        patients = np.asarray(table[ids]).tolist()
+        if times in names:
+            dates = np.asarray(table[times])
+            if dates.dtype.kind == 'M':
+                minutes = np.where(
+                    np.isnat(dates), np.nan,
+                    dates.astype('datetime64[m]').astype(np.int64)).tolist()
+            else:
+                minutes = [_minutes(d) for d in dates.tolist()]
+        else:
+            minutes = [None] * len(patients)
+        applied = 0
+        for row, (patient, time) in enumerate(zip(patients, minutes)):
+            values = dict((name, column[row]) for name, column in columns)
+            applied += self.update(patient, values, time)
+        return applied
+
+    def trend(self, patient):
+        """Current trends of patient.
+
+        :return:
+            `TRENDED` parameter to `Trend`, None for unknown patient.
+        :rtype: dict
+        """
+        with self._lock:
+            state = self._states.get(patient)
+            if state is None:
+                return None
+            return dict(
+                (name, Trend(state.last[i], state.delta[i], state.ewma[i],
+                             state.slope[i], state.count[i]))
+                for i, name in enumerate(TRENDED))
+
+    def last_time(self, patient):
+        """Time of last sample of patient, `numpy.datetime64` or None."""
+        state = self._states.get(patient)
+        if state is None or state.time != state.time:
+            return None
+        return np.datetime64(int(state.time), 'm')
+
+    def info(self):
+        """Engine statistics.
+
+        :rtype: TrendInfo
+        """
+        return TrendInfo(self.updates, self.stale, self.evictions,
+                         self.expired, self.maxsize, len(self._states))
+
+    def clear(self):
+        """Drop all patients and reset statistics."""
+        with self._lock:
+            self._states.clear()
+            self._now = _nan
+            self.updates = self.stale = self.evictions = self.expired = 0
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, patient):
+        return patient in self._states
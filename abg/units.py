@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Units of measurement and ingest-time conversion.
+
+Formulas in `abg`, `odc` and their batch versions expect canonical units
+(kPa, fraction, mmol/L, °C) and never convert or check units themselves.
+Tables are converted once, column by column, by `ingest`:
+
+    >>> values = units.ingest(records)  # `sample` records, units in dtype
+    >>> values = units.ingest(data, {'pCO2': 'kPa'})  # override for column
+    >>> abg_batch.calculate_hco3p(values['pH'], values['pCO2'])
+
+Every column unit is checked before anything is converted, so a table with
+e.g. pCO2 in mmol/L is rejected as a whole with `UnitError`.
+
+Exceptions, kept for compatibility with Radiometer report layout:
+`abg.calculate_hco3`, `abg.expected_pH` and acid-base interpretation
+(`abg.abg`, `abg.abg2`, `abg.describe`) take pCO2 in mmHg,
+`abg.calculate_pO2_FO2_fraction` returns mmHg.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import backends
+
+np = backends.lazy('numpy')
+
+kPa = 0.133322368  # kPa to mmHg, 1 mmHg = 0.133322368 kPa
+ctHb_g_dL = 0.62058  # ctHb(mmol/L) == ctHb(g/dL) * 0.62058
+ctO2_Vol = 2.241  # ctO2(Vol%) == ctO2(mmol/L) * 2.241
+
+# Accepted units -> multiplier to canonical unit (one with multiplier 1)
+PRESSURE = {'kPa': 1., 'mmHg': kPa}
+FRACTION = {'fraction': 1., '%': 0.01}
+CONCENTRATION = {'mmol/L': 1.}
+
+# Formula argument -> (samples.csv column, samples.csv unit, accepted units)
+INPUTS = {
+    'pH': ('pH', '', {'': 1.}),
+    'pCO2': ('pCO2', 'mmHg', PRESSURE),
+    'pO2': ('pO2', 'mmHg', PRESSURE),
+    'sO2': ('sO2', '%', FRACTION),
+    'ctHb': ('ctHb', 'g/dL', {'mmol/L': 1., 'g/dL': ctHb_g_dL}),
+    'FCOHb': ('FCOHb', '%', FRACTION),
+    'FMetHb': ('FMetHb', '%', FRACTION),
+    'FO2': ('FO2', '%', FRACTION),
+    'Na': ('cNa', 'mmol/L', CONCENTRATION),
+    'Cl': ('cCl', 'mmol/L', CONCENTRATION),
+    'K': ('cK', 'mmol/L', CONCENTRATION),
+    'glucosae': ('cGlu', 'mmol/L', CONCENTRATION),
+    'T': ('temp', '°C', {'°C': 1.}),
+}
+
+
+class UnitError(ValueError):
+
+    """Raised for unit which can't be converted to canonical one."""
+
+
+def canonical(name):
+    """Canonical unit of formula argument, e.g. 'kPa' for 'pCO2'.
+
+    :param str name: One of `INPUTS`.
+    :rtype: str
+    """
+    accepted = INPUTS[name][2]
+    return next(unit for unit, m in accepted.items() if m == 1.)
+
+
+def multiplier(name, unit):
+    """Multiplier converting `unit` to canonical unit of `name`.
+
+    :param str name: Formula argument, one of `INPUTS`.
+    :param str unit: Unit of values.
+    :raises UnitError: If unit is not accepted for `name`.
+    :rtype: float
+    """
+    column, _, accepted = INPUTS[name]
+    try:
+        return accepted[unit]
+    except KeyError:
+        raise UnitError("'%s' in '%s', expected one of %s" % (
+            column, unit, ', '.join("'%s'" % u for u in sorted(accepted))))
+
+
+def convert(values, name, unit):
+    """Convert array of `name` values from `unit` to canonical unit.
+
+    :rtype: ndarray
+    """
+    return np.asarray(values, dtype=float) * multiplier(name, unit)
+
+
+def column_units(table, units=None):
+    """Unit of every input column of table.
+
+    Taken from `units`, then from structured dtype field metadata (see
+    `sample`), `samples.csv` units otherwise.
+
+    :param table: DataFrame, dict of arrays or structured ndarray.
+    :param dict units: Column name to unit overrides.
+    :raises UnitError: For override of unknown column.
+    :return:
+        Column name to unit for columns present in table.
+    :rtype: dict
+    """
+    units = units or {}
+    unknown = set(units) - set(column for column, _, _ in INPUTS.values())
+    if unknown:
+        raise UnitError("Unknown input columns %s" % ', '.join(
+            sorted(unknown)))
+    dtype = getattr(table, 'dtype', None)
+    fields = dtype.fields if dtype is not None and dtype.names else None
+    if fields is not None:
+        names = set(fields)
+    else:
+        names = set(table.keys())
+    result = {}
+    for column, default, _ in INPUTS.values():
+        if column not in names:
+            continue
+        metadata = fields[column][0].metadata if fields else None
+        if column in units:
+            result[column] = units[column]
+        elif metadata and 'unit' in metadata:
+            result[column] = metadata['unit']
+        else:
+            result[column] = default
+    return result
+
+
+def ingest(table, units=None):
+    """Convert table columns to canonical units of formula arguments.
+
+    All units are validated before any column is converted.
+
+    :param table: DataFrame, dict of arrays or structured ndarray with
+        `samples.csv` column names.
+    :param dict units: Column name to unit, see `column_units`.
+    :raises UnitError: If any column has unit not accepted for it.
+    :return:
+        Formula argument name to float ndarray in canonical units.
+        Missing columns are skipped.
+    :rtype: dict
+    """
+    found = column_units(table, units)
+    factors = dict(
+        (name, multiplier(name, found[column]))
+        for name, (column, _, _) in INPUTS.items() if column in found)
+    return dict(
+        (name, np.asarray(table[INPUTS[name][0]], dtype=float) * factor)
+        for name, factor in factors.items())
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parallel validation of formulas against ABL800 Flex reports.
+
+Same check as `test_abg.diff`: calculated value agrees with analyzer
+printout if they differ by no more than sum of their standard deviations.
+Printout SD is its last digit (`CHECKS`), calculated value SD is
+propagated from measurement SDs (`propagation.ABL800_SD`) analytically.
+
+Corpus in `samples.csv` layout is split to blocks of raw records
+(`stream.read_blocks`), blocks are parsed and checked in a process pool
+and per-parameter statistics are merged, so memory use doesn't depend on
+corpus size:
+
+    $ python validate.py slips.csv --workers 8 > report.json
+
+    >>> report = validate('slips.csv', workers=8)
+    >>> report['ABE']['agreed'] / report['ABE']['checked']
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import sys
+
+import backends
+import propagation
+import stream
+from units import INPUTS, ingest, kPa, ctO2_Vol
+
+np = backends.lazy('numpy')
+
+# Intermediate values with propagated SD: name -> (formula, arguments)
+DERIVED = {
+    'HCO3act': ('calculate_hco3p', ('pH', 'pCO2')),
+}
+
+# Checked parameter -> (report column, report SD, formula, arguments,
+# multiplier from formula units to report units). Argument is input name
+# or (formula argument, input name) pair.
+CHECKS = {
+    'Hct': ('Hct', 0.1, 'calculate_hct', ('ctHb',), 100.),
+    'AnionGap': ('AnionGap', 0.1, 'calculate_anion_gap',
+                 ('Na', 'Cl', 'HCO3act'), 1.),
+    'pHT': ('pHT', 0.001, 'calculate_pHT', ('pH', ('t', 'T')), 1.),
+    'pCO2T': ('pCO2T', 0.1, 'calculate_pCO2T', ('pCO2', ('t', 'T')),
+              1 / kPa),
+    'ctO2': ('ctO2', 0.1, 'calculate_ctO2',
+             ('pO2', 'sO2', 'FCOHb', 'FMetHb', 'ctHb'), ctO2_Vol),
+    'RespIdx': ('RespIdx', 1., 'calculate_pO2_FO2_fraction',
+                ('pO2', 'FO2'), 1.),
+    'HCO3st': ('HCO3st', 0.1, 'calculate_hco3pst',
+               ('pH', 'pCO2', 'ctHb', 'sO2'), 1.),
+    'SBE': ('SBE', 0.1, 'calculate_cbase', ('pH', 'pCO2'), 1.),
+    'ABE': ('ABE', 0.1, 'calculate_cbase', ('pH', 'pCO2', 'ctHb'), 1.),
+    'mOsm': ('mOsm', 0.1, 'calculate_mosm', ('Na', 'glucosae'), 1.),
+}
+
+max_mismatches = 1000  # Default cap of mismatch list per parameter
+
+
+def _empty_stats():
+    return {
+        'checked': 0,
+        'agreed': 0,
+        'sum_delta': 0.,
+        'sum_delta2': 0.,
+        'max_abs_delta': 0.,
+        'mismatches': [],
+    }
+
+
+def check_chunk(chunk, offset=0, limit=max_mismatches):
+    """Check one chunk of reports.
+
+    :param dict chunk: `samples.csv`-like table, see `stream.read_chunks`.
+    :param int offset: Row number of first chunk row in corpus.
+    :param int limit: Max mismatches kept per parameter.
+    :return:
+        Parameter name to statistics dict: number of 'checked' rows (both
+        values present), 'agreed' rows, sums of delta (report minus
+        calculated) and its square, 'max_abs_delta' and 'mismatches' -
+        list of (row, id, report, calculated, tolerance).
+    :rtype: dict
+    """
+    values = ingest(chunk)
+    sds = dict((name, sd) for name, sd in propagation.ABL800_SD.items()
+               if name in values)
+
+    def propagate(formula, args):
+        """Value and SD, None if some argument is missing."""
+        pairs = [arg if isinstance(arg, tuple) else (arg, arg)
+                 for arg in args]
+        if not all(name in values for _, name in pairs):
+            return None
+        return propagation.propagate(
+            formula,
+            sd=dict((param, sds[name]) for param, name in pairs
+                    if name in sds),
+            **dict((param, values[name]) for param, name in pairs))
+
+    for name, (formula, args) in DERIVED.items():
+        result = propagate(formula, args)
+        if result is not None:
+            values[name], sds[name] = result
+    ids = chunk.get('id') if hasattr(chunk, 'get') else None
+    report = {}
+    for name, (column, report_sd, formula, args, scale) in CHECKS.items():
+        stats = report[name] = _empty_stats()
+        result = propagate(formula, args)
+        if column not in chunk or result is None:
+            continue
+        value, sd = result
+        expected = np.asarray(chunk[column], dtype=float)
+        got = value * scale
+        tolerance = report_sd + sd * abs(scale)
+        delta = expected - got
+        checked = np.isfinite(delta)
+        agreed = checked & (np.abs(delta) <= tolerance)
+        stats['checked'] = int(checked.sum())
+        stats['agreed'] = int(agreed.sum())
+        stats['sum_delta'] = float(delta[checked].sum())
+        stats['sum_delta2'] = float((delta[checked] ** 2).sum())
+        if stats['checked']:
+            stats['max_abs_delta'] = float(np.abs(delta[checked]).max())
+        rows = np.flatnonzero(checked & ~agreed)[:limit]
+        stats['mismatches'] = [(
+            offset + int(i),
+            None if ids is None else str(ids[i]),
+            float(expected[i]), float(got[i]), float(tolerance[i]))
+            for i in rows]
+    return report
+
+
+def merge(first, second, limit=max_mismatches):
+    """Merge two reports of `check_chunk`, `first` is updated in place.
+
+    :return:
+        `first` report.
+    :rtype: dict
+    """
+    for name, stats in second.items():
+        total = first.setdefault(name, _empty_stats())
+        for key in ('checked', 'agreed', 'sum_delta', 'sum_delta2'):
+            total[key] += stats[key]
+        total['max_abs_delta'] = max(
+            total['max_abs_delta'], stats['max_abs_delta'])
+        room = limit - len(total['mismatches'])
+        total['mismatches'].extend(stats['mismatches'][:max(room, 0)])
+    return first
+
+
+def summary(report):
+    """Add agreement rate, mean and SD of delta to every parameter.
+
+    :param dict report: Output of `validate`.
+    :rtype: dict
+    """
+    for stats in report.values():
+        n = stats['checked']
+        stats['agreement'] = stats['agreed'] / n if n else None
+        stats['mean_delta'] = stats['sum_delta'] / n if n else None
+        stats['sd_delta'] = (
+            max(stats['sum_delta2'] / n - stats['mean_delta'] ** 2, 0.)
+            ** 0.5 if n else None)
+    return report
+
+
+def _columns():
+    """Numeric columns required by `CHECKS`."""
+    columns = set(column for column, _, _ in INPUTS.values())
+    columns.update(column for column, _, _, _, _ in CHECKS.values())
+    return columns
+
+
+def check_block(header, records, offset=0, limit=max_mismatches):
+    """Parse and check raw block of `stream.read_blocks`.
+
+    Runs in worker process, so parent process only splits file.
+
+    :rtype: dict
+    """
+    chunk = stream.parse_block(
+        header, records, passthrough=('id',), columns=_columns())
+    return check_chunk(chunk, offset, limit)
+
+
+def validate(source, workers=None, chunksize=50000, limit=max_mismatches):
+    """Check whole corpus in process pool.
+
+    Parent process splits corpus to raw blocks of records, workers parse
+    and check them. At most `2 * workers` blocks are in flight, so memory
+    is bounded by chunk size.
+
+    :param source: Path or text file object, `samples.csv` layout.
+    :param int workers: Number of processes, CPU count by default. 0 checks
+        in current process.
+    :param int chunksize: Rows per task.
+    :param int limit: Max mismatches kept per parameter.
+    :return:
+        Merged report, see `check_chunk` and `summary`.
+    :rtype: dict
+    """
+    blocks = stream.read_blocks(source, chunksize=chunksize)
+    report = {}
+    offset = 0
+    if workers == 0:
+        for header, records in blocks:
+            merge(report, check_block(header, records, offset, limit), limit)
+            offset += len(records)
+        return summary(report)
+    workers = workers or os.cpu_count() or 1
+    pending = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for header, records in blocks:
+            pending.append(pool.submit(
+                check_block, header, records, offset, limit))
+            offset += len(records)
+            if len(pending) >= 2 * workers:
+                # Merge in submission order, so mismatches are sorted by row
+                merge(report, pending.pop(0).result(), limit)
+        for future in pending:
+            merge(report, future.result(), limit)
+    return summary(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('source', help="samples.csv-layout CSV")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=50000)
+    parser.add_argument('--limit', type=int, default=max_mismatches,
+                        help="max mismatches reported per parameter")
+    args = parser.parse_args()
+    report = validate(args.source, workers=args.workers,
+                      chunksize=args.chunksize, limit=args.limit)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()